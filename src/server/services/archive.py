@@ -0,0 +1,287 @@
+from typing import Any, BinaryIO, Callable, Iterator, Optional
+import hashlib
+import os
+import queue
+import tarfile
+import threading
+import time
+
+
+def start_thread(fn: Callable[[], None]) -> None:
+    """
+    Default way of starting the long-running work of the classes and
+    functions below: on a new daemon thread. Services pass a function
+    starting it on one of their pools instead.
+    """
+    threading.Thread(target=fn, daemon=True).start()
+
+
+class _QueueWriter:
+    """
+    Write-only file object which cuts the written data into chunks of at most
+    'chunk_size' bytes and puts them in a bounded queue, blocking while the
+    queue is full. Raises an OSError once the reader has stopped.
+    """
+    def __init__(self, chunks: queue.Queue, chunk_size: int,
+                 stopped: threading.Event) -> None:
+        self._chunks = chunks
+        self._chunk_size = chunk_size
+        self._stopped = stopped
+        self._buffer = bytearray()
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self._chunk_size:
+            self._put(bytes(self._buffer[:self._chunk_size]))
+            del self._buffer[:self._chunk_size]
+        return len(data)
+
+    def flush(self) -> None:
+        if self._buffer:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+
+    def _put(self, item) -> None:
+        while True:
+            if self._stopped.is_set():
+                raise OSError("Archive reader has stopped.")
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+
+def iter_tar_chunks(path: str, arcname: str, chunk_size: int,
+                    max_chunks: int = 4,
+                    start: Callable[[Callable[[], None]], Any] = start_thread
+                    ) -> Iterator[bytes]:
+    """
+    Return an iterator over a tar archive of the given path in chunks of at
+    most 'chunk_size' bytes, while it is being built. The build is started
+    right away by passing it to 'start' (see start_thread), and runs at most
+    'max_chunks' chunks ahead of the consumer, so memory use is bounded
+    regardless of the size of the files.
+    """
+    chunks: queue.Queue = queue.Queue(max_chunks)
+    stopped = threading.Event()
+    error: Optional[BaseException] = None
+    done = object()
+
+    def build() -> None:
+        nonlocal error
+        writer = _QueueWriter(chunks, chunk_size, stopped)
+        try:
+            with tarfile.open(fileobj=writer, mode="w|") as tar:
+                tar.add(path, arcname=arcname)
+            writer.flush()
+        except BaseException as e:
+            error = e
+        finally:
+            if not stopped.is_set():
+                try:
+                    writer._put(done)
+                except OSError:
+                    pass
+
+    def read() -> Iterator[bytes]:
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is done:
+                    break
+                yield chunk
+            if error is not None:
+                raise error
+        finally:
+            stopped.set()
+
+    start(build)
+    return read()
+
+
+# Tar modes of the supported compression methods.
+COMPRESSION_MODES = {None: "w", "gz": "w:gz", "xz": "w:xz"}
+
+
+def tree_hash(path: str) -> str:
+    """
+    Return a hash of the directory at the given path, based on the path,
+    modification time and size of everything within it, so it only takes a
+    walk over the directory and no files have to be read.
+    """
+    digest = hashlib.sha1()
+    for dir_path, dir_names, file_names in os.walk(path):
+        dir_names.sort()
+        rel_path = os.path.relpath(dir_path, path)
+        for name in [''] + sorted(file_names):
+            try:
+                stat = os.stat(os.path.join(dir_path, name))
+            except OSError:
+                continue
+            digest.update(f"{os.path.join(rel_path, name)}\0"
+                          f"{stat.st_mtime_ns}\0{stat.st_size}\n"
+                          .encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()
+
+
+def build_archive(path: str, arcname: str, dest: str,
+                  compression: Optional[str]) -> int:
+    """
+    Write a tar archive of the given path to 'dest', compressed with the
+    given method ("gz", "xz" or None), and return its size. The archive is
+    written to a temporary file first, so 'dest' is either complete or
+    absent. Meant to run in a process pool.
+    """
+    temp_path = f"{dest}.{os.getpid()}.tmp"
+    try:
+        with tarfile.open(temp_path, COMPRESSION_MODES[compression]) as tar:
+            tar.add(path, arcname=arcname)
+        os.replace(temp_path, dest)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return os.path.getsize(dest)
+
+
+def iter_file_chunks(file: BinaryIO, chunk_size: int) -> Iterator[bytes]:
+    """
+    Generate the content of an open file in chunks of at most 'chunk_size'
+    bytes, and close it afterwards.
+    """
+    with file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class ArchiveCache:
+    """
+    Directory of built project archives, named after the hash of the project
+    tree (see tree_hash) and their compression method, so an archive can be
+    reused as long as nothing in the project has changed. Only the
+    'max_archives' most recently used archives are kept.
+    """
+    def __init__(self, path: str, max_archives: int) -> None:
+        self.path = path
+        self.max_archives = max_archives
+        os.makedirs(path, exist_ok=True)
+
+    def archive_path(self, key: str, compression: Optional[str]) -> str:
+        return os.path.join(self.path, f"{key}.tar"
+                            + (f".{compression}" if compression else ""))
+
+    def open(self, key: str, compression: Optional[str]) -> Optional[BinaryIO]:
+        """
+        Open the cached archive, if present, and mark it as recently used.
+        """
+        path = self.archive_path(key, compression)
+        try:
+            file = open(path, 'rb')
+        except OSError:
+            return None
+        now = time.time_ns()
+        os.utime(path, ns=(now, now))
+        return file
+
+    def evict(self) -> None:
+        """
+        Remove all but the 'max_archives' most recently used archives.
+        Archives which are still being sent remain readable until closed.
+        """
+        archives = []
+        for name in os.listdir(self.path):
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                archives.append((os.stat(path).st_mtime_ns, path))
+            except OSError:
+                continue
+        for _, path in sorted(archives, reverse=True)[self.max_archives:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class ChunkedUpload:
+    """
+    Tar file uploaded in chunks to a temporary file at 'path', which is
+    extracted into the directory 'dest' once the whole file has been
+    uploaded, so no thread is held while the upload is idle. 'on_entry' is
+    called from the extracting thread with the path (relative to 'dest')
+    of every extracted entry, where paths of directories end with a
+    separator.
+
+    An upload can be resumed from its temporary file after the server has
+    restarted, in which case the upload continues at the end of the file.
+
+    Only regular files and directories within 'dest' are extracted; links,
+    devices and paths outside of 'dest' are skipped.
+    """
+    def __init__(self, path: str, dest: str,
+                 on_entry: Callable[[str], None]) -> None:
+        self.path = path
+        self.dest = os.path.realpath(dest)
+        self._on_entry = on_entry
+
+        self._file = open(path, 'ab')
+        self.offset = self._file.tell()
+        self._stopped = threading.Event()
+
+    def _target(self, member: tarfile.TarInfo) -> Optional[str]:
+        if not (member.isfile() or member.isdir()):
+            return None
+        target = os.path.realpath(os.path.join(self.dest, member.name))
+        if not target.startswith(self.dest + os.sep):
+            return None
+        return target
+
+    def _extract(self) -> None:
+        with tarfile.open(self.path, mode="r|") as tar:
+            for member in tar:
+                if self._stopped.is_set():
+                    raise OSError("Extraction has been stopped.")
+                if self._target(member) is None:
+                    continue
+                tar.extract(member, path=self.dest, set_attrs=False)
+                self._on_entry(member.name + os.sep if member.isdir()
+                               else member.name)
+
+    def write(self, offset: int, data: bytes) -> int:
+        """
+        Append a chunk at the given offset, if it is the current offset, and
+        return the offset of the next chunk. Chunks at other offsets (e.g.
+        resent after a lost acknowledgement) are ignored.
+        """
+        if offset == self.offset and data:
+            self._file.write(data)
+            self._file.flush()
+            self.offset += len(data)
+        return self.offset
+
+    def finish(self) -> None:
+        """
+        Extract the whole archive on the calling thread, and remove the
+        temporary file. Raises the error of the extraction, if any.
+        """
+        self._file.close()
+        try:
+            self._extract()
+        finally:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def abort(self) -> None:
+        """
+        Stop the extraction, if any, and remove the temporary file, without
+        waiting for the extraction to stop. Entries which have already been
+        extracted are kept.
+        """
+        self._file.close()
+        self._stopped.set()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,260 @@
+from typing import Dict, Iterator, List, Optional, Sequence
+from array import array
+import bisect
+import itertools
+import locale
+import mmap
+import os
+import threading
+
+
+class BlockView(Sequence):
+    """
+    Read-only view on a range of lines of another sequence, used as a block
+    within the piece table without copying the lines it refers to.
+
+    The underlying sequence is never changed in place by the piece table
+    (the add buffer is only appended to), so a view stays valid for as long
+    as it exists.
+    """
+    __slots__ = ('base', 'start', 'length')
+
+    def __init__(self, base: Sequence, start: int, length: int) -> None:
+        self.base = base
+        self.start = start
+        self.length = length
+
+    @classmethod
+    def of(cls, block: Sequence, start: int, length: int) -> 'BlockView':
+        """
+        Create a view on a range of the given block. If the block is a view
+        itself, the new view refers to the underlying sequence directly.
+        """
+        if isinstance(block, BlockView):
+            return cls(block.base, block.start + start, length)
+        return cls(block, start, length)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            if step != 1:
+                return list(self)[key]
+            return list(self.base[self.start + start:self.start + stop])
+
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError("block view index out of range")
+        return self.base[self.start + key]
+
+    def __iter__(self) -> Iterator[str]:
+        base = self.base
+        if isinstance(base, MappedLines):
+            yield from base.iter_range(self.start, self.start + self.length)
+            return
+        for i in range(self.start, self.start + self.length):
+            yield base[i]
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (list, tuple, BlockView)):
+            return len(self) == len(other) and list(self) == list(other)
+        return NotImplemented
+
+    def __add__(self, other) -> List[str]:
+        return list(self) + list(other)
+
+    def __radd__(self, other) -> List[str]:
+        return list(other) + list(self)
+
+    def __reduce__(self):
+        # Only send the lines within the view, not the underlying sequence.
+        return list, (self[:],)
+
+    def __repr__(self) -> str:
+        return f"BlockView({list(self)!r})"
+
+
+def _split_text(text: str) -> List[str]:
+    """
+    Split text into lines ending with "\\n", normalising "\\r\\n" endings.
+    """
+    parts = text.split('\n')
+    last = parts.pop()
+    lines = [part[:-1] + '\n' if part.endswith('\r') else part + '\n'
+             for part in parts]
+    if last:
+        lines.append(last)
+    return lines
+
+
+class MappedLines(Sequence):
+    """
+    Read-only sequence of the lines of a file on disk, backed by a memory map
+    of the file. Used as the orig block of large files, so that lines are
+    only decoded when they are requested. Line endings are normalised like
+    the universal newlines mode of 'open' does for "\\n" and "\\r\\n"
+    endings.
+
+    Nothing is read up front. The first call to 'len' counts the newlines
+    of every chunk of the file, after which the offsets of the lines within
+    a chunk are only indexed once a line of that chunk is requested. The
+    lines can be read from several threads at once.
+
+    The file itself is mapped, so reading a part of it which has since been
+    truncated would crash the process. Therefore, every read first checks
+    the size and modification time of the file, and raises an OSError if
+    the file has been changed in place. Saving replaces the file by a new
+    one (see ServerFile.write_snapshot), which leaves the mapped file
+    intact.
+    """
+    __slots__ = ('_path', '_file', '_map', '_stat', '_size', '_length',
+                 '_counts', '_chunks', '_encoding', '_lock')
+
+    CHUNK_SIZE = 1 << 20
+    BATCH_LINES = 4096
+
+    def __init__(self, path: str, encoding: Optional[str] = None) -> None:
+        self._path = path
+        self._encoding = encoding or locale.getpreferredencoding(False)
+        self._lock = threading.Lock()
+
+        self._file = open(path, 'rb')
+        stat = os.fstat(self._file.fileno())
+        self._stat = (stat.st_size, stat.st_mtime_ns)
+        self._size = stat.st_size
+        self._map = (mmap.mmap(self._file.fileno(), 0,
+                               access=mmap.ACCESS_READ)
+                     if self._size else None)
+
+        # Number of lines, the number of newlines before the start of every
+        # chunk (followed by the total), and the end offsets of the lines
+        # ending within every indexed chunk.
+        self._length: Optional[int] = None
+        self._counts = array('q')
+        self._chunks: Dict[int, array] = {}
+
+    @property
+    def size(self) -> int:
+        """
+        The size of the mapped file in bytes.
+        """
+        return self._size
+
+    def _check(self) -> None:
+        """
+        Raise an OSError if the file has been changed in place.
+        """
+        stat = os.fstat(self._file.fileno())
+        if (stat.st_size, stat.st_mtime_ns) != self._stat:
+            raise OSError(f"{self._path} has been changed on disk.")
+
+    def _count(self) -> int:
+        """
+        Count the newlines in every chunk, and return the number of lines.
+        """
+        with self._lock:
+            if self._length is not None:
+                return self._length
+
+            self._check()
+            counts = array('q', [0])
+            for pos in range(0, self._size, self.CHUNK_SIZE):
+                counts.append(counts[-1] + self._map[
+                    pos:pos + self.CHUNK_SIZE].count(b'\n'))
+
+            self._counts = counts
+            self._length = counts[-1]
+            if self._size and self._map[self._size - 1:] != b'\n':
+                self._length += 1
+            return self._length
+
+    def _chunk_ends(self, chunk: int) -> array:
+        """
+        Return the end offsets of the lines ending within the given chunk,
+        indexing the chunk if needed.
+        """
+        ends = self._chunks.get(chunk)
+        if ends is None:
+            pos = chunk * self.CHUNK_SIZE
+            lines = self._map[pos:pos + self.CHUNK_SIZE].split(b'\n')
+            lines.pop()
+            ends = array('q', itertools.accumulate(
+                (len(line) + 1 for line in lines), initial=pos))
+            ends.pop(0)
+            ends = self._chunks.setdefault(chunk, ends)
+        return ends
+
+    def _offset(self, index: int) -> int:
+        """
+        Return the start offset of the given line, or the size of the file
+        for the line after the last one.
+        """
+        if index == 0:
+            return 0
+        if index > self._counts[-1]:
+            return self._size
+
+        # The offset is the end of the preceding line.
+        chunk = bisect.bisect_right(self._counts, index - 1) - 1
+        return self._chunk_ends(chunk)[index - 1 - self._counts[chunk]]
+
+    def _lines(self, start: int, stop: int) -> List[str]:
+        if start >= stop:
+            return []
+        self._check()
+        text = self._map[self._offset(start):self._offset(stop)]
+        return _split_text(text.decode(self._encoding))
+
+    def __len__(self) -> int:
+        if self._length is None:
+            return self._count()
+        return self._length
+
+    def __getitem__(self, key):
+        length = len(self)
+        if isinstance(key, slice):
+            start, stop, step = key.indices(length)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return self._lines(start, stop)
+
+        if key < 0:
+            key += length
+        if not 0 <= key < length:
+            raise IndexError("mapped lines index out of range")
+        return self._lines(key, key + 1)[0]
+
+    def iter_range(self, start: int, stop: int) -> Iterator[str]:
+        """
+        Iterate over the lines 'start' up to 'stop', decoding BATCH_LINES
+        lines at a time.
+        """
+        stop = min(stop, len(self))
+        for pos in range(start, stop, self.BATCH_LINES):
+            yield from self._lines(pos, min(pos + self.BATCH_LINES, stop))
+
+    def __iter__(self) -> Iterator[str]:
+        return self.iter_range(0, len(self))
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (list, tuple, BlockView, MappedLines)):
+            return len(self) == len(other) and list(self) == list(other)
+        return NotImplemented
+
+    def __add__(self, other) -> List[str]:
+        return list(self) + list(other)
+
+    def __radd__(self, other) -> List[str]:
+        return list(other) + list(self)
+
+    def __reduce__(self):
+        # Send the content as a single string rather than as separate lines.
+        self._check()
+        text = self._map[:].decode(self._encoding) if self._size else ""
+        return _split_text, (text,)
+
+    def __repr__(self) -> str:
+        return f"MappedLines({len(self)} lines)"
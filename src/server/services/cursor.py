@@ -1,15 +1,20 @@
 import dataclasses
+from typing import Tuple
 
 
 @dataclasses.dataclass
 class Cursor:
+    __slots__ = ('piece_id', 'offset', 'column')
+
     piece_id: str
     offset: int
     column: int
 
-    def _get_fields(self):
-        return [getattr(self, field) for field in self.__annotations__]
+    def as_tuple(self) -> Tuple[str, int, int]:
+        return (self.piece_id, self.offset, self.column)
 
     def __iter__(self):
-        for field in self._get_fields():
-            yield field
+        return iter(self.as_tuple())
+
+    def __reduce__(self):
+        return Cursor, self.as_tuple()
@@ -0,0 +1,170 @@
+from typing import Dict, List, Optional, Tuple, Union
+import os
+
+# A directory tree as sent to the clients: a list of file names and
+# (directory name, directory tree) tuples.
+TreeList = List[Union[str, Tuple[str, 'TreeList']]]
+
+
+class _DirNode:
+    """
+    Directory within the tree, with its subdirectories and files in the
+    order they were added, and a cache of its tree list.
+    """
+    __slots__ = ('parent', 'dirs', 'files', 'cache')
+
+    def __init__(self, parent: Optional['_DirNode'] = None) -> None:
+        self.parent = parent
+        self.dirs: Dict[str, _DirNode] = {}
+        self.files: Dict[str, None] = {}
+        self.cache: Optional[TreeList] = None
+
+    def invalidate(self) -> None:
+        node: Optional[_DirNode] = self
+        while node is not None and node.cache is not None:
+            node.cache = None
+            node = node.parent
+
+
+class DirTree:
+    """
+    In-memory tree of the directories and files within the root directory.
+    It is built once with a single walk over the root directory, after which
+    it is updated for every file which is added, removed or renamed.
+
+    'to_list' returns the tree in the format sent to the clients. The list of
+    every directory is cached until something within it changes, so only the
+    changed directories are rebuilt.
+
+    Paths are relative to the root directory, where paths of directories end
+    with a separator.
+    """
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self._root = _DirNode()
+
+        nodes = {root: self._root}
+        for dir_path, dir_names, file_names in os.walk(root):
+            node = nodes.pop(dir_path)
+            for name in dir_names:
+                node.dirs[name] = nodes[os.path.join(dir_path, name)] = \
+                    _DirNode(node)
+            node.files = dict.fromkeys(file_names)
+
+    @staticmethod
+    def _split(path: str) -> List[str]:
+        return [part for part in path.split(os.sep)
+                if part and part != os.curdir]
+
+    def _find(self, parts: List[str]) -> Optional[_DirNode]:
+        node = self._root
+        for part in parts:
+            node = node.dirs.get(part)
+            if node is None:
+                return None
+        return node
+
+    def _make_dirs(self, parts: List[str]) -> _DirNode:
+        node = self._root
+        for part in parts:
+            if part not in node.dirs:
+                node.dirs[part] = _DirNode(node)
+                node.invalidate()
+            node = node.dirs[part]
+        return node
+
+    def add(self, path: str) -> None:
+        """
+        Add the file or directory at the given path, including its parent
+        directories.
+        """
+        parts = self._split(path)
+        if path.endswith(os.sep):
+            self._make_dirs(parts)
+        elif parts:
+            node = self._make_dirs(parts[:-1])
+            if parts[-1] not in node.files:
+                node.files[parts[-1]] = None
+                node.invalidate()
+
+    def add_walk(self, path: str) -> None:
+        """
+        Add the directory at the given path together with all of its content
+        on disk, after it has been created or moved there.
+        """
+        self.add(path.rstrip(os.sep) + os.sep)
+        abs_path = os.path.join(self.root, path)
+        for dir_path, dir_names, file_names in os.walk(abs_path):
+            rel_path = os.path.relpath(dir_path, self.root)
+            rel_path = '' if rel_path == os.curdir else rel_path
+            for name in dir_names:
+                self.add(os.path.join(rel_path, name) + os.sep)
+            for name in file_names:
+                self.add(os.path.join(rel_path, name))
+
+    def remove(self, path: str) -> None:
+        """
+        Remove the file or directory (with all of its content) at the given
+        path, if present.
+        """
+        parts = self._split(path)
+        if not parts:
+            return
+        node = self._find(parts[:-1])
+        if node is None:
+            return
+
+        name = parts[-1]
+        if name in node.dirs:
+            del node.dirs[name]
+        elif name in node.files and not path.endswith(os.sep):
+            del node.files[name]
+        else:
+            return
+        node.invalidate()
+
+    def rename(self, old_path: str, new_path: str) -> None:
+        """
+        Move the file or directory at 'old_path' to 'new_path'.
+        """
+        old_parts, new_parts = self._split(old_path), self._split(new_path)
+        old_parent = self._find(old_parts[:-1])
+        if old_parent is None or not new_parts:
+            return
+
+        old_name, new_name = old_parts[-1], new_parts[-1]
+        if old_name in old_parent.dirs:
+            moved = old_parent.dirs.pop(old_name)
+            old_parent.invalidate()
+
+            new_parent = self._make_dirs(new_parts[:-1])
+            moved.parent = new_parent
+            new_parent.dirs[new_name] = moved
+            new_parent.invalidate()
+        elif old_name in old_parent.files:
+            del old_parent.files[old_name]
+            old_parent.invalidate()
+            self.add(os.sep.join(new_parts))
+
+    def __contains__(self, path: str) -> bool:
+        parts = self._split(path)
+        if not parts:
+            return True
+        node = self._find(parts[:-1])
+        return node is not None and (parts[-1] in node.dirs
+                                     or parts[-1] in node.files)
+
+    def to_list(self) -> TreeList:
+        """
+        Return the tree as a list of file names and (directory name, tree)
+        tuples, with the directories first.
+        """
+        return self._to_list(self._root)
+
+    def _to_list(self, node: _DirNode) -> TreeList:
+        if node.cache is None:
+            tree: TreeList = [(name, self._to_list(child))
+                              for name, child in node.dirs.items()]
+            tree.extend(node.files)
+            node.cache = tree
+        return node.cache
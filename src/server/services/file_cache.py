@@ -0,0 +1,84 @@
+from collections import OrderedDict
+from typing import Optional, Tuple
+import os
+from .journal import Journal
+from .server_file import ServerFile
+
+
+class FileCache:
+    """
+    Least recently used cache of saved files which are no longer joined by
+    any client, so they do not have to be read from disk again when they are
+    joined shortly after.
+
+    At most 'max_files' files are kept, using at most 'max_bytes' bytes of
+    memory (see PieceTable.memory_usage). A cached file is only reused when
+    the size and modification time of the file on disk have not changed
+    since it was cached.
+    """
+    def __init__(self, max_files: int, max_bytes: int) -> None:
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._files: 'OrderedDict[str, Tuple[ServerFile, Tuple[int, int], int]]'
+        self._files = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def __contains__(self, path: str) -> bool:
+        return path in self._files
+
+    def put(self, path: str, file: ServerFile) -> None:
+        """
+        Add a closed file to the cache, evicting the least recently used
+        files if the cache is full. Files with unsaved changes are not cached.
+        """
+        self.discard(path)
+        if not file.is_saved:
+            return
+
+        usage = file.pt.memory_usage()
+        size = usage["table_bytes"] + usage["block_bytes"]
+        if size > self.max_bytes:
+            return
+
+        try:
+            state = Journal.disk_state(os.path.join(file.root, path))
+        except OSError:
+            return
+
+        self._files[path] = (file, state, size)
+        self.size += size
+
+        while len(self._files) > self.max_files or self.size > self.max_bytes:
+            _, (_, _, evicted_size) = self._files.popitem(last=False)
+            self.size -= evicted_size
+
+    def take(self, path: str) -> Optional[ServerFile]:
+        """
+        Remove the file from the cache and return it, if it is cached and
+        has not changed on disk since.
+        """
+        if path not in self._files:
+            return None
+
+        file, state, size = self._files.pop(path)
+        self.size -= size
+
+        try:
+            if Journal.disk_state(os.path.join(file.root, path)) != state:
+                return None
+        except OSError:
+            return None
+        return file
+
+    def discard(self, path: str) -> None:
+        """
+        Remove the file, or all files within the directory, from the cache.
+        """
+        prefix = path.rstrip(os.sep) + os.sep
+        for cached in [p for p in self._files
+                       if p == path or p.startswith(prefix)]:
+            _, _, size = self._files.pop(cached)
+            self.size -= size
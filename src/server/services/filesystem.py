@@ -1,11 +1,25 @@
+from .archive import (COMPRESSION_MODES, ArchiveCache, ChunkedUpload,
+                      build_archive, iter_file_chunks, iter_tar_chunks,
+                      tree_hash)
+from .dir_tree import DirTree
+from .file_cache import FileCache
+from .line_store import LineStore
+from .piece_table import PieceTable
 from .server_file import ServerFile
-from .typedefs import Address, LockError
+from .typedefs import Address, LockError, VersionError
+from .watcher import Event, create_watcher
 from .service import Service, message_type
-from typing import Dict, List
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from contextlib import AsyncExitStack
+from functools import partial
+import asyncio
 import base64
 import tarfile
+import time
 import os
 import shutil
+import uuid
+import weakref
 import Pyro4
 
 # TODO: dit is vast lelijk
@@ -17,6 +31,84 @@ ERROR_FILE_ILLEGAL_LOCK = 5
 ERROR_NOT_LOCKED = 6
 ERROR_ILLEGAL_PIECE_ID = 7
 ERROR_FILE_NOT_SAVED = 8
+ERROR_OUTDATED_VERSION = 9
+
+# Piece table storage options, see PieceTable.
+USE_PIECE_TREE = True
+USE_ADD_BUFFER = True
+
+# Files of at least this size (in bytes) are memory mapped instead of read
+# into memory, see ServerFile.
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+# Whether the lines of all files are interned in a shared LineStore.
+USE_LINE_STORE = True
+
+# Files are defragmented (see PieceTable.defragment) once this many unlocked
+# pieces can be merged, or when they have some and have not been changed
+# for DEFRAG_IDLE_TIME seconds. Checked every DEFRAG_INTERVAL seconds.
+DEFRAG_THRESHOLD = 64
+DEFRAG_IDLE_TIME = 30
+DEFRAG_INTERVAL = 5
+
+# Whether edits are recorded in a journal (see Journal) until they are saved,
+# and the interval in seconds at which the journals are synced to disk.
+USE_JOURNAL = True
+JOURNAL_SYNC_INTERVAL = 0.05
+
+# Whether files with unsaved edits are saved automatically. A file is saved
+# once it has not been edited for AUTOSAVE_QUIET_TIME seconds, or at most
+# AUTOSAVE_MAX_DELAY seconds after its first unsaved edit. Autosaves write at
+# most AUTOSAVE_BANDWIDTH characters per second on average, and are checked
+# every AUTOSAVE_INTERVAL seconds.
+AUTOSAVE = True
+AUTOSAVE_QUIET_TIME = 2
+AUTOSAVE_MAX_DELAY = 30
+AUTOSAVE_BANDWIDTH = 4 * 1024 * 1024
+AUTOSAVE_INTERVAL = 0.5
+
+# Maximum number of closed files kept in memory, and their maximum total size
+# in bytes, see FileCache.
+FILE_CACHE_FILES = 32
+FILE_CACHE_BYTES = 256 * 1024 * 1024
+
+# Whether changes made to the root directory by other programs are picked up
+# (see create_watcher), and the interval in seconds at which this is checked.
+WATCH_FILES = True
+WATCH_INTERVAL = 1
+
+# Streamed project downloads are sent in chunks of at most
+# PROJECT_CHUNK_SIZE bytes (before base64 encoding). At most
+# PROJECT_CHUNK_WINDOW chunks are sent ahead of the last chunk acknowledged
+# by the client, and a download is aborted when the client has not
+# acknowledged a chunk for PROJECT_CHUNK_TIMEOUT seconds.
+PROJECT_CHUNK_SIZE = 256 * 1024
+PROJECT_CHUNK_WINDOW = 8
+PROJECT_CHUNK_TIMEOUT = 60
+
+# Temporary files of chunked uploads are kept in UPLOAD_DIR, so an upload can
+# be resumed after the connection or the server was lost. Uploads without a
+# chunk for UPLOAD_EXPIRY seconds are discarded, which is checked every
+# UPLOAD_EXPIRY_INTERVAL seconds. At most MAX_UPLOADS uploads can be in
+# progress at the same time.
+UPLOAD_DIR = 'file_upload'
+UPLOAD_EXPIRY = 24 * 60 * 60
+UPLOAD_EXPIRY_INTERVAL = 10 * 60
+MAX_UPLOADS = 16
+
+# Compressed project archives are built on the process pool of the service,
+# and the ARCHIVE_CACHE_SIZE most recently downloaded ones are kept in
+# ARCHIVE_DIR.
+ARCHIVE_DIR = 'file_archive'
+ARCHIVE_CACHE_SIZE = 4
+
+
+def file_key(content) -> str:
+    """
+    Key of the messages about a single file, so messages about different
+    files are handled concurrently (see message_type).
+    """
+    return content["file_path"]
 
 
 @Pyro4.expose
@@ -52,87 +144,420 @@ class Filesystem(Service):
         self.root_dir: str = os.path.realpath('file_root')
         if not os.path.exists(self.root_dir):
             os.makedirs(self.root_dir, exist_ok=True)
-        files: Dict[str, ServerFile] = {}
+        self.files: Dict[str, ServerFile] = {}
+        self.file_cache = FileCache(FILE_CACHE_FILES, FILE_CACHE_BYTES)
+        self.dir_tree = DirTree(self.root_dir)
+        if WATCH_FILES:
+            self.watcher = create_watcher(self.root_dir)
+            asyncio.run_coroutine_threadsafe(self._watch_loop(), self._loop)
+        self.line_store: Optional[LineStore] = (LineStore() if USE_LINE_STORE
+                                                else None)
+
+        # Last seen table version of every file, and the time it was seen.
+        self._file_versions: Dict[str, Tuple[int, float]] = {}
+        self._save_locks: 'weakref.WeakKeyDictionary[ServerFile, asyncio.Lock]'
+        self._save_locks = weakref.WeakKeyDictionary()
+
+        self.journal_dir: Optional[str] = None
+        if USE_JOURNAL:
+            self.journal_dir = os.path.realpath('file_journal')
+            os.makedirs(self.journal_dir, exist_ok=True)
+            asyncio.run_coroutine_threadsafe(self._journal_sync_loop(),
+                                             self._loop)
+
+        # Edit count, time of the first unsaved edit and time of the last
+        # edit of every unsaved file, and the time autosaving may resume.
+        self._dirty_files: Dict[str, Tuple[int, float, float]] = {}
+        self._autosave_resume = 0.0
+        if AUTOSAVE:
+            asyncio.run_coroutine_threadsafe(self._autosave_loop(),
+                                             self._loop)
+        asyncio.run_coroutine_threadsafe(self._defragment_loop(), self._loop)
+
+        # Last acknowledged chunk of every streamed download, and an event
+        # set whenever a chunk of it is acknowledged.
+        self._download_acks: Dict[str, int] = {}
+        self._download_events: Dict[str, asyncio.Event] = {}
+
+        # Chunked uploads in progress and the time of their last chunk.
+        self.upload_dir = os.path.realpath(UPLOAD_DIR)
+        os.makedirs(self.upload_dir, exist_ok=True)
+        self._uploads: Dict[str, Tuple[ChunkedUpload, float]] = {}
+        asyncio.run_coroutine_threadsafe(self._expire_uploads_loop(),
+                                         self._loop)
+
+        # Cache of compressed project archives and the builds in progress.
+        self.archive_cache = ArchiveCache(os.path.realpath(ARCHIVE_DIR),
+                                          ARCHIVE_CACHE_SIZE)
+        self._archive_builds: Dict[Tuple[str, str], asyncio.Future] = {}
 
     #
     # FILE I/O
     #
 
-    def load_file(self, file_path: str) -> None:
+    async def load_file(self, file_path: str) -> None:
         """
         Add the file to the Filesystem. Path file is relative to root
-        directory.
+        directory. Recently closed files are taken from the file cache,
+        other files are read from disk on the thread pool.
         """
-        if file_path not in self.files:
-            self.files[file_path] = ServerFile(self.root_dir, file_path)
+        if file_path in self.files:
+            return
 
-    def parse_walk(self, walk, path):
+        file = self.file_cache.take(file_path)
+        if file is not None:
+            # Let a save of the file finish restarting the journal first.
+            async with self._save_lock(file):
+                file.reopen()
+        else:
+            file = await self._run_in_pool(
+                partial(ServerFile, self.root_dir, file_path,
+                        tree=USE_PIECE_TREE,
+                        add_buffer=USE_ADD_BUFFER,
+                        mmap_threshold=MMAP_THRESHOLD,
+                        line_store=self.line_store,
+                        journal_dir=self.journal_dir))
+        self.files[file_path] = file
+
+    @message_type("file-save", key=file_key)
+    async def _save_file_to_disk(self, msg):
         """
-        Creates directory tree of the root directory.
+        Saves a snapshot of the file to disk. The file is written on a worker
+        thread outside of the handler lock, so other messages are handled
+        during the save. Afterwards, broadcasts that the file was saved.
         """
-        dir_tup = [t for t in walk if t[0] == path][0]
-        walk.remove(dir_tup)
-        tree = []
-
-        for dir_name in dir_tup[1]:
-            tree.append((dir_name,
-                         self.parse_walk(walk, os.path.join(path, dir_name))))
-        for file_name in dir_tup[2]:
-            tree.append(file_name)
-
-        return tree
-
-    @message_type("file-save")
-    async def _save_file_to_disk(self, msg):
         file_path = msg["content"]["file_path"]
-        username = msg["sender"][1]
+        address, username = msg["sender"]
 
         file = self.files[file_path]
-        lines = file.save_to_disk()  # noqa
+        snapshot = file.pt.snapshot()
+        edit_count = file.edit_count
+
+        asyncio.ensure_future(self._save_and_broadcast(file_path, file,
+                                                       snapshot, edit_count,
+                                                       address, username))
+
+    async def _save_and_broadcast(self, file_path: str, file: ServerFile,
+                                  snapshot: PieceTable, edit_count: int,
+                                  address: Address, username: str) -> None:
+        """
+        Writes the snapshot of the file, and broadcasts the save to the
+        clients in the file, or sends an error to the client on failure.
+        """
+        try:
+            written = await self._write_snapshot(file, snapshot, edit_count)
+        except OSError as e:
+            message = f"Saving {file_path} has failed: {e}"
+            self._send_message_client("error-response",
+                                      {"message": message,
+                                       "error_code": ERROR_FILE_NOT_SAVED},
+                                      address)
+            return
+        if written is None:
+            return
 
         self._send_message_client("file-save-broadcast",
                                   {
-                                      "file_path": file_path,
+                                      "file_path": file.path_relative,
                                       "username": username
                                   },
                                   *file.get_clients())
 
+    def _save_lock(self, file: ServerFile) -> asyncio.Lock:
+        """
+        Returns the lock held while the file is written to disk.
+        """
+        if file not in self._save_locks:
+            self._save_locks[file] = asyncio.Lock()
+        return self._save_locks[file]
+
+    async def _write_snapshot(self, file: ServerFile, snapshot: PieceTable,
+                              edit_count: int,
+                              skip_unchanged: bool = False) -> Optional[int]:
+        """
+        Writes the snapshot of the file on a worker thread, and marks the
+        file as saved. Saves of the same file are written one at a time, in
+        the order they were requested. Returns the number of characters
+        written, see ServerFile.write_snapshot, or None if the file has been
+        removed in the meantime.
+
+        The path is only looked up once the save lock is held, which renames
+        and removals hold while they change the file on disk, so a file is
+        always written to its current path.
+        """
+        async with self._save_lock(file):
+            if file.is_removed:
+                return None
+            written = await self._run_in_pool(
+                file.write_snapshot, snapshot, file.path_relative,
+                skip_unchanged)
+            await self._run_in_pool(file.checkpoint_journal, edit_count)
+
+        file.mark_saved(edit_count)
+        return written
+
     @message_type("file-project-request")
     async def _send_files_as_tar(self, msg):
         """
         Sends the complete root directory currently on disk to the requesting
-        client. The files are encoded in base64 as a tar file.
+        client. The files are encoded in base64 as a tar file, optionally
+        compressed with the "compression" method of the request ("gz" or
+        "xz"). Compressed archives are cached (see _project_chunks).
+
+        When the request content has "chunked" set, the archive is streamed
+        instead (see _stream_project): the client is sent a
+        file-project-start message with the download id, followed by
+        file-project-chunk messages as the archive is being built.
         """
         addr = msg["sender"][0]
+        content = msg["content"] or {}
+        compression = content.get("compression")
 
-        with tarfile.open(".project.tar", "w|") as tar:
-            tar.add(self.root_dir, arcname=os.path.basename(self.root_dir))
-        with open(".project.tar", 'rb') as f:
-            b64_string = base64.b64encode(f.read()).decode('utf-8')
+        if compression not in COMPRESSION_MODES:
+            self._send_message_client("file-project-response",
+                                      {
+                                          "error": "Unknown compression "
+                                                   f"{compression}."
+                                      },
+                                      addr)
+            return
+
+        if content.get("chunked"):
+            download_id = str(uuid.uuid4())
+            self._download_acks[download_id] = -1
+            self._download_events[download_id] = asyncio.Event()
+            self._send_message_client("file-project-start",
+                                      {
+                                          "download_id": download_id,
+                                          "window": PROJECT_CHUNK_WINDOW,
+                                          "compression": compression
+                                      },
+                                      addr)
+            self._loop.create_task(self._stream_project(download_id, addr,
+                                                        compression))
+            return
+
+        try:
+            chunks = await self._project_chunks(compression)
+            data = await self._run_in_pool(b"".join, chunks)
+        except (OSError, tarfile.TarError) as e:
+            self._error(f"Building the project archive has failed: {e}")
+            self._send_message_client("file-project-response",
+                                      {"error": str(e)},
+                                      addr)
+            return
+        b64_string = base64.b64encode(data).decode('utf-8')
 
         self._send_message_client("file-project-response",
-                                  {"data": b64_string},
+                                  {
+                                      "data": b64_string,
+                                      "compression": compression
+                                  },
                                   addr)
 
-        os.remove(".project.tar")
+    async def _project_chunks(self,
+                              compression: Optional[str]) -> Iterator[bytes]:
+        """
+        Returns an iterator over the chunks of a tar archive of the root
+        directory. Uncompressed archives are built while they are read.
+
+        Compressed archives are built in a process pool and cached by the
+        hash of the tree (see archive.tree_hash), so repeated downloads of an
+        unchanged project are served from the cache without reading the
+        files. Concurrent requests for the same archive share a single build.
+        """
+        if compression is None:
+            return iter_tar_chunks(self.root_dir,
+                                   os.path.basename(self.root_dir),
+                                   PROJECT_CHUNK_SIZE,
+                                   start=self._start_streaming)
+
+        key = await self._run_in_pool(tree_hash, self.root_dir)
+        file = self.archive_cache.open(key, compression)
+        if file is None:
+            build = self._archive_builds.get((key, compression))
+            if build is None:
+                build = asyncio.ensure_future(self._run_in_pool(
+                    build_archive, self.root_dir,
+                    os.path.basename(self.root_dir),
+                    self.archive_cache.archive_path(key, compression),
+                    compression, pool="process"))
+                self._archive_builds[(key, compression)] = build
+                try:
+                    await build
+                finally:
+                    del self._archive_builds[(key, compression)]
+                await self._run_in_pool(self.archive_cache.evict)
+            else:
+                await build
+
+            file = self.archive_cache.open(key, compression)
+            if file is None:
+                raise OSError("The project archive was removed from the "
+                              "cache before it could be sent.")
+        return iter_file_chunks(file, PROJECT_CHUNK_SIZE)
+
+    async def _stream_project(self, download_id: str, addr: Address,
+                              compression: Optional[str]) -> None:
+        """
+        Sends the root directory to the client as a tar file in sequenced
+        file-project-chunk messages of the form:
+            {"download_id": <id>, "seq": <chunk number>,
+             "data": <base64 data>, "last": <whether this is the last chunk>}
+        The archive is built on a worker thread while it is sent, and waits
+        for the client to acknowledge the chunks with
+        file-project-chunk-ack messages, so only a bounded part of it is
+        held in memory. The final chunk is empty.
+
+        Runs outside of the message handlers, so other messages are handled
+        in the meantime.
+        """
+        chunks: Iterator[bytes] = iter(())
+        event = self._download_events[download_id]
+        seq = 0
+        try:
+            chunks = await self._project_chunks(compression)
+            while True:
+                while seq - self._download_acks[download_id] \
+                        > PROJECT_CHUNK_WINDOW:
+                    event.clear()
+                    await asyncio.wait_for(event.wait(),
+                                           PROJECT_CHUNK_TIMEOUT)
+
+                chunk = await self._run_in_pool(next, chunks, None)
+                self._send_message_client("file-project-chunk",
+                                          {
+                                              "download_id": download_id,
+                                              "seq": seq,
+                                              "data": base64.b64encode(
+                                                  chunk or b"").decode(),
+                                              "last": chunk is None
+                                          },
+                                          addr)
+                if chunk is None:
+                    break
+                seq += 1
+        except asyncio.TimeoutError:
+            self._error(f"Download {download_id} timed out at chunk {seq}.")
+        except (OSError, tarfile.TarError) as e:
+            self._error(f"Download {download_id} has failed: {e}")
+            self._send_message_client("file-project-chunk",
+                                      {
+                                          "download_id": download_id,
+                                          "seq": seq,
+                                          "error": str(e),
+                                          "last": True
+                                      },
+                                      addr)
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            del self._download_acks[download_id]
+            del self._download_events[download_id]
+
+    @message_type("file-project-chunk-ack",
+                  key=lambda content: content["download_id"])
+    async def _ack_project_chunk(self, msg) -> None:
+        """
+        Registers that the client has received the project chunks up to and
+        including the given sequence number, allowing more chunks to be sent.
+        """
+        content = msg["content"]
+        download_id = content["download_id"]
+        if download_id not in self._download_acks:
+            return
+
+        self._download_acks[download_id] = max(
+            self._download_acks[download_id], content["seq"])
+        self._download_events[download_id].set()
 
     @message_type("file-folder-upload")
     async def _upload_folder_as_tar(self, msg):
         """
         Creates a folder with content based on a given base64 byte stream
         """
-        b64_string = msg["content"]["data"]
-        data_bytes = base64.b64decode(b64_string)
+        data_bytes = base64.b64decode(msg["content"]["data"])
 
-        with open(".project.tar", "wb") as f:
-            f.write(data_bytes)
-        with tarfile.open(".project.tar", "r|") as tar:
-            tar.extractall(path=self.root_dir)
+        upload_id = str(uuid.uuid4())
+        upload = self._open_upload(upload_id)
+        await self._run_in_pool(upload.write, 0, data_bytes)
+        await self._finish_upload(upload_id)
 
-        os.remove(".project.tar")
+    def _start_streaming(self, fn: Callable[[], None]) -> None:
+        """
+        Starts building an archive while it is being transferred, on the
+        stream pool (see archive.start_thread).
+        """
+        self._loop.create_task(self._run_in_pool(fn, pool="stream"))
+
+    def _upload_path(self, upload_id: str) -> str:
+        return os.path.join(self.upload_dir,
+                            os.path.basename(upload_id) + '.tar')
+
+    def _open_upload(self, upload_id: str) -> ChunkedUpload:
+        """
+        Starts or resumes the upload with the given id, extracting into the
+        root directory.
+        """
+        def on_entry(path: str) -> None:
+            self._loop.call_soon_threadsafe(self._add_uploaded_entry, path)
+
+        upload = ChunkedUpload(self._upload_path(upload_id), self.root_dir,
+                               on_entry)
+        self._uploads[upload_id] = (upload, time.monotonic())
+        return upload
 
-        root_tree = self.parse_walk(list(os.walk(self.root_dir)),
-                                    self.root_dir)
+    def _add_uploaded_entry(self, path: str) -> None:
+        self.file_cache.discard(path)
+        self.dir_tree.add(path)
+
+    async def _expire_uploads_loop(self) -> None:
+        """
+        Periodically discards the uploads which have expired.
+        """
+        while True:
+            await asyncio.sleep(UPLOAD_EXPIRY_INTERVAL)
+            try:
+                self._expire_uploads()
+            except Exception as e:
+                self._error(f"Expiring the uploads has failed: {e}")
+
+    def _expire_uploads(self) -> None:
+        """
+        Discards the uploads which have not received a chunk for
+        UPLOAD_EXPIRY seconds, including their temporary files left behind
+        by an earlier run of the server.
+        """
+        now = time.monotonic()
+        for upload_id, (upload, last_chunk) in list(self._uploads.items()):
+            if now - last_chunk > UPLOAD_EXPIRY:
+                del self._uploads[upload_id]
+                upload.abort()
+
+        active = {upload.path for upload, _ in self._uploads.values()}
+        for name in os.listdir(self.upload_dir):
+            path = os.path.join(self.upload_dir, name)
+            try:
+                expired = time.time() - os.path.getmtime(path) > UPLOAD_EXPIRY
+            except OSError:
+                continue
+            if path not in active and expired:
+                os.remove(path)
+
+    async def _finish_upload(self, upload_id: str) -> Optional[str]:
+        """
+        Extracts the upload on the stream pool, and broadcasts the new file
+        list. Returns the error, if any.
+        """
+        upload, _ = self._uploads.pop(upload_id)
+        try:
+            await self._run_in_pool(upload.finish, pool="stream")
+            error = None
+        except (OSError, tarfile.TarError) as e:
+            self._error(f"Upload {upload_id} has failed: {e}")
+            error = str(e)
+
+        root_tree = self.dir_tree.to_list()
 
         c_msg = self._send_message("client-list-request", {})
         resp = await self._wait_for_response(c_msg["uuid"])
@@ -142,6 +567,96 @@ class Filesystem(Service):
                                       "root_tree": root_tree
                                   },
                                   *resp["content"]["client_list"])
+        return error
+
+    @message_type("file-upload-start")
+    async def _start_upload(self, msg) -> None:
+        """
+        Starts a chunked upload of a tar file, which is extracted into the
+        root directory while it is being uploaded. An upload is resumed by
+        passing its "upload_id". Responds with a file-upload-status message
+        containing the upload id and the offset of the next chunk to send, or
+        an error when MAX_UPLOADS uploads are already in progress.
+        """
+        address = msg["sender"][0]
+        upload_id = msg["content"].get("upload_id") or str(uuid.uuid4())
+
+        if upload_id in self._uploads:
+            upload, _ = self._uploads[upload_id]
+        elif len(self._uploads) >= MAX_UPLOADS:
+            self._send_message_client("file-upload-status",
+                                      {
+                                          "upload_id": upload_id,
+                                          "error": "Too many uploads."
+                                      },
+                                      address)
+            return
+        else:
+            upload = self._open_upload(upload_id)
+
+        self._send_message_client("file-upload-status",
+                                  {
+                                      "upload_id": upload_id,
+                                      "offset": upload.offset
+                                  },
+                                  address)
+
+    @message_type("file-upload-chunk",
+                  key=lambda content: content["upload_id"])
+    async def _upload_chunk(self, msg) -> None:
+        """
+        Appends a base64 encoded chunk to an upload, at the given "offset".
+        Responds with a file-upload-status message containing the offset of
+        the next chunk, which differs from the expected offset when a chunk
+        was lost and has to be sent again. When "last" is set, the upload is
+        finished once the extraction has completed, and a file-upload-done
+        message is sent.
+        """
+        address = msg["sender"][0]
+        content = msg["content"]
+        upload_id = content["upload_id"]
+
+        if upload_id not in self._uploads:
+            if not os.path.exists(self._upload_path(upload_id)):
+                error = "Unknown upload."
+            elif len(self._uploads) >= MAX_UPLOADS:
+                error = "Too many uploads."
+            else:
+                error = None
+
+            if error is not None:
+                self._send_message_client("file-upload-status",
+                                          {
+                                              "upload_id": upload_id,
+                                              "error": error
+                                          },
+                                          address)
+                return
+            self._open_upload(upload_id)
+
+        upload, _ = self._uploads[upload_id]
+        data = base64.b64decode(content["data"])
+        offset = await self._run_in_pool(upload.write, content["offset"],
+                                         data)
+        self._uploads[upload_id] = (upload, time.monotonic())
+
+        if not content.get("last") or offset != content["offset"] + len(data):
+            self._send_message_client("file-upload-status",
+                                      {
+                                          "upload_id": upload_id,
+                                          "offset": offset
+                                      },
+                                      address)
+            return
+
+        error = await self._finish_upload(upload_id)
+        self._send_message_client("file-upload-done",
+                                  {
+                                      "upload_id": upload_id,
+                                      "success": error is None,
+                                      "error": error
+                                  },
+                                  address)
 
     #
     # CLIENTS JOIN/LEAVE
@@ -213,8 +728,7 @@ class Filesystem(Service):
             return
 
         # Add the file to RAM if necessary.
-        if path not in self.files:
-            self.files[path] = ServerFile(self.root_dir, path)
+        await self.load_file(path)
 
         # Add the file to the client list in the ServerFile class.
         self.files[path].client_join(username)
@@ -269,20 +783,26 @@ class Filesystem(Service):
                      if f.is_joined(username)]
 
         for path in to_unlock:
-            self._file_remove_client(address, username, path, True)
+            self._file_remove_client(address, username, path, True,
+                                     keep_journal=True)
 
     def _file_remove_client(self, addr: Address, username: str,
-                            path: str, force: bool) -> None:
+                            path: str, force: bool,
+                            keep_journal: bool = False) -> None:
         """
         Removes the specified client from the specified file, removing all
         locks in the process.
 
         Because of this, the piece table of the file is updated as well as the
         cursor positions. These changes are broadcasted to the other clients.
+
+        When the last client leaves, the file is removed from RAM. Unsaved
+        changes of a forced leave are discarded, unless 'keep_journal' is set,
+        in which case they are recovered from the journal on the next join.
         """
         file = self.files[path]
 
-        file.client_leave(username)
+        changed = file.client_leave(username)
 
         # Broadcast the change and remove the username
         self._send_message_client("file-leave-broadcast",
@@ -290,18 +810,20 @@ class Filesystem(Service):
                                    "file_path": path},
                                   *file.get_clients(exclude=[username]))
 
-        self._update_and_broadcast_piece_table(path, update_orig=True)
+        self._update_and_broadcast_piece_table(path, changed)
         self._broadcast_file_cursors(path)
 
         # Remove the file from RAM if necessary.
         if file.client_count() == 0:
+            file.close(discard=force and not keep_journal)
             del self.files[path]
+            self.file_cache.put(path, file)
 
     #
     # CONTENT REQUEST
     #
 
-    @message_type("file-content-request")
+    @message_type("file-content-request", key=file_key)
     async def _process_file_content_request(self, msg) -> None:
         """
         Constructs and sends the file content message to the requesting client,
@@ -380,7 +902,7 @@ class Filesystem(Service):
     # CURSORS
     #
 
-    @message_type("cursor-move")
+    @message_type("cursor-move", key=file_key)
     async def _move_cursor(self, msg) -> None:
         """
         Moves the client that has send the message to the specified location
@@ -429,7 +951,7 @@ class Filesystem(Service):
                                   {"cursor_list": cursors},
                                   *usernames)
 
-    @message_type("cursor-list-request")
+    @message_type("cursor-list-request", key=file_key)
     async def _clist_request_handler(self, msg) -> None:
         """
         Sends the cursor list to the requesting client.
@@ -465,36 +987,67 @@ class Filesystem(Service):
     # EDITS
     #
 
-    @message_type("file-delta")
+    @message_type("file-delta", key=file_key)
     async def _edit_block(self, msg) -> None:
         """
-        Replaces a line in the given block of the piecetable with the new
+        Replaces the content of the given block of the piecetable with the new
         provided content.
+
+        Instead of the full 'content', the message may contain a 'patch': a
+        list of [start, end, content] operations replacing line ranges of the
+        block, together with the 'version' of the block the patch is based
+        on. Only the patch is broadcast to the other clients in that case.
         """
         content = msg["content"]
         address, username = msg["sender"]
 
         file_path = content["file_path"]
-        piece_uuid = content["piece_uuid"]
-        block_content = content["content"]
+
+        if not self.check_valid(address, username, file_path):
+            return
+
+        try:
+            piece_uuid = content["piece_uuid"]
+            if "patch" in content:
+                args = (content["version"], content["patch"])
+            else:
+                args = (content["content"],)
+        except KeyError as e:
+            self._send_message_client("error-response",
+                                      {"message": f"Missing field {e}.",
+                                       "error_code": ERROR_WRONG_MESSAGE},
+                                      address)
+            return
 
         file = self.files[file_path]
 
         try:
-            file.update_content(username, piece_uuid, block_content)
-        except LockError:
-            message = "Illegal edit, this lock does not belong to you."
+            if "patch" in content:
+                version = file.patch_content(username, piece_uuid, *args)
+            else:
+                version = file.update_content(username, piece_uuid, *args)
+        except (LockError, VersionError) as e:
+            if isinstance(e, LockError):
+                message = "Illegal edit, this lock does not belong to you."
+                error_code = ERROR_NOT_LOCKED
+            else:
+                message = "Edit is based on an outdated version of the block."
+                error_code = ERROR_OUTDATED_VERSION
+
             self._send_message_client("error-response",
                                       {"message": message,
-                                       "error_code": ERROR_NOT_LOCKED},
+                                       "error_code": error_code},
                                       address)
 
+            # Resend the current content, so the client can recover.
+            piece = file.pt.get_piece(piece_uuid)
             block_lines = file.pt.get_piece_content(piece_uuid)
             block_content = "".join(block_lines)
 
             resp_content = {
                         "file_path": file_path,
                         "piece_uuid": piece_uuid,
+                        "version": file.pt.get_block_version(piece.block_id),
                         "content": block_content
                     }
             self._send_message_client("file-delta-broadcast",
@@ -507,9 +1060,14 @@ class Filesystem(Service):
                                       address)
             return
 
+        broadcast = {key: content[key] for key in
+                     ("file_path", "piece_uuid", "patch", "content")
+                     if key in content}
+        broadcast["version"] = version
+
         self._send_message_client("file-delta-broadcast",
-                                  content,
-                                  *file.get_clients(exclude=[address]))
+                                  broadcast,
+                                  *file.get_clients(exclude=[username]))
 
     #
     # FILES
@@ -525,6 +1083,15 @@ class Filesystem(Service):
         # if it existed.
         return f"{os.path.dirname(path)}{os.sep}" == path
 
+    def _files_within(self, path: str) -> List[ServerFile]:
+        """
+        Returns the files in memory at the given path, or within the
+        directory at the given path.
+        """
+        prefix = path.rstrip(os.sep) + os.sep
+        return [file for p, file in self.files.items()
+                if p == path or p.startswith(prefix)]
+
     def _rename_file(self, old_path: str, new_path: str) -> None:
         """
         Renames the file or directory 'old_path' to 'new_path', both paths
@@ -537,6 +1104,12 @@ class Filesystem(Service):
         os.makedirs(os.path.dirname(new_abs), exist_ok=True)
         os.rename(old_abs, new_abs)
 
+        # A rename keeps the size and modification time of the files.
+        self.file_cache.discard(old_path)
+        self.file_cache.discard(new_path)
+
+        self.dir_tree.rename(old_path, new_path)
+
         # Update the file paths within memory.
         if self._isdir(old_path):
             files_new = {}
@@ -545,7 +1118,7 @@ class Filesystem(Service):
                     p_new = p.replace(old_path, new_path, 1)
 
                     self.files[p].change_file_path(p_new)
-                    self.files[p_new] = self.files[p]
+                    files_new[p_new] = self.files[p]
                 else:
                     files_new[p] = self.files[p]
 
@@ -561,6 +1134,8 @@ class Filesystem(Service):
         Removes the specified file from disk, and updates the ServerFile dict.
         """
         old_abs = os.path.join(self.root_dir, old_path)
+        self.file_cache.discard(old_path)
+        self.dir_tree.remove(old_path)
 
         if self._isdir(old_path):
             shutil.rmtree(old_abs)
@@ -569,11 +1144,16 @@ class Filesystem(Service):
             for p in self.files:
                 if not p.startswith(old_path):
                     files_new[p] = self.files[p]
+                else:
+                    self.files[p].is_removed = True
+                    self.files[p].close(discard=True)
             self.files = files_new
         else:
             os.remove(old_abs)
 
             if old_path in self.files.keys():
+                self.files[old_path].is_removed = True
+                self.files[old_path].close(discard=True)
                 del self.files[old_path]
 
     def _add_file(self, new_path: str, file_content: str) -> None:
@@ -582,6 +1162,7 @@ class Filesystem(Service):
         given file contents.
         """
         new_abs = os.path.join(self.root_dir, new_path)
+        self.file_cache.discard(new_path)
 
         os.makedirs(os.path.dirname(new_abs), exist_ok=True)
 
@@ -589,6 +1170,8 @@ class Filesystem(Service):
             with open(new_abs, 'w') as f:
                 f.write(file_content)
 
+        self.dir_tree.add(new_path)
+
     @message_type("file-change")
     async def _change_file(self, msg):
         """
@@ -600,15 +1183,19 @@ class Filesystem(Service):
         old_path = content["old_path"]
         new_path = content["new_path"]
 
-        if new_path and old_path:
-            self._rename_file(old_path, new_path)
-        elif old_path:
-            self._remove_file(old_path)
-        elif new_path:
-            self._add_file(new_path, content["file_content"])
+        # Wait for saves in progress of the files involved, and keep new
+        # saves from starting until the files have their new path.
+        async with AsyncExitStack() as stack:
+            if old_path:
+                for file in self._files_within(old_path):
+                    await stack.enter_async_context(self._save_lock(file))
 
-        self.root_tree = self.parse_walk(list(os.walk(self.root_dir)),
-                                         self.root_dir)
+            if new_path and old_path:
+                self._rename_file(old_path, new_path)
+            elif old_path:
+                self._remove_file(old_path)
+            elif new_path:
+                self._add_file(new_path, content["file_content"])
 
         c_msg = self._send_message("client-list-request", {})
         resp = await self._wait_for_response(c_msg["uuid"])
@@ -623,17 +1210,14 @@ class Filesystem(Service):
         """
         address = msg["sender"][0]
 
-        root_tree = self.parse_walk(list(os.walk(self.root_dir)),
-                                    self.root_dir)
-
-        net_msg = {"root_tree": root_tree}
+        net_msg = {"root_tree": self.dir_tree.to_list()}
         self._send_message_client("file-list-response", net_msg, address)
 
     #
     # LOCKS
     #
 
-    @message_type("file-lock-request")
+    @message_type("file-lock-request", key=file_key)
     async def _file_add_lock(self, msg) -> None:
         """
         If possible, creates a lock in the specified file for the client,
@@ -677,7 +1261,7 @@ class Filesystem(Service):
         self._update_and_broadcast_piece_table(path, [lock_id])
         self._broadcast_file_cursors(path)
 
-    @message_type("file-lock-insert-request")
+    @message_type("file-lock-insert-request", key=file_key)
     async def _file_insert_lock(self, msg) -> None:
         """
         Insert a new lock after the given piece_uuid, or at the beginning of
@@ -700,7 +1284,7 @@ class Filesystem(Service):
                                           "error_code": ERROR_FILE_ILLEGAL_LOCK
                                       }, address)
 
-    @message_type("file-unlock-request")
+    @message_type("file-unlock-request", key=file_key)
     async def _file_remove_lock(self, msg) -> None:
         """
         Remove the client's lock from the specified file, and broadcasts
@@ -715,13 +1299,70 @@ class Filesystem(Service):
         if not self.check_valid(address, username, path):
             return
 
+        changed: List[str] = []
         try:
-            self.files[path].remove_lock(lock_id)
+            changed = self.files[path].remove_lock(lock_id)
         except ValueError:
             self._error("Cursor repositioning has failed, possible table "
                         "divergence at the client side.")
 
-        self._update_and_broadcast_piece_table(path, update_orig=True)
+        self._update_and_broadcast_piece_table(path, changed)
+        self._broadcast_file_cursors(path)
+
+    @message_type("file-batch-request", key=file_key)
+    async def _file_apply_batch(self, msg) -> None:
+        """
+        Applies a list of lock, unlock and edit operations of the client to
+        the specified file in one pass. Every operation is a dictionary with
+        a 'type' ("lock", "insert", "unlock", "delta" or "patch") and the
+        fields of the corresponding single request.
+
+        Responds with the result of every operation (the lock id for locks,
+        the new block version for edits), and broadcasts the resulting table
+        and cursors only once.
+        """
+        content = msg["content"]
+        address, username = msg["sender"]
+
+        path = content["file_path"]
+
+        if not self.check_valid(address, username, path):
+            return
+
+        fields = {
+            "lock": ("piece_uuid", "offset", "length"),
+            "insert": ("piece_uuid",),
+            "unlock": ("lock_id",),
+            "delta": ("piece_uuid", "content"),
+            "patch": ("piece_uuid", "version", "patch"),
+        }
+
+        if not isinstance(content.get("operations"), list):
+            self._send_message_client("error-response",
+                                      {"message": "Missing operations.",
+                                       "error_code": ERROR_WRONG_MESSAGE},
+                                      address)
+            return
+
+        operations = []
+        for op in content["operations"]:
+            try:
+                operations.append((op["type"], *(op[key] for key in
+                                                 fields[op["type"]])))
+            except (KeyError, TypeError):
+                # Let the file report the malformed operation in place.
+                operations.append((op.get("type") if isinstance(op, dict)
+                                   else None,))
+
+        results, changed = self.files[path].apply_operations(username,
+                                                             operations)
+
+        results = [{"success": success, "result": result}
+                   for success, result in results]
+        self._send_message_client("file-batch-response",
+                                  {"file_path": path, "results": results},
+                                  address)
+        self._update_and_broadcast_piece_table(path, changed)
         self._broadcast_file_cursors(path)
 
     def _send_lock_response(self, file_path: str, success: bool,
@@ -735,6 +1376,248 @@ class Filesystem(Service):
                                    "success": success},
                                   client)
 
+    #
+    # DEFRAGMENTATION
+    #
+
+    async def _defragment_loop(self) -> None:
+        """
+        Periodically defragments the files in memory, in between the message
+        handlers.
+        """
+        while True:
+            await asyncio.sleep(DEFRAG_INTERVAL)
+            async with self._handler_lock:
+                try:
+                    await self._defragment_files()
+                except Exception as e:
+                    self._error(f"Defragmentation has failed: {e}")
+
+    async def _defragment_files(self) -> None:
+        """
+        Defragments every file of which the number of mergeable pieces
+        exceeds DEFRAG_THRESHOLD, or which has been idle for DEFRAG_IDLE_TIME
+        seconds, and broadcasts the new piece table of these files. Files are
+        defragmented on a worker thread, while the handler lock keeps them
+        from being changed.
+        """
+        now = time.monotonic()
+        self._file_versions = {path: self._file_versions.get(path, (-1, now))
+                               for path in self.files}
+
+        for path, file in list(self.files.items()):
+            version, since = self._file_versions[path]
+            if file.pt.version != version:
+                version, since = file.pt.version, now
+            self._file_versions[path] = (version, since)
+
+            fragmentation = file.pt.fragmentation()
+            if not fragmentation or (fragmentation < DEFRAG_THRESHOLD
+                                     and now - since < DEFRAG_IDLE_TIME):
+                continue
+
+            piece_count = len(file.pt.table)
+            changed = await self._run_in_pool(file.defragment)
+            self._file_versions[path] = (file.pt.version, now)
+
+            # Pieces containing cursors may leave nothing to merge.
+            if len(file.pt.table) < piece_count:
+                self._update_and_broadcast_piece_table(path, changed)
+
+    #
+    # AUTOSAVE
+    #
+
+    async def _autosave_loop(self) -> None:
+        """
+        Periodically saves one of the files which are due to be saved (see
+        '_autosave_due'), without broadcasting the save. After writing, waits
+        long enough to stay within AUTOSAVE_BANDWIDTH.
+        """
+        while True:
+            await asyncio.sleep(AUTOSAVE_INTERVAL)
+            now = time.monotonic()
+            try:
+                path = self._autosave_due(now)
+            except Exception as e:
+                self._error(f"Checking for files to autosave has failed: {e}")
+                continue
+            if path is None or now < self._autosave_resume:
+                continue
+
+            file = self.files[path]
+            written = 0
+            try:
+                # Files may be changed on a worker thread while the handler
+                # lock is held exclusively.
+                async with self._handler_lock.shared():
+                    snapshot, edit_count = file.pt.snapshot(), file.edit_count
+                written = await self._write_snapshot(file, snapshot,
+                                                     edit_count,
+                                                     skip_unchanged=True)
+                written = written or 0
+            except Exception as e:
+                self._error(f"Autosaving {path} has failed: {e}")
+
+            # Edits made during the save start a new quiet period.
+            self._dirty_files.pop(path, None)
+            self._autosave_resume = (time.monotonic()
+                                     + written / AUTOSAVE_BANDWIDTH)
+
+    def _autosave_due(self, now: float) -> Optional[str]:
+        """
+        Updates the edit times of the unsaved files, and returns the file
+        which has been unsaved the longest among the files which have been
+        quiet for AUTOSAVE_QUIET_TIME or unsaved for AUTOSAVE_MAX_DELAY
+        seconds, if any.
+        """
+        dirty_files = {}
+        due, due_since = None, now
+
+        for path, file in self.files.items():
+            if file.is_saved:
+                continue
+
+            edit_count, since, last_edit = self._dirty_files.get(
+                path, (file.edit_count, now, now))
+            if file.edit_count != edit_count:
+                edit_count, last_edit = file.edit_count, now
+            dirty_files[path] = (edit_count, since, last_edit)
+
+            if ((now - last_edit >= AUTOSAVE_QUIET_TIME
+                    or now - since >= AUTOSAVE_MAX_DELAY)
+                    and since <= due_since):
+                due, due_since = path, since
+
+        self._dirty_files = dirty_files
+        return due
+
+    #
+    # JOURNAL
+    #
+
+    async def _journal_sync_loop(self) -> None:
+        """
+        Periodically syncs the journals of all files with new edits to disk,
+        so a burst of edits costs a single fsync per file. The fsyncs run on
+        a worker thread.
+        """
+        while True:
+            await asyncio.sleep(JOURNAL_SYNC_INTERVAL)
+            try:
+                fds = [file.journal.flush() for file in self.files.values()
+                       if file.journal is not None and file.journal.dirty]
+                if fds:
+                    await self._run_in_pool(self._fsync_all, fds)
+            except Exception as e:
+                self._error(f"Syncing the journals has failed: {e}")
+
+    @staticmethod
+    def _fsync_all(fds: List[int]) -> None:
+        for fd in fds:
+            os.fsync(fd)
+
+    #
+    # WATCHER
+    #
+
+    async def _watch_loop(self) -> None:
+        """
+        Periodically collects the changes made to the root directory by other
+        programs on a worker thread, and applies them in between the message
+        handlers.
+        """
+        while True:
+            await asyncio.sleep(WATCH_INTERVAL)
+            try:
+                events = await self._run_in_pool(self.watcher.poll)
+                if events:
+                    async with self._handler_lock:
+                        await self._apply_disk_changes(events)
+            except Exception as e:
+                self._error(f"Watching the files has failed: {e}")
+
+    async def _apply_disk_changes(self, events: List[Event]) -> None:
+        """
+        Updates the directory tree and the files in memory after they have
+        been changed on disk. Only the changed piece tables are broadcast,
+        and the file list only when the tree changed.
+        """
+        old_tree = self.dir_tree.to_list()
+
+        for kind, path in events:
+            self.file_cache.discard(path)
+            if kind == "added":
+                self.dir_tree.add(path)
+            elif kind == "removed":
+                self.dir_tree.remove(path)
+            elif path in self.files:
+                await self._refresh_file(path)
+
+        root_tree = self.dir_tree.to_list()
+        if root_tree is old_tree:
+            return
+
+        c_msg = self._send_message("client-list-request", {})
+        resp = await self._wait_for_response(c_msg["uuid"])
+
+        self._send_message_client("file-list-broadcast",
+                                  {"root_tree": root_tree},
+                                  *resp["content"]["client_list"])
+
+    async def _refresh_file(self, path: str) -> None:
+        """
+        Applies the changes made on disk to the file in memory, unless they
+        were made by saving the file itself. Reading and comparing the file,
+        and rewriting its journal, run on a worker thread (see
+        ServerFile.refresh_from_disk), while the save lock keeps the file
+        from being saved in the meantime.
+        """
+        file = self.files[path]
+        save_lock = self._save_lock(file)
+        if save_lock.locked() or not file.is_changed_on_disk():
+            return
+
+        try:
+            async with save_lock:
+                changes = await self._run_in_pool(file.read_disk_changes)
+                changed = file.apply_disk_changes(changes)
+                await self._run_in_pool(file.journal_disk_changes, changes)
+        except (OSError, ValueError) as e:
+            self._error(f"Refreshing {path} from disk has failed: {e}")
+            return
+
+        self._update_and_broadcast_piece_table(path, changed)
+        self._broadcast_file_cursors(path)
+
+    #
+    # STATISTICS
+    #
+
+    @message_type("server-stats-request", pool="thread")
+    def _send_server_stats(self, msg) -> None:
+        """
+        Send the memory and fragmentation statistics of every file in memory
+        (see ServerFile.get_stats) back to the requesting client, for
+        capacity planning and spotting sessions which are never closed,
+        together with the queue and run times of the worker pools (see
+        Service._get_pool_stats). Runs on the thread pool, since it walks
+        the piece tables of all files.
+        """
+        address = msg["sender"][0]
+
+        files = {path: file.get_stats() for path, file in self.files.items()}
+
+        self._send_message_client("server-stats-response",
+                                  {
+                                      "files": files,
+                                      "pools": self._get_pool_stats(),
+                                      "line_store_lines": (
+                                          len(self.line_store)
+                                          if self.line_store else 0)
+                                  },
+                                  address)
+
 
 def main():
     Filesystem.start()
@@ -0,0 +1,216 @@
+from typing import Any, Dict, List, Optional, Tuple
+import json
+import os
+import threading
+
+
+class Journal:
+    """
+    Append-only journal of the edits made to a file since it was last saved,
+    used to recover unsaved edits after the server stopped unexpectedly.
+
+    The first line of the journal is a header describing the state of the
+    file on disk the edits apply to (its size and modification time), every
+    next line is an edit record of the form:
+        {"seq": <edit number>, "row": <row>, "length": <rows>,
+         "lines": <new lines>}
+    which replaces 'length' rows from 'row' on with the new lines.
+
+    Records are written to the journal immediately, but only flushed to the
+    disk by 'sync', so multiple edits share a single fsync. A checkpoint may
+    run on a worker thread while records are appended, see 'checkpoint'.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.dirty = False
+        self._file: Optional[Any] = None
+        self._removed = False
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def disk_state(file_path: str) -> Tuple[int, int]:
+        """
+        Return the state of the file on disk a journal applies to.
+        """
+        stat = os.stat(file_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def open(self, base: Tuple[int, int]) -> List[Dict[str, Any]]:
+        """
+        Open the journal for appending, and return the records to replay on
+        top of the file in the given disk state. When the journal belongs to
+        another state of the file, it is discarded. A record which was only
+        partially written is dropped.
+        """
+        try:
+            with open(self.path) as f:
+                journal = f.read().split('\n')
+        except OSError:
+            journal = []
+
+        records: List[Dict[str, Any]] = []
+        try:
+            header = json.loads(journal[0])
+            valid = tuple(header["base"]) == tuple(base)
+        except (IndexError, ValueError, KeyError, TypeError):
+            valid = False
+
+        # Every record ends with a newline, so the last part is empty unless
+        # the last record was only partially written.
+        intact = valid and journal[-1] == ''
+        if valid:
+            for line in journal[1:-1]:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    intact = False
+                    break
+
+        if not intact:
+            self._rewrite(base, records)
+        self._file = open(self.path, 'a')
+        return records
+
+    def _rewrite(self, base: Tuple[int, int],
+                 records: List[Dict[str, Any]]) -> None:
+        """
+        Atomically replace the journal by one with the given records.
+        """
+        os.replace(self._write_temp(base, records), self.path)
+
+    def _write_temp(self, base: Tuple[int, int],
+                    records: List[Dict[str, Any]]) -> str:
+        """
+        Write a journal with the given records to a temporary file, sync it
+        and return its path.
+        """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(json.dumps({"base": list(base)}) + '\n')
+            f.writelines(json.dumps(record) + '\n' for record in records)
+            f.flush()
+            os.fsync(f.fileno())
+        return temp_path
+
+    def append(self, seq: int, row: int, length: int,
+               lines: List[str]) -> None:
+        """
+        Write an edit record to the journal.
+        """
+        record = {"seq": seq, "row": row, "length": length,
+                  "lines": list(lines)}
+        with self._lock:
+            self._file.write(json.dumps(record) + '\n')
+            self.dirty = True
+
+    def flush(self) -> int:
+        """
+        Flush the written records to the operating system, and return the
+        file descriptor to pass to os.fsync, which may be called from another
+        thread.
+        """
+        with self._lock:
+            self._file.flush()
+            self.dirty = False
+            return self._file.fileno()
+
+    def sync(self) -> None:
+        os.fsync(self.flush())
+
+    def checkpoint(self, base: Tuple[int, int], seq: int) -> None:
+        """
+        Restart the journal after the file has been saved in the given disk
+        state, including all edits up to edit number 'seq'. Later edits are
+        kept in the journal.
+
+        The new journal is written and synced without holding the lock, so
+        this can run on a worker thread while edits are appended. Records
+        appended in the meantime are copied over before the new journal
+        replaces the old one.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+            with open(self.path, 'rb') as f:
+                journal = f.read()
+
+        records = [json.loads(line) for line in journal.splitlines()[1:]]
+        temp_path = self._write_temp(base, [record for record in records
+                                            if record["seq"] > seq])
+
+        with self._lock:
+            if self._removed:
+                os.remove(temp_path)
+                return
+            if self._file is not None:
+                self._file.flush()
+            with open(self.path, 'rb') as f:
+                f.seek(len(journal))
+                appended = f.read()
+            if appended:
+                with open(temp_path, 'ab') as f:
+                    f.write(appended)
+                    # A closed journal is not synced by its owner anymore.
+                    if self._file is None:
+                        f.flush()
+                        os.fsync(f.fileno())
+                self.dirty = self._file is not None
+
+            if self._file is not None:
+                self._file.close()
+            os.replace(temp_path, self.path)
+            if self._file is not None:
+                self._file = open(self.path, 'a')
+
+    def restart(self, base: Tuple[int, int],
+                records: List[Dict[str, Any]]) -> None:
+        """
+        Replace the journal by one with the given records, applying to the
+        file in the given disk state, after the file has been changed on
+        disk.
+        """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            self._rewrite(base, records)
+            self._file = open(self.path, 'a')
+            self.dirty = False
+
+    def move(self, path: str) -> None:
+        """
+        Move the journal to a new path, after the file has been renamed.
+        """
+        with self._lock:
+            self.flush()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.path, path)
+            self.path = path
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self.sync()
+                self._file.close()
+                self._file = None
+
+    def remove(self) -> None:
+        """
+        Close and delete the journal, discarding the edits within.
+        """
+        with self._lock:
+            self._removed = True
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    @staticmethod
+    def replay(lines: List[str], records: List[Dict[str, Any]]) -> None:
+        """
+        Apply the edit records to the lines of the file in place.
+        """
+        for record in records:
+            row = record["row"]
+            lines[row:row + record["length"]] = record["lines"]
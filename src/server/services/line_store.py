@@ -0,0 +1,90 @@
+from typing import Any, Counter, Dict, Iterable, List, Optional
+import sys
+import threading
+import weakref
+
+
+class LineStore:
+    """
+    Store of unique line strings, shared by the piece tables of all files.
+    Interning the lines of a block replaces every line by the equal line
+    already in the store, so that duplicated lines (within a file, or across
+    files) are kept in memory only once.
+
+    Tables using the store register themselves (see 'register'). Lines
+    which are no longer used by the blocks of any registered table are
+    pruned from the store whenever it has grown to twice its size after the
+    previous pruning.
+    """
+    # Minimal number of lines in the store before it is pruned.
+    PRUNE_MIN_SIZE = 4096
+
+    def __init__(self) -> None:
+        self._lines: Dict[str, str] = {}
+        self._prune_size = self.PRUNE_MIN_SIZE
+        self._tables: 'weakref.WeakSet[Any]' = weakref.WeakSet()
+        self._tables_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._lines)
+
+    def register(self, table: Any) -> None:
+        """
+        Register a table of which the lines are interned in the store, for
+        as long as the table exists. The table must have an 'interned_lines'
+        method returning all lines it holds, see PieceTable.interned_lines.
+        """
+        with self._tables_lock:
+            self._tables.add(table)
+
+    def intern(self, lines: Iterable[str],
+               stats: Optional[Counter] = None) -> List[str]:
+        """
+        Return the given lines as a list of the equal lines in the store,
+        adding lines which are not present yet.
+
+        If 'stats' is given, the number of bytes of new unique lines is added
+        to its "unique_bytes" key, and the number of bytes of lines which
+        were replaced by a line already in the store to "shared_bytes".
+        """
+        # Prune first, as the lines interned now are not held by a table yet.
+        if len(self._lines) >= self._prune_size:
+            self.prune()
+
+        store = self._lines
+        result = []
+        unique_bytes = shared_bytes = 0
+
+        for line in lines:
+            stored = store.get(line)
+            if stored is None:
+                store[line] = stored = line
+                unique_bytes += sys.getsizeof(line)
+            elif stored is not line:
+                shared_bytes += sys.getsizeof(line)
+            result.append(stored)
+
+        if stats is not None:
+            stats["unique_bytes"] += unique_bytes
+            stats["shared_bytes"] += shared_bytes
+
+        return result
+
+    def prune(self) -> int:
+        """
+        Rebuild the store from the lines held by the registered tables, and
+        return the number of removed lines.
+        """
+        with self._tables_lock:
+            tables = list(self._tables)
+
+        store = self._lines
+        used: Dict[str, str] = {}
+        for table in tables:
+            for line in table.interned_lines():
+                if store.get(line) is line:
+                    used[line] = line
+
+        self._lines = used
+        self._prune_size = max(self.PRUNE_MIN_SIZE, 2 * len(used))
+        return len(store) - len(used)
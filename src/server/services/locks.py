@@ -0,0 +1,118 @@
+from typing import Any, Awaitable, Callable, Dict, Tuple
+from collections import deque
+import asyncio
+
+
+class HandlerLock:
+    """
+    First-in, first-out lock which is either held exclusively, or shared by
+    any number of holders. Used as an async context manager, the lock is
+    acquired exclusively; 'shared' returns a context manager acquiring it
+    shared.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        self._shared = 0
+        self._exclusive = False
+        self._waiters: deque = deque()
+
+    def locked(self) -> bool:
+        return self._exclusive or self._shared > 0
+
+    def _can_enter(self, exclusive: bool) -> bool:
+        return not self._exclusive and (not exclusive or self._shared == 0)
+
+    def _enter(self, exclusive: bool) -> None:
+        if exclusive:
+            self._exclusive = True
+        else:
+            self._shared += 1
+
+    async def acquire(self, exclusive: bool = True) -> None:
+        if not self._waiters and self._can_enter(exclusive):
+            self._enter(exclusive)
+            return
+
+        fut = self._loop.create_future()
+        self._waiters.append((fut, exclusive))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(exclusive)
+            else:
+                self._wake()
+            raise
+
+    def release(self, exclusive: bool = True) -> None:
+        if exclusive:
+            self._exclusive = False
+        else:
+            self._shared -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._waiters:
+            fut, exclusive = self._waiters[0]
+            if fut.done():
+                self._waiters.popleft()
+                continue
+            if not self._can_enter(exclusive):
+                break
+            self._waiters.popleft()
+            self._enter(exclusive)
+            fut.set_result(None)
+
+    async def __aenter__(self) -> None:
+        await self.acquire()
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.release()
+
+    def shared(self) -> '_SharedHandlerLock':
+        return _SharedHandlerLock(self)
+
+
+class _SharedHandlerLock:
+    def __init__(self, lock: HandlerLock) -> None:
+        self._lock = lock
+
+    async def __aenter__(self) -> None:
+        await self._lock.acquire(exclusive=False)
+
+    async def __aexit__(self, *exc_info) -> None:
+        self._lock.release(exclusive=False)
+
+
+class KeyLocks:
+    """
+    Locks of the handlers with a key (see message_type). Handlers of the
+    same key run one at a time, in the order they were started, but
+    concurrently with handlers of other keys, and never while the handler
+    lock is held exclusively. A lock is only kept while handlers of its key
+    are running or waiting.
+    """
+    def __init__(self, handler_lock: HandlerLock) -> None:
+        self._handler_lock = handler_lock
+        # Lock of every key with handlers running or waiting, and the number
+        # of those handlers.
+        self._locks: Dict[Any, Tuple[asyncio.Lock, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    async def run(self, key: Any, fn: Callable[..., Awaitable],
+                  *args) -> Any:
+        lock, users = self._locks.get(key, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._locks[key] = (lock, users + 1)
+        try:
+            async with lock, self._handler_lock.shared():
+                return await fn(*args)
+        finally:
+            lock, users = self._locks[key]
+            if users == 1:
+                del self._locks[key]
+            else:
+                self._locks[key] = (lock, users - 1)
@@ -1,17 +1,25 @@
 import dataclasses
+from typing import Tuple
 
 
 @dataclasses.dataclass
 class Piece:
+    # Slotted, since long editing sessions can leave tens of thousands of
+    # pieces in a table.
+    __slots__ = ('piece_id', 'block_id', 'start', 'length', 'owner')
+
     piece_id: str
     block_id: int
     start:    int
     length:   int
     owner:    str
 
-    def _get_fields(self):
-        return [getattr(self, field) for field in self.__annotations__]
+    def as_tuple(self) -> Tuple[str, int, int, int, str]:
+        return (self.piece_id, self.block_id, self.start, self.length,
+                self.owner)
 
     def __iter__(self):
-        for field in self._get_fields():
-            yield field
+        return iter(self.as_tuple())
+
+    def __reduce__(self):
+        return Piece, self.as_tuple()
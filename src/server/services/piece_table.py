@@ -1,9 +1,35 @@
-from typing import List, Tuple, Dict, Union
+from typing import (List, Tuple, Dict, Union, Optional, Set, Sequence,
+                    Iterator, Iterable)
+from collections import Counter, defaultdict
+import copy
+import difflib
+import functools
+import itertools
+import sys
 import uuid
+import weakref
+from .blocks import BlockView, MappedLines
+from .line_store import LineStore
 from .piece import Piece
+from .piece_tree import PieceTree
 from .typedefs import LockError
 
 
+def _mutates(method):
+    """
+    Decorator for PieceTable methods which change the table. Makes sure the
+    table no longer shares its state with a snapshot in use before it is
+    changed, and increases the version of the table.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if len(self._sharing) > 1:
+            self._unshare()
+        self.version += 1
+        return method(self, *args, **kwargs)
+    return wrapper
+
+
 class PieceTable:
     """
     Text file data structure consisting of the original file together with
@@ -15,8 +41,40 @@ class PieceTable:
     that no other pieces can be created on top of them, until the
     piece is unlocked manually. Blocks can thereafter be edited, while the
     piece table makes sure the general structure stays intact.
+
+    When created with 'tree=True', the table is backed by a PieceTree instead
+    of a list, which makes row lookups, piece positions and the file length
+    O(log n) at the cost of slightly slower indexing.
+
+    When created with 'add_buffer=True', new and edited lines are appended to
+    a single shared add buffer, and blocks are views on ranges of this buffer
+    (or on the block they were locked from) rather than copies. The add
+    buffer is compacted by 'clear_unused_blocks' once enough of it is unused.
+
+    'snapshot' creates a copy of the piece table in O(1), which shares its
+    state with the original until either of them is changed while the other
+    is still in use. 'freeze' returns the content of the table without
+    keeping its state shared. 'diff' returns the row ranges in which two
+    versions of a piece table differ.
+
+    When a LineStore is given as 'line_store', all new lines are interned in
+    it, so equal lines share their memory across blocks and files. The bytes
+    this stores and saves are counted in 'line_stats'.
     """
-    def __init__(self, text) -> None:
+    # Maximum number of lines copied when merging unlocked pieces which do
+    # not follow each other within the same block.
+    MERGE_COPY_LIMIT = 256
+
+    # The add buffer is compacted when the number of unused lines within it
+    # exceeds both this minimum and the number of lines still in use.
+    ADD_BUFFER_MIN_GARBAGE = 1024
+
+    # Maximum number of rows compared line by line by 'diff'.
+    DIFF_LINE_LIMIT = 10000
+
+    def __init__(self, text, tree: bool = False,
+                 add_buffer: bool = False,
+                 line_store: Optional[LineStore] = None) -> None:
         """
         Initialises the block dictionary and piece table. Also creates the
         block with id 0, the 'orig' block which contains the original file.
@@ -24,20 +82,101 @@ class PieceTable:
         if not text:
             text = ["\n"]
 
-        lines = self.text_to_lines(text)
+        self._line_store = line_store
+        self.line_stats: Counter = Counter()
+
+        lines = self._intern(self.text_to_lines(text))
         orig = Piece(str(uuid.uuid4()), 0, 0, len(lines), "")
 
-        self.blocks: Dict[int, List[str]] = {0: lines}
-        self.table: List[Piece] = [orig]
+        self.blocks: Dict[int, Sequence[str]] = {0: lines}
+        self._next_block_id = 1
+        if line_store is not None:
+            line_store.register(self)
+        self._tree = tree
+
+        # The shared add buffer, and the number of its lines still in use.
+        self._add: Optional[List[str]] = [] if add_buffer else None
+        self._add_live = 0
+
+        # Number of pieces referencing every block. Blocks which are no longer
+        # referenced are collected in '_dead_blocks', until they are removed
+        # by 'clear_unused_blocks'.
+        self._block_refs: Counter = Counter({0: 1})
+        self._dead_blocks: Set[int] = set()
+
+        # Version of every block, increased whenever its content changes.
+        self._versions: Counter = Counter()
+
+        # Version of the whole table, and the tables sharing its state, which
+        # are the table itself and its snapshots still in use. Blocks which
+        # existed when the state was last shared are never changed in place.
+        self.version = 0
+        self._sharing: 'weakref.WeakSet[PieceTable]' = weakref.WeakSet([self])
+        self._frozen_blocks: Set[int] = set()
+        self.table: List[Piece] = self._new_table([orig])
+
+        # Index from piece id to piece, kept in sync by every method that
+        # adds, removes or renames pieces. The position of each piece in the
+        # table is cached lazily, since inserting or removing a piece shifts
+        # all pieces after it: only the positions before '_positions_valid'
+        # are known to be correct, which is lowered to the index of every
+        # insertion or removal (see 'get_piece_index').
+        self._pieces: Dict[str, Piece] = {orig.piece_id: orig}
+        self._positions: Dict[str, int] = {}
+        self._positions_valid = 0
+
+        # Index from owner to the ids of their locked pieces, and a cache of
+        # the ids of all locks in table order. Edits never reorder pieces, so
+        # the cache is only rebuilt when the lock version (increased whenever
+        # a lock is added, removed or renamed) changed.
+        self._locks: Dict[str, Set[str]] = defaultdict(set)
+        self._lock_version = 0
+        self._lock_order: Optional[Tuple[int, List[str]]] = None
 
     @staticmethod
     def text_to_lines(text) -> List[str]:
         return text.splitlines(True) if isinstance(text, str) else text
 
+    def _intern(self, lines: Iterable[str]) -> Iterable[str]:
+        """
+        Intern the lines in the line store, if any. Lazily loaded lines and
+        views on existing blocks are left alone.
+        """
+        if (self._line_store is None
+                or isinstance(lines, (BlockView, MappedLines))):
+            return lines
+        return self._line_store.intern(lines, self.line_stats)
+
+    def _new_table(self, pieces: List[Piece]) -> List[Piece]:
+        """
+        Create the table container for the given pieces, depending on whether
+        the piece table is tree backed.
+        """
+        return PieceTree(pieces) if self._tree else pieces
+
+    def _iter_table(self, start_index: int = 0):
+        """
+        Iterate over the table, starting at the given index.
+        """
+        if self._tree:
+            return self.table.iter_from(start_index)
+        return itertools.islice(self.table, start_index, None)
+
+    @_mutates
+    def _set_length(self, piece: Piece, length: int) -> None:
+        """
+        Change the length of a piece within the table.
+        """
+        piece.length = length
+        if self._tree:
+            self.table.refresh(piece)
+
     def __len__(self) -> int:
         """
         Returns the length of the stitched file according to the piece table.
         """
+        if self._tree:
+            return self.table.total_rows()
         return sum(piece.length for piece in self.table)
 
     def __str__(self) -> str:
@@ -58,15 +197,263 @@ class PieceTable:
     def __getitem__(self, idx):
         return self.table[idx]
 
-    def _insert_block(self, text: Union[List[str], str]) -> int:
+    def __contains__(self, piece_id: str) -> bool:
+        return piece_id in self._pieces
+
+    def _is_add_view(self, block: Sequence[str]) -> bool:
+        return isinstance(block, BlockView) and block.base is self._add
+
+    def _store_block(self, block_id: int, lines: Union[Iterable[str], str],
+                     owned: bool = False) -> None:
+        """
+        Store the lines as the content of the given block. In add buffer mode,
+        lines which are not a view yet are appended to the add buffer, unless
+        'owned' is set, see 'set_piece_content'.
+
+        Stored blocks are never changed in place afterwards, so views on them
+        remain valid. Only owned lock blocks are patched in place.
+        """
+        lines = self._intern(self.text_to_lines(lines))
+        old_block = self.blocks.get(block_id)
+
+        if (self._add is None or owned) and not isinstance(lines, Sequence):
+            lines = list(lines)
+
+        if old_block is not None and self._is_add_view(old_block):
+            self._add_live -= len(old_block)
+
+        if self._add is not None and not owned:
+            if not isinstance(lines, BlockView):
+                start = len(self._add)
+                self._add.extend(lines)
+                lines = BlockView(self._add, start, len(self._add) - start)
+            if self._is_add_view(lines):
+                self._add_live += len(lines)
+
+        self.blocks[block_id] = lines
+        self._versions[block_id] += 1
+        self._frozen_blocks.discard(block_id)
+
+    @_mutates
+    def _insert_block(self, text: Union[Iterable[str], str]) -> int:
         """
         Insert a new block into the block dictionary, and return its id.
         """
-        lines = self.text_to_lines(text)
-        index = max(self.blocks) + 1
-        self.blocks[index] = lines
+        index = self._next_block_id
+        self._next_block_id += 1
+        self._store_block(index, text)
+
+        # The block is unused until a piece refers to it.
+        self._dead_blocks.add(index)
         return index
 
+    def _ref_block(self, block_id: int) -> None:
+        self._block_refs[block_id] += 1
+
+    def _unref_block(self, block_id: int) -> None:
+        self._block_refs[block_id] -= 1
+        if self._block_refs[block_id] <= 0:
+            del self._block_refs[block_id]
+            self._dead_blocks.add(block_id)
+
+    def _set_block(self, piece: Piece, block_id: int, start: int) -> None:
+        """
+        Let the piece refer to another block.
+        """
+        self._unref_block(piece.block_id)
+        piece.block_id = block_id
+        piece.start = start
+        self._ref_block(block_id)
+
+    def _index_piece(self, piece: Piece) -> None:
+        """
+        Add the piece to the piece id index.
+        """
+        self._pieces[piece.piece_id] = piece
+        self._ref_block(piece.block_id)
+
+        if piece.owner:
+            self._lock_version += 1
+            self._locks[piece.owner].add(piece.piece_id)
+
+    def _unindex_piece(self, piece: Piece) -> None:
+        """
+        Remove the piece from the piece id index.
+        """
+        if self._pieces.get(piece.piece_id) is piece:
+            del self._pieces[piece.piece_id]
+            self._positions.pop(piece.piece_id, None)
+        self._unref_block(piece.block_id)
+
+        if piece.owner:
+            self._lock_version += 1
+            self._locks[piece.owner].discard(piece.piece_id)
+
+    def _reindex(self) -> None:
+        """
+        Rebuild the piece id index and block references from the table.
+        """
+        self._pieces = {p.piece_id: p for p in reversed(self.table)}
+        self._positions = {}
+        self._positions_valid = 0
+
+        self._block_refs = Counter(p.block_id for p in self.table)
+        self._dead_blocks = {b for b in self.blocks
+                             if b not in self._block_refs}
+
+        self._lock_version += 1
+        self._locks = defaultdict(set)
+        for p in self.table:
+            if p.owner:
+                self._locks[p.owner].add(p.piece_id)
+
+    def snapshot(self) -> 'PieceTable':
+        """
+        Return a point-in-time copy of the piece table in O(1). The copy
+        shares its pieces and blocks with this table, until either of them is
+        changed while the other is still in use, which then copies the table
+        (but not the blocks) first. Snapshots should therefore be dropped as
+        soon as possible, see 'freeze'.
+        """
+        snapshot = copy.copy(self)
+        self._sharing.add(snapshot)
+        return snapshot
+
+    def _unshare(self) -> None:
+        """
+        Give the piece table its own copy of the state shared with snapshots.
+        """
+        self.table = self._new_table([Piece(*p.as_tuple())
+                                      for p in self.table])
+        self.blocks = dict(self.blocks)
+        self._versions = Counter(self._versions)
+        self._frozen_blocks = set(self.blocks)
+        self._sharing.discard(self)
+        self._sharing = weakref.WeakSet([self])
+        self._reindex()
+
+    def freeze(self) -> List[Sequence[str]]:
+        """
+        Return the content of the table as a list of line sequences, which is
+        not affected by later changes to the table. Unlike a snapshot, this
+        does not keep the state of the table shared.
+
+        Lines are shared with the blocks which are never changed in place:
+        the orig block and the add buffer. Other lines are copied, which
+        are only those of locks in practice.
+        """
+        fixed = (self.blocks.get(0), self._add)
+        parts: List[Sequence[str]] = []
+        for piece in self.table:
+            view = BlockView.of(self.blocks[piece.block_id], piece.start,
+                                piece.length)
+            if isinstance(view.base, list) and not any(
+                    view.base is base for base in fixed):
+                parts.append(view[:])
+            else:
+                parts.append(view)
+        return parts
+
+    def _line_runs(self) -> List[Tuple[int, int, int]]:
+        """
+        Return the file as a list of (sequence id, start, length) runs of
+        lines, where neighbouring pieces referring to consecutive lines of the
+        same underlying sequence are joined.
+        """
+        runs: List[Tuple[int, int, int]] = []
+        for piece in self.table:
+            block = self.blocks[piece.block_id]
+            base, start = block, piece.start
+            if isinstance(block, BlockView):
+                base, start = block.base, block.start + piece.start
+
+            if (runs and runs[-1][0] == id(base)
+                    and runs[-1][1] + runs[-1][2] == start):
+                runs[-1] = (id(base), runs[-1][1],
+                            runs[-1][2] + piece.length)
+            elif piece.length:
+                runs.append((id(base), start, piece.length))
+        return runs
+
+    @staticmethod
+    def _common_rows(a_runs: List[Tuple[int, int, int]],
+                     b_runs: List[Tuple[int, int, int]]) -> int:
+        """
+        Return the number of leading rows two lists of runs have in common.
+        """
+        rows = i = j = a_offset = b_offset = 0
+        while i < len(a_runs) and j < len(b_runs):
+            a_key, a_start, a_length = a_runs[i]
+            b_key, b_start, b_length = b_runs[j]
+            if a_key != b_key or a_start + a_offset != b_start + b_offset:
+                break
+
+            step = min(a_length - a_offset, b_length - b_offset)
+            rows += step
+            a_offset += step
+            b_offset += step
+            if a_offset == a_length:
+                i, a_offset = i + 1, 0
+            if b_offset == b_length:
+                j, b_offset = j + 1, 0
+        return rows
+
+    @staticmethod
+    def _line_keys(runs: List[Tuple[int, int, int]], start: int,
+                   stop: int) -> List[Tuple[int, int]]:
+        """
+        Return a (sequence id, index) key for every row from 'start' up to
+        'stop' in the given runs.
+        """
+        keys: List[Tuple[int, int]] = []
+        row = 0
+        for key, run_start, length in runs:
+            lo, hi = max(start - row, 0), min(stop - row, length)
+            keys.extend((key, run_start + i) for i in range(lo, hi))
+            row += length
+            if row >= stop:
+                break
+        return keys
+
+    def diff(self, other: 'PieceTable') -> List[Tuple[int, int, int, int]]:
+        """
+        Return the row ranges in which this piece table differs from another
+        version of it (usually a snapshot), as a list of (start row, length,
+        other start row, other length) tuples.
+
+        Rows are compared by where their lines are stored rather than by
+        their content, so this is cheap for versions sharing their blocks.
+        Lines which were copied into another block are reported as changed,
+        even if their content is the same.
+        """
+        a_runs, b_runs = self._line_runs(), other._line_runs()
+        a_len, b_len = len(self), len(other)
+
+        prefix = self._common_rows(a_runs, b_runs)
+        if prefix == a_len == b_len:
+            return []
+
+        def reverse(runs):
+            return [(key, -(start + length), length)
+                    for key, start, length in reversed(runs)]
+
+        suffix = min(self._common_rows(reverse(a_runs), reverse(b_runs)),
+                     min(a_len, b_len) - prefix)
+        a_stop, b_stop = a_len - suffix, b_len - suffix
+
+        # Split the remaining range into separate changes if it is small
+        # enough to compare line by line.
+        if a_stop - prefix + b_stop - prefix > self.DIFF_LINE_LIMIT:
+            return [(prefix, a_stop - prefix, prefix, b_stop - prefix)]
+
+        matcher = difflib.SequenceMatcher(
+            None, self._line_keys(a_runs, prefix, a_stop),
+            self._line_keys(b_runs, prefix, b_stop), autojunk=False)
+        return [(prefix + i1, i2 - i1, prefix + j1, j2 - j1)
+                for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+                if tag != 'equal']
+
+    @_mutates
     def _insert_piece(self, piece: Piece, index: int = None,
                       after_id: str = None) -> None:
         """
@@ -80,6 +467,8 @@ class PieceTable:
         """
         if index is not None:
             self.table.insert(index, piece)
+            self._positions_changed(index)
+            self._index_piece(piece)
         elif after_id is not None:
             if after_id == "":
                 index = 0
@@ -89,13 +478,44 @@ class PieceTable:
         else:
             raise ValueError("No index or preceding uuid given")
 
+    def _pop_piece(self, index: int) -> Piece:
+        """
+        Remove the piece at the given index from the table and return it.
+        """
+        piece = self.table.pop(index)
+        self._positions_changed(index)
+        self._unindex_piece(piece)
+        return piece
+
+    @_mutates
     def _remove_piece(self, piece_id: str) -> None:
         """
         Remove the specified piece from the table.
         """
+        self._pop_piece(self.get_piece_index(piece_id))
+
+    @_mutates
+    def renew_piece_id(self, piece_id: str) -> str:
+        """
+        Give the specified piece a new uuid, and return it. Used to signal
+        clients that the piece has changed.
+        """
         piece = self.get_piece(piece_id)
-        if piece:
-            self.table.remove(piece)
+        new_id = str(uuid.uuid4())
+
+        del self._pieces[piece_id]
+        piece.piece_id = new_id
+        self._pieces[new_id] = piece
+
+        if piece_id in self._locks[piece.owner]:
+            self._lock_version += 1
+            self._locks[piece.owner].remove(piece_id)
+            self._locks[piece.owner].add(new_id)
+
+        if piece_id in self._positions:
+            self._positions[new_id] = self._positions.pop(piece_id)
+
+        return new_id
 
     def _merge_neighbours_same_owner(self, piece_id: str, uname: str) -> None:
         """
@@ -112,47 +532,70 @@ class PieceTable:
         piece = self.get_piece(piece_id)
         index = self.get_piece_index(piece_id)
 
+        lines = self._get_piece_lines(piece)
+        merged = False
+
         # Try merging with the next piece in the table.
         if (index + 1 < len(self.table)
            and self.table[index + 1].owner == uname):
-            next_piece = self.table[index + 1]
-            next_block = self.get_lines(next_piece.piece_id, next_piece.start,
-                                        next_piece.length)
-
-            self.blocks[piece.block_id] += next_block
-            piece.length += next_piece.length
-            self.table.remove(next_piece)
+            next_piece = self._pop_piece(index + 1)
+            lines = lines + self._get_piece_lines(next_piece)
+            merged = True
 
         # Try merging with the previous piece in the table.
         if index > 0 and self.table[index - 1].owner == uname:
-            prev_piece = self.table[index - 1]
-            prev_block = self.get_lines(prev_piece.piece_id, prev_piece.start,
-                                        prev_piece.length)
+            prev_piece = self._pop_piece(index - 1)
+            lines = self._get_piece_lines(prev_piece) + lines
+            merged = True
 
-            self.blocks[piece.block_id] = (prev_block +
-                                           self.blocks[piece.block_id])
-            piece.length += prev_piece.length
-            self.table.remove(prev_piece)
+        if merged:
+            self._store_block(piece.block_id, lines)
+            self._set_length(piece, len(lines))
 
     def get_piece_index(self, piece_id: str) -> int:
         """
         From the given piece_id, return its index in the piece table. If it is
         not present, raises a ValueError.
         """
-        for i, piece in enumerate(self.table):
-            if piece.piece_id == piece_id:
-                return i
+        piece = self.get_piece(piece_id)
+
+        if self._tree:
+            return self.table.index(piece)
+
+        index = self._positions.get(piece_id)
+        if (index is not None and index < self._positions_valid
+                and self.table[index] is piece):
+            return index
+
+        # Number the pieces from the first unknown position up to the piece,
+        # so a burst of edits around the same spot only renumbers the
+        # pieces between the edits and the looked up pieces.
+        for index in range(self._positions_valid, len(self.table)):
+            other = self.table[index]
+            self._positions[other.piece_id] = index
+            if other is piece:
+                self._positions_valid = index + 1
+                return index
+
+        self._positions_valid = len(self.table)
         raise ValueError("Given uuid not in piece table")
 
+    def _positions_changed(self, index: int) -> None:
+        """
+        Mark the cached positions from the given index onwards as unknown,
+        after pieces have been inserted or removed there.
+        """
+        self._positions_valid = min(self._positions_valid, index)
+
     def get_piece(self, piece_id: str) -> Piece:
         """
         Return the piece given its id. If the piece is not present in the
         table, raises a ValueError.
         """
-        for piece in self.table:
-            if piece.piece_id == piece_id:
-                return piece
-        raise ValueError("Given uuid not in piece table")
+        piece = self._pieces.get(piece_id)
+        if piece is None:
+            raise ValueError("Given uuid not in piece table")
+        return piece
 
     def row_to_piece(self, row: int) -> Tuple[str, int]:
         """
@@ -160,6 +603,10 @@ class PieceTable:
         as well as the offset within this piece.
         Raises a ValueError when the row is outside the file.
         """
+        if self._tree:
+            piece, offset = self.table.find_row(row)
+            return piece.piece_id, offset
+
         for piece in self.table:
             row -= piece.length
             if row < 0:
@@ -171,6 +618,9 @@ class PieceTable:
         Returns the starting row of the specified piece, and raises a
         ValueError if the piece_id is not present in the table.
         """
+        if self._tree:
+            return self.table.row_of(self.get_piece(piece_id))
+
         row = 0
         for piece in self.table:
             if piece.piece_id == piece_id:
@@ -200,7 +650,7 @@ class PieceTable:
         remainder = -(length + offset)
         end_offset = 0
 
-        for piece in self.table[start_index:]:
+        for piece in self._iter_table(start_index):
             pieces.append(piece)
             remainder += piece.length
 
@@ -211,58 +661,104 @@ class PieceTable:
 
         return pieces, end_offset
 
-    def get_piece_content(self, piece_id: str) -> List[str]:
+    def _get_piece_lines(self, piece: Piece) -> List[str]:
         """
-        Get the text content for a given piece id.
+        Get the text content of the given piece object.
         """
-        p = self.get_piece(piece_id)
-        return self.blocks[p.block_id][p.start:p.start+p.length]
+        return self.blocks[piece.block_id][piece.start:piece.start
+                                           + piece.length]
 
-    def get_lines(self, start_piece_id: str = None, offset: int = 0,
-                  length: int = None) -> List[str]:
+    def get_piece_content(self, piece_id: str) -> Sequence[str]:
         """
-        Return actual text lines possibly spanning multiple pieces.
+        Get the text content for a given piece id, as a view on its block.
+        """
+        piece = self.get_piece(piece_id)
+        return BlockView.of(self.blocks[piece.block_id], piece.start,
+                            piece.length)
+
+    def _line_ranges(self, start_piece_id: str = None, offset: int = 0,
+                     length: int = None
+                     ) -> Tuple[int, Iterator[Tuple[Sequence[str], int, int]]]:
+        """
+        Return the number of lines within the specified range, together with
+        an iterator over the (block, start, length) ranges making up these
+        lines, one for every piece. The range is checked right away, while the
+        pieces are only visited during iteration.
 
         If no start id is passed, starts from the first piece
-        If length is not passed, returns the length until the end of the file.
+        If length is not passed, the range runs until the end of the file.
         """
         if start_piece_id:
             start_index = self.get_piece_index(start_piece_id)
+            start_row = self.piece_to_row(start_piece_id)
         else:
             start_index = 0
+            start_row = 0
 
         if length is None:
             length = len(self)
+        length = min(len(self) - start_row - offset, length)
 
-        pieces = self.table[start_index:]
-        first_piece, *rest_pieces = pieces
+        def ranges():
+            remaining_length = length
+            piece_offset = offset
 
-        length = min(sum(piece.length for piece in pieces) - offset, length)
-        remaining_length = length
+            for piece in self._iter_table(start_index):
+                if remaining_length <= 0:
+                    break
 
-        # Step 1. Take the lines we need from the first piece
-        start = first_piece.start + offset
+                # We can never take more lines from a piece than it contains.
+                take_length = min(remaining_length,
+                                  piece.length - piece_offset)
+                yield (self.blocks[piece.block_id],
+                       piece.start + piece_offset, take_length)
 
-        # We can never take more lines from the first piece than it contains,
-        # so we need to take min(length, first_piece.length) lines.
-        take_length = min(length, first_piece.length - offset)
-        lines = self.blocks[first_piece.block_id][start:start + take_length]
-        remaining_length -= take_length
+                remaining_length -= take_length
+                piece_offset = 0
 
-        # Step 2. Take the remaining lines we need from the next pieces
-        for piece in rest_pieces:
-            if (remaining_length <= 0):
-                break
+            assert remaining_length <= 0
 
-            block = self.blocks[piece.block_id]
-            take_length = min(remaining_length, piece.length)
-            lines += block[piece.start:piece.start + take_length]
-            remaining_length -= take_length
+        return length, ranges()
+
+    def iter_chunks(self, start_piece_id: str = None, offset: int = 0,
+                    length: int = None) -> Iterator[BlockView]:
+        """
+        Iterate over the lines in the given range (see 'get_lines') block by
+        block, yielding a view on the lines of every piece without copying
+        them.
+        """
+        _, ranges = self._line_ranges(start_piece_id, offset, length)
+        return (BlockView.of(block, start, take_length)
+                for block, start, take_length in ranges)
+
+    def iter_lines(self, start_piece_id: str = None, offset: int = 0,
+                   length: int = None) -> Iterator[str]:
+        """
+        Iterate over the lines in the given range (see 'get_lines') without
+        building a list of them.
+        """
+        _, ranges = self._line_ranges(start_piece_id, offset, length)
+        return (block[i] for block, start, take_length in ranges
+                for i in range(start, start + take_length))
+
+    def get_lines(self, start_piece_id: str = None, offset: int = 0,
+                  length: int = None) -> List[str]:
+        """
+        Return actual text lines possibly spanning multiple pieces.
+
+        If no start id is passed, starts from the first piece
+        If length is not passed, returns the length until the end of the file.
+        """
+        length, ranges = self._line_ranges(start_piece_id, offset, length)
+
+        lines: List[str] = []
+        for block, start, take_length in ranges:
+            lines += block[start:start + take_length]
 
-        assert remaining_length == 0
         assert len(lines) == length
         return lines
 
+    @_mutates
     def put_piece(self, start_piece_id: str, offset: int, length: int,
                   uname: str) -> str:
         """
@@ -281,53 +777,57 @@ class PieceTable:
         pieces, end_offset = self.get_pieces(*args)
 
         # Check if allowed
-        for p in pieces:
-            if p.owner not in ("", uname):
-                raise ValueError("The requested area is (partially) locked.")
-
-        # Get lines and initiate new block
-        lines = self.get_lines(*args)
+        row = self.piece_to_row(start_piece_id) + offset
+        if not self.is_range_free(row, length, uname):
+            raise ValueError("The requested area is (partially) locked.")
+
+        # Get lines and initiate new block. In add buffer mode, a lock within
+        # a single piece refers to the lines of that piece without copying.
+        first_piece, last_piece = pieces[0], pieces[-1]
+        if self._add is not None and len(pieces) == 1:
+            lines = BlockView.of(self.blocks[first_piece.block_id],
+                                 first_piece.start + offset,
+                                 min(end_offset, first_piece.length) - offset)
+        else:
+            lines = self.iter_lines(*args)
         block_id = self._insert_block(lines)
 
-        if len(pieces) > 1:
-            (first_piece, *middle_pieces, last_piece) = pieces
-        else:
-            # This occurs when we're creating a piece fully inside another one.
-            # In that case, we want to insert a copy of the piece after itself.
-            first_piece = pieces[0]
-            last_piece = Piece(*first_piece)
-            self._insert_piece(last_piece, after_id=first_piece.piece_id)
-            middle_pieces = []
-
-        # Insert the new piece
         new_piece = Piece(piece_id=str(uuid.uuid4()), block_id=block_id,
-                          start=0, length=len(lines), owner=uname)
-        self._insert_piece(new_piece, after_id=first_piece.piece_id)
+                          start=0, length=len(self.blocks[block_id]),
+                          owner=uname)
+        replacement = [new_piece]
 
-        # Cut starting piece
+        # Keep the part of the first piece before the lock.
         if offset:
-            first_piece.length = offset
-            first_piece.piece_id = str(uuid.uuid4())
-        else:
-            self.table.remove(first_piece)
-
-        # Remove pieces within range
-        for piece in middle_pieces:
-            self.table.remove(piece)
+            replacement.insert(0, Piece(str(uuid.uuid4()),
+                                        first_piece.block_id,
+                                        first_piece.start, offset,
+                                        first_piece.owner))
+
+        # Keep the part of the last piece after the lock. This also covers
+        # creating a piece fully inside another one.
+        if end_offset < last_piece.length:
+            replacement.append(Piece(str(uuid.uuid4()), last_piece.block_id,
+                                     last_piece.start + end_offset,
+                                     last_piece.length - end_offset,
+                                     last_piece.owner))
+
+        # Replace the covered pieces in a single splice.
+        start_index = self.get_piece_index(start_piece_id)
+        self.table[start_index:start_index + len(pieces)] = replacement
+        self._positions_changed(start_index)
 
-        # Cut last piece
-        if not end_offset >= last_piece.length:
-            last_piece.start += end_offset
-            last_piece.length -= end_offset
-            last_piece.piece_id = str(uuid.uuid4())
-        else:
-            self.table.remove(last_piece)
+        for piece in pieces:
+            self._unindex_piece(piece)
+        for piece in replacement:
+            self._index_piece(piece)
 
         # Merge the locks if necessary.
         self._merge_neighbours_same_owner(new_piece.piece_id, uname)
 
         return new_piece.piece_id
 
+    @_mutates
     def put_piece_after(self, piece_id: str, uname: str) -> str:
         """
         Inserts a new piece inbetween existing pieces after the piece
@@ -339,30 +839,317 @@ class PieceTable:
         self._merge_neighbours_same_owner(piece.piece_id, uname)
         return piece.piece_id
 
+    @_mutates
     def close_piece(self, piece_id: str) -> None:
         """
         After calling this function, 'merge_unlocked_pieces' could be called to
         potentially merge the piece with other unlocked pieces.
         """
-        self.get_piece(piece_id).owner = ""
+        self.set_owner(piece_id, "")
+
+        # In add buffer mode, move a block owned by the lock into the add
+        # buffer. Its content is unchanged, so its version is kept.
+        block_id = self.get_piece(piece_id).block_id
+        block = self.blocks[block_id]
+        if self._add is not None and block_id and isinstance(block, list):
+            start = len(self._add)
+            self._add.extend(block)
+            self.blocks[block_id] = BlockView(self._add, start, len(block))
+            self._add_live += len(block)
+            self._frozen_blocks.discard(block_id)
+
+    def unlock_piece(self, piece_id: str) -> List[str]:
+        """
+        Unlocks the given piece, gives it a new id and merges it with its
+        unlocked neighbours. Returns the ids of the pieces which reference a
+        new block after merging, see 'merge_unlocked_pieces'.
+        """
+        self.close_piece(piece_id)
+        new_id = self.renew_piece_id(piece_id)
+        return self.merge_unlocked_pieces(new_id)
 
-    def set_piece_content(self, piece_id: str, lines: List[str]) -> None:
+    @_mutates
+    def set_owner(self, piece_id: str, uname: str) -> None:
+        """
+        Change the owner of the given piece. An empty owner unlocks it.
+        """
+        piece = self.get_piece(piece_id)
+
+        self._locks[piece.owner].discard(piece_id)
+        piece.owner = uname
+        if uname:
+            self._locks[uname].add(piece_id)
+        self._lock_version += 1
+
+    def get_locks(self, uname: str) -> List[str]:
+        """
+        Return the ids of the pieces locked by the given user.
+        """
+        return [piece_id for piece_id in self._locks.get(uname, ())
+                if self._pieces[piece_id].owner == uname]
+
+    def _get_lock_order(self) -> List[str]:
+        """
+        Return the ids of all locks in table order, cached until a lock is
+        added, removed or renamed.
+        """
+        if (self._lock_order is None
+                or self._lock_order[0] != self._lock_version):
+            lock_ids = [piece_id for owner, piece_ids in self._locks.items()
+                        for piece_id in piece_ids
+                        if self._pieces[piece_id].owner == owner]
+            lock_ids.sort(key=self.get_piece_index)
+            self._lock_order = (self._lock_version, lock_ids)
+
+        return self._lock_order[1]
+
+    def get_locked_ranges(self) -> List[Tuple[int, int, str]]:
+        """
+        Return the (start row, length, piece id) of every lock, sorted by
+        row.
+        """
+        lock_ids = self._get_lock_order()
+        if self._tree:
+            return [(self.piece_to_row(piece_id),
+                     self._pieces[piece_id].length, piece_id)
+                    for piece_id in lock_ids]
+
+        # Find the rows of all locks in a single pass over the table.
+        wanted = set(lock_ids)
+        ranges = []
+        row = 0
+        for piece in self.table:
+            if piece.piece_id in wanted:
+                ranges.append((row, piece.length, piece.piece_id))
+            row += piece.length
+        return ranges
+
+    def is_range_free(self, row: int, length: int, uname: str = "") -> bool:
+        """
+        Return whether the rows 'row' up to 'row + length' do not overlap
+        with any lock, ignoring locks owned by 'uname'.
+        """
+        lock_ids = self._get_lock_order()
+        end = row + length
+
+        # Find the first lock starting at or after the end of the range by
+        # bisecting the locks in table order, looking up only the rows of
+        # the probed locks.
+        low, high = 0, len(lock_ids)
+        while low < high:
+            middle = (low + high) // 2
+            if self.piece_to_row(lock_ids[middle]) < end:
+                low = middle + 1
+            else:
+                high = middle
+
+        # Only locks starting before the end of the range can overlap, and
+        # locks do not overlap each other, so walk back from there.
+        for i in range(low - 1, -1, -1):
+            piece = self._pieces[lock_ids[i]]
+            if self.piece_to_row(piece.piece_id) + piece.length <= row:
+                break
+            if piece.owner != uname:
+                return False
+        return True
+
+    @_mutates
+    def set_piece_content(self, piece_id: str, lines: List[str],
+                          start: int = 0, end: int = None) -> int:
+        """
+        Replaces the lines 'start' up to 'end' of the content of the given
+        locked piece with 'lines'. By default, the whole content is replaced.
+        Raises a LockError if the piece is not locked, and a ValueError if
+        the range lies outside of the piece.
+
+        Returns the new version of the block of the piece.
+        """
         piece = self.get_piece(piece_id)
         if not piece.owner:
             raise LockError("Piece not locked.")
         assert piece.start == 0
-        piece.length = len(lines)
-        self.blocks[piece.block_id] = lines
 
-    def merge_unlocked_pieces(self) -> None:
+        if end is None:
+            end = piece.length
+        if not 0 <= start <= end <= piece.length:
+            raise ValueError("Range is outside of the piece.")
+
+        lines = self._intern(lines)
+        block = self.blocks[piece.block_id]
+        owned = (isinstance(block, list)
+                 and piece.block_id not in self._frozen_blocks)
+        if owned and (start, end) != (0, piece.length):
+            # Lock blocks are owned by the piece, so patch them in place.
+            block[start:end] = lines
+            self._versions[piece.block_id] += 1
+        elif self._add is not None:
+            # Keep the block as a list owned by the lock until it is closed,
+            # so later patches neither copy it nor grow the add buffer.
+            self._store_block(piece.block_id,
+                              list(block[:start]) + list(lines)
+                              + list(block[end:]), owned=True)
+        elif start == 0 and end == piece.length:
+            self._store_block(piece.block_id, lines)
+        else:
+            self._store_block(piece.block_id,
+                              block[:start] + list(lines) + block[end:])
+
+        self._set_length(piece, len(self.blocks[piece.block_id]))
+        return self._versions[piece.block_id]
+
+    def get_block_version(self, block_id: int) -> int:
+        """
+        Return the version of the given block, which is increased whenever
+        the content of the block changes.
+        """
+        return self._versions[block_id]
+
+    def _block_bases(self) -> List[Sequence[str]]:
+        """
+        Return the distinct sequences underlying the blocks, including the
+        whole add buffer.
+        """
+        bases: Dict[int, Sequence[str]] = {}
+        for block in list(self.blocks.values()):
+            base = block.base if isinstance(block, BlockView) else block
+            bases[id(base)] = base
+        return list(bases.values())
+
+    def interned_lines(self) -> Iterator[str]:
         """
-        This function merges unlocked pieces by stitching the file and turning
+        Iterate over the lines held by the blocks, except for memory mapped
+        ones, which are never interned. Used by LineStore.prune, possibly
+        from another thread.
+        """
+        for base in self._block_bases():
+            if not isinstance(base, MappedLines):
+                yield from base
+
+    def memory_usage(self) -> Dict[str, int]:
+        """
+        Return statistics on the memory use and fragmentation of the table:
+        - "pieces", "blocks", "dead_blocks" and "locks": the number of pieces,
+          blocks, unused blocks not cleared yet and locked pieces;
+        - "rows": the length of the file;
+        - "mergeable_pieces": see 'fragmentation';
+        - "table_bytes": the size of the pieces and their ids, and of the
+          list or tree holding them;
+        - "block_bytes": the size of the lines and line lists held by the
+          blocks (including the whole add buffer), counting every line once;
+        - "mapped_bytes": the size of memory mapped files, which are only
+          read from disk on demand;
+        - "unique_bytes" and "shared_bytes": see LineStore.intern.
+
+        Lines interned in a shared LineStore are counted for every table
+        which refers to them.
+        """
+        seen_lines: Set[int] = set()
+        block_bytes = mapped_bytes = 0
+        for base in self._block_bases():
+            if isinstance(base, MappedLines):
+                mapped_bytes += base.size
+                continue
+
+            block_bytes += sys.getsizeof(base)
+            for line in base:
+                if id(line) not in seen_lines:
+                    seen_lines.add(id(line))
+                    block_bytes += sys.getsizeof(line)
+
+        table_bytes = (self.table.size_bytes()
+                       if isinstance(self.table, PieceTree)
+                       else sys.getsizeof(self.table))
+        for piece in self.table:
+            table_bytes += (sys.getsizeof(piece)
+                            + sys.getsizeof(piece.piece_id))
+
+        return {
+            "pieces": len(self.table),
+            "blocks": len(self.blocks),
+            "dead_blocks": len(self._dead_blocks),
+            "locks": sum(len(ids) for ids in self._locks.values()),
+            "rows": len(self),
+            "mergeable_pieces": self.fragmentation(),
+            "table_bytes": table_bytes,
+            "block_bytes": block_bytes,
+            "mapped_bytes": mapped_bytes,
+            "unique_bytes": self.line_stats["unique_bytes"],
+            "shared_bytes": self.line_stats["shared_bytes"],
+        }
+
+    def _join_unlocked(self, index: int) -> Tuple[bool, bool]:
+        """
+        Tries to join the unlocked pieces at 'index' and 'index + 1' into the
+        first of the two. Pieces which are contiguous within the same block
+        are joined without copying. Other pieces are only joined when their
+        combined length is at most MERGE_COPY_LIMIT, by copying both into a
+        new block.
+
+        Returns whether the pieces were joined, and whether a new block was
+        created for them.
+        """
+        left, right = self.table[index], self.table[index + 1]
+        if left.owner or right.owner:
+            return False, False
+
+        if (left.block_id == right.block_id
+                and left.start + left.length == right.start):
+            self._pop_piece(index + 1)
+            self._set_length(left, left.length + right.length)
+            return True, False
+
+        if left.length + right.length > self.MERGE_COPY_LIMIT:
+            return False, False
+
+        lines = self._get_piece_lines(left) + self._get_piece_lines(right)
+        self._pop_piece(index + 1)
+        self._set_block(left, self._insert_block(lines), 0)
+        self._set_length(left, len(lines))
+        return True, True
+
+    @_mutates
+    def merge_unlocked_pieces(self, piece_id: str = None) -> List[str]:
+        """
+        Merges unlocked pieces into larger pieces.
+
+        If 'piece_id' is given, only the specified (unlocked) piece is merged
+        with its unlocked neighbours, see '_join_unlocked'. Returns the ids of
+        the pieces which now reference a new block, of which the content should
+        be sent to the clients. Restitching the 'orig' block is deferred to a
+        call without 'piece_id'.
+
+        Otherwise, this function stitches the whole file and turns
         neighbouring unlocked pieces into a single piece referencing the new
-        orig block (with id 0).
+        orig block (with id 0). Returns an empty list, the orig block itself
+        has changed in this case.
 
         After calling this function, 'clear_unused_blocks' should be called
         to erase the removed blocks from memory.
         """
+        if piece_id is None:
+            self._restitch()
+            return []
+
+        index = self.get_piece_index(piece_id)
+        copied = False
+
+        # Join with the next piece first, so 'index' remains valid.
+        if index + 1 < len(self.table):
+            _, copied = self._join_unlocked(index)
+
+        if index > 0:
+            joined, copied_prev = self._join_unlocked(index - 1)
+            copied = copied or copied_prev
+            if joined:
+                index -= 1
+
+        return [self.table[index].piece_id] if copied else []
+
+    def _restitch(self) -> None:
+        """
+        Stitches the file into a new orig block, and merges all neighbouring
+        unlocked pieces into pieces referencing it.
+        """
         new_orig = self.get_lines()
 
         cur_pos = 0
@@ -383,17 +1170,123 @@ class PieceTable:
 
             cur_pos += piece.length
 
-        self.table = [piece for piece in self.table if piece.piece_id]
+        self.table = self._new_table([piece for piece in self.table
+                                      if piece.piece_id])
         self.blocks[0] = new_orig
+        self._versions[0] += 1
+        self._reindex()
+
+    @_mutates
+    def defragment(self, keep: Iterable[str] = ()) -> List[str]:
+        """
+        Merges every run of neighbouring unlocked pieces into a single piece,
+        which keeps the id of the first piece of the run. Pieces of which the
+        id is in 'keep' are not merged into the piece before them, so these
+        ids (and offsets within them) stay valid.
 
+        Runs which are contiguous within a single block are merged without
+        copying, other runs are copied into a new block. Returns the ids of
+        the pieces which reference a new block.
+
+        After calling this function, 'clear_unused_blocks' should be called
+        to erase the removed blocks from memory.
+        """
+        keep = set(keep)
+        pieces: List[Piece] = []
+        changed: List[str] = []
+        run: List[Piece] = []
+
+        def flush() -> None:
+            if len(run) < 2:
+                pieces.extend(run)
+                return
+
+            head = run[0]
+            length = sum(piece.length for piece in run)
+            if all(piece.block_id == head.block_id
+                   and piece.start == prev.start + prev.length
+                   for prev, piece in zip(run, run[1:])):
+                pieces.append(Piece(head.piece_id, head.block_id, head.start,
+                                    length, ""))
+            else:
+                lines = itertools.chain.from_iterable(
+                    self._get_piece_lines(piece) for piece in run)
+                block_id = self._insert_block(lines)
+                pieces.append(Piece(head.piece_id, block_id, 0, length, ""))
+                changed.append(head.piece_id)
+
+        for piece in self.table:
+            if piece.owner or piece.piece_id in keep:
+                flush()
+                run = []
+            if piece.owner:
+                pieces.append(piece)
+            else:
+                run.append(piece)
+        flush()
+
+        if len(pieces) < len(self.table):
+            self.table = self._new_table(pieces)
+            self._reindex()
+        return changed
+
+    def fragmentation(self) -> int:
+        """
+        Return the number of unlocked pieces directly following another
+        unlocked piece, which 'defragment' would merge into it.
+        """
+        count = 0
+        prev_owner = None
+        for piece in self.table:
+            if prev_owner == "" and not piece.owner:
+                count += 1
+            prev_owner = piece.owner
+        return count
+
+    @_mutates
     def clear_unused_blocks(self) -> List[int]:
         """
         Removes all unused blocks from the 'blocks' dictionary, and returns
         the block id's of the blocks which were removed from it.
-        """
-        used = {p.block_id for p in self.table} | {0}
-        unused = {k for k in self.blocks if k not in used}
-
-        self.blocks = {k: v for k, v in self.blocks.items() if k in used}
 
-        return list(unused)
+        Only blocks which became unused since the last call are checked. In
+        add buffer mode, the add buffer is compacted here once enough of its
+        lines are unused.
+        """
+        unused = sorted(b for b in self._dead_blocks
+                        if b not in self._block_refs and b in self.blocks
+                        and b != 0)
+        self._dead_blocks = set()
+
+        for block_id in unused:
+            block = self.blocks.pop(block_id)
+            self._versions.pop(block_id, None)
+            if self._is_add_view(block):
+                self._add_live -= len(block)
+
+        if self._add is not None:
+            garbage = len(self._add) - self._add_live
+            if garbage > max(self._add_live, self.ADD_BUFFER_MIN_GARBAGE):
+                self.compact_add_buffer()
+
+        return unused
+
+    @_mutates
+    def compact_add_buffer(self) -> None:
+        """
+        Rebuilds the add buffer from the lines which are still in use, and
+        lets the blocks refer to their new location. The old views are left
+        untouched, as snapshots may still be reading them.
+        """
+        if self._add is None:
+            return
+
+        old_add, new_add = self._add, []
+        for block_id, block in list(self.blocks.items()):
+            if isinstance(block, BlockView) and block.base is old_add:
+                start = len(new_add)
+                new_add.extend(block)
+                self.blocks[block_id] = BlockView(new_add, start, len(block))
+
+        self._add = new_add
+        self._add_live = len(new_add)
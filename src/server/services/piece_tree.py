@@ -0,0 +1,359 @@
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import itertools
+import random
+import sys
+from .piece import Piece
+
+
+class _Node:
+    """
+    Node of the piece tree. Besides the piece itself, every node caches the
+    number of pieces and the number of rows within its subtree.
+    """
+    __slots__ = ('piece', 'priority', 'left', 'right', 'parent', 'size',
+                 'rows')
+
+    def __init__(self, piece: Piece, priority: float) -> None:
+        self.piece = piece
+        self.priority = priority
+        self.left: Optional[_Node] = None
+        self.right: Optional[_Node] = None
+        self.parent: Optional[_Node] = None
+        self.size = 1
+        self.rows = piece.length
+
+
+def _size(node: Optional[_Node]) -> int:
+    return node.size if node else 0
+
+
+def _rows(node: Optional[_Node]) -> int:
+    return node.rows if node else 0
+
+
+def _update(node: _Node) -> None:
+    """
+    Recompute the cached subtree values of a node and fix the parent pointers
+    of its children.
+    """
+    node.size = 1 + _size(node.left) + _size(node.right)
+    node.rows = node.piece.length + _rows(node.left) + _rows(node.right)
+    if node.left:
+        node.left.parent = node
+    if node.right:
+        node.right.parent = node
+
+
+def _split(node: Optional[_Node],
+           count: int) -> Tuple[Optional[_Node], Optional[_Node]]:
+    """
+    Split the subtree into a tree containing the first 'count' pieces and a
+    tree containing the rest.
+    """
+    if node is None:
+        return None, None
+
+    if _size(node.left) < count:
+        left, right = _split(node.right, count - _size(node.left) - 1)
+        node.right = left
+        _update(node)
+        node.parent = None
+        return node, right
+    else:
+        left, right = _split(node.left, count)
+        node.left = right
+        _update(node)
+        node.parent = None
+        return left, node
+
+
+def _merge(left: Optional[_Node], right: Optional[_Node]) -> Optional[_Node]:
+    """
+    Concatenate two subtrees, keeping the heap order on the priorities.
+    """
+    if left is None:
+        return right
+    if right is None:
+        return left
+
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _update(left)
+        left.parent = None
+        return left
+    else:
+        right.left = _merge(left, right.left)
+        _update(right)
+        right.parent = None
+        return right
+
+
+class PieceTree:
+    """
+    Balanced order-statistic tree (a randomised treap) over the pieces of a
+    piece table, augmented with the number of rows in every subtree.
+
+    It behaves like the list of pieces it replaces (indexing, slicing,
+    iteration, insertion and removal), but additionally supports looking up
+    the piece at a given row, the starting row of a piece and the total
+    length of the file in O(log n).
+
+    Whenever the length of a piece in the tree is changed, 'refresh' has to be
+    called for that piece to keep the row counts up to date. Every piece
+    object can only be present in the tree once.
+    """
+    def __init__(self, pieces: Iterable[Piece] = ()) -> None:
+        self._root: Optional[_Node] = None
+        self._nodes: Dict[int, _Node] = {}
+        self._root = self._build(list(pieces))
+
+    def _new_node(self, piece: Piece) -> _Node:
+        node = _Node(piece, random.random())
+        self._nodes[id(piece)] = node
+        return node
+
+    def _build(self, pieces: List[Piece]) -> Optional[_Node]:
+        """
+        Build a balanced subtree from the given pieces in O(n). Priorities are
+        handed out in breadth first order, so that the heap order holds.
+        """
+        if not pieces:
+            return None
+
+        nodes = [self._new_node(piece) for piece in pieces]
+        priorities = sorted((node.priority for node in nodes), reverse=True)
+
+        def build(lo: int, hi: int) -> Optional[_Node]:
+            if lo >= hi:
+                return None
+            mid = (lo + hi) // 2
+            node = nodes[mid]
+            node.left = build(lo, mid)
+            node.right = build(mid + 1, hi)
+            _update(node)
+            return node
+
+        root = build(0, len(nodes))
+
+        level = [root]
+        priority_iter = iter(priorities)
+        while level:
+            for node in level:
+                node.priority = next(priority_iter)
+            level = [child for node in level
+                     for child in (node.left, node.right) if child]
+
+        root.parent = None
+        return root
+
+    def _node_at(self, index: int) -> _Node:
+        """
+        Return the node at the given (non-negative) index.
+        """
+        node = self._root
+        while node:
+            left_size = _size(node.left)
+            if index < left_size:
+                node = node.left
+            elif index == left_size:
+                return node
+            else:
+                index -= left_size + 1
+                node = node.right
+        raise IndexError("piece tree index out of range")
+
+    def _node_of(self, piece: Piece) -> _Node:
+        node = self._nodes.get(id(piece))
+        if node is None or node.piece is not piece:
+            raise ValueError("Piece is not in the piece tree.")
+        return node
+
+    def _normalise_index(self, index: int) -> int:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("piece tree index out of range")
+        return index
+
+    @staticmethod
+    def _successor(node: _Node) -> Optional[_Node]:
+        if node.right:
+            node = node.right
+            while node.left:
+                node = node.left
+            return node
+
+        while node.parent and node.parent.right is node:
+            node = node.parent
+        return node.parent
+
+    def __len__(self) -> int:
+        return _size(self._root)
+
+    def __iter__(self) -> Iterator[Piece]:
+        return self.iter_from(0)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return list(self)[key]
+            return list(itertools.islice(self.iter_from(start),
+                                         max(0, stop - start)))
+        return self._node_at(self._normalise_index(key)).piece
+
+    def __setitem__(self, key, value) -> None:
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise ValueError("Extended slices are not supported.")
+            stop = max(start, stop)
+
+            left, rest = _split(self._root, start)
+            middle, right = _split(rest, stop - start)
+            self._forget(middle)
+            self._root = _merge(_merge(left, self._build(list(value))), right)
+        else:
+            node = self._node_at(self._normalise_index(key))
+            del self._nodes[id(node.piece)]
+            node.piece = value
+            self._nodes[id(value)] = node
+            self.refresh(value)
+
+    def __delitem__(self, key) -> None:
+        if isinstance(key, slice):
+            self[key] = []
+        else:
+            self.pop(key)
+
+    def __reduce__(self):
+        # Send the tree over the wire as the plain list of pieces it replaces.
+        return list, (list(self),)
+
+    def __repr__(self) -> str:
+        return f"PieceTree({list(self)!r})"
+
+    def _forget(self, node: Optional[_Node]) -> None:
+        """
+        Remove all pieces in the given subtree from the node map.
+        """
+        stack = [node] if node else []
+        while stack:
+            node = stack.pop()
+            del self._nodes[id(node.piece)]
+            stack.extend(child for child in (node.left, node.right) if child)
+
+    def iter_from(self, index: int) -> Iterator[Piece]:
+        """
+        Iterate over the pieces starting at the given index.
+        """
+        if index >= len(self):
+            return
+        node: Optional[_Node] = self._node_at(index)
+        while node:
+            yield node.piece
+            node = self._successor(node)
+
+    def insert(self, index: int, piece: Piece) -> None:
+        """
+        Insert a piece before the given index, like list.insert.
+        """
+        if index < 0:
+            index = max(0, index + len(self))
+        index = min(index, len(self))
+
+        left, right = _split(self._root, index)
+        self._root = _merge(_merge(left, self._new_node(piece)), right)
+
+    def append(self, piece: Piece) -> None:
+        self.insert(len(self), piece)
+
+    def pop(self, index: int = -1) -> Piece:
+        """
+        Remove and return the piece at the given index.
+        """
+        index = self._normalise_index(index)
+
+        left, rest = _split(self._root, index)
+        node, right = _split(rest, 1)
+        self._root = _merge(left, right)
+
+        del self._nodes[id(node.piece)]
+        return node.piece
+
+    def remove(self, piece: Piece) -> None:
+        self.pop(self.index(piece))
+
+    def index(self, piece: Piece) -> int:
+        """
+        Return the position of the given piece object in the tree.
+        """
+        node = self._node_of(piece)
+        index = _size(node.left)
+        while node.parent:
+            if node.parent.right is node:
+                index += _size(node.parent.left) + 1
+            node = node.parent
+        return index
+
+    def row_of(self, piece: Piece) -> int:
+        """
+        Return the row at which the given piece object starts.
+        """
+        node = self._node_of(piece)
+        row = _rows(node.left)
+        while node.parent:
+            if node.parent.right is node:
+                row += _rows(node.parent.left) + node.parent.piece.length
+            node = node.parent
+        return row
+
+    def find_row(self, row: int) -> Tuple[Piece, int]:
+        """
+        Return the piece which contains the given row, together with the
+        offset of the row within this piece. Raises a ValueError when the row
+        is outside the file.
+        """
+        if row < 0 or row >= self.total_rows():
+            raise ValueError("Row number out of bounds.")
+
+        node = self._root
+        while node:
+            left_rows = _rows(node.left)
+            if row < left_rows:
+                node = node.left
+                continue
+
+            row -= left_rows
+            if row < node.piece.length:
+                return node.piece, row
+
+            row -= node.piece.length
+            node = node.right
+        raise ValueError("Row number out of bounds.")
+
+    def total_rows(self) -> int:
+        """
+        Return the sum of the lengths of all pieces.
+        """
+        return _rows(self._root)
+
+    def size_bytes(self) -> int:
+        """
+        Return the size of the tree itself: its nodes (including their
+        priorities) and the index of nodes by piece, but not the pieces.
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self._nodes)
+        for node in self._nodes.values():
+            size += sys.getsizeof(node) + sys.getsizeof(node.priority)
+        return size
+
+    def refresh(self, piece: Piece) -> None:
+        """
+        Update the row counts after the length of the given piece changed.
+        """
+        node: Optional[_Node] = self._node_of(piece)
+        while node:
+            node.rows = (node.piece.length + _rows(node.left)
+                         + _rows(node.right))
+            node = node.parent
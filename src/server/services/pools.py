@@ -0,0 +1,115 @@
+from typing import Callable, Dict, Optional, Tuple
+from concurrent.futures import Executor, ProcessPoolExecutor, \
+    ThreadPoolExecutor
+import asyncio
+import time
+
+# Number of workers of the pools of every service (see WorkerPools).
+THREAD_POOL_WORKERS = 8
+PROCESS_POOL_WORKERS = 2
+STREAM_POOL_WORKERS = 32
+
+
+def _timed_call(fn: Callable, args: Tuple, submitted: float) -> Tuple:
+    """
+    Call the function on a pool worker, and return its result and the
+    exception it raised (if any), together with the time it spent waiting
+    in the queue of the pool and running.
+    """
+    started = time.time()
+    try:
+        result, error = fn(*args), None
+    except Exception as e:
+        result, error = None, e
+    return result, error, started - submitted, time.time() - started
+
+
+class WorkerPools:
+    """
+    Pools which run blocking and CPU-heavy work off the event loop of a
+    service:
+    - "thread" for blocking calls, such as file I/O;
+    - "process" for CPU-heavy calls, created on first use. The function,
+      its arguments and its result must be picklable;
+    - "stream" for long-running calls which mostly wait, such as building
+      an archive while it is sent, so they do not hold up the thread pool.
+      Its threads are only started when needed.
+
+    The time calls spend in the queue of a pool and running is recorded,
+    see 'stats'.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        self._executors: Dict[str, Optional[Executor]] = {
+            "thread": ThreadPoolExecutor(THREAD_POOL_WORKERS),
+            "process": None,
+            "stream": ThreadPoolExecutor(STREAM_POOL_WORKERS)
+        }
+        self._closed = False
+        # Number of calls, calls in progress, total and maximum queue time
+        # and total run time of every pool.
+        self._stats: Dict[str, Dict[str, float]] = {
+            name: {"calls": 0, "pending": 0, "queue_time": 0.0,
+                   "max_queue_time": 0.0, "run_time": 0.0}
+            for name in self._executors}
+
+    def executor(self, pool: str) -> Executor:
+        """
+        Return the executor of the given pool. Raises a KeyError for unknown
+        pools, and a RuntimeError once the pools have been shut down.
+        """
+        executor = self._executors[pool]
+        if self._closed:
+            raise RuntimeError("The worker pools have been shut down.")
+        if executor is None:
+            executor = self._executors[pool] = ProcessPoolExecutor(
+                PROCESS_POOL_WORKERS)
+        return executor
+
+    async def run(self, fn: Callable, *args, pool: str = "thread"):
+        """
+        Run the function on the given pool, and return its result on the
+        event loop. Exceptions raised by the function are raised here, after
+        the call has been recorded.
+        """
+        executor = self.executor(pool)
+        stats = self._stats[pool]
+        stats["pending"] += 1
+        times = None
+        try:
+            result, error, *times = await self._loop.run_in_executor(
+                executor, _timed_call, fn, args, time.time())
+        finally:
+            # Calls which were cancelled or broke the pool are counted, but
+            # their times are unknown.
+            stats["pending"] -= 1
+            stats["calls"] += 1
+            if times:
+                queue_time, run_time = times
+                stats["queue_time"] += queue_time
+                stats["max_queue_time"] = max(stats["max_queue_time"],
+                                              queue_time)
+                stats["run_time"] += run_time
+
+        if error is not None:
+            raise error
+        return result
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Return the statistics of every pool: the number of finished calls
+        (including failed ones), the number of calls queued or running, the
+        total and maximum time calls waited in the queue, and their total run
+        time, in seconds.
+        """
+        return {name: dict(stats) for name, stats in self._stats.items()}
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Shut down all pools. Calls which are queued or running are finished
+        first; new calls raise a RuntimeError.
+        """
+        self._closed = True
+        for executor in self._executors.values():
+            if executor is not None:
+                executor.shutdown(wait)
@@ -1,9 +1,40 @@
+from .blocks import MappedLines
 from .cursor import Cursor
+from .journal import Journal
+from .line_store import LineStore
 from .piece_table import PieceTable
-from .typedefs import LockError
-from typing import Dict, List, Tuple, Optional
+from .typedefs import LockError, VersionError
+from typing import (Any, Dict, List, Tuple, Optional, Sequence, Iterable,
+                    Iterator)
+import dataclasses
+import difflib
+import hashlib
+import itertools
 import os
-import uuid
+import shutil
+import tempfile
+import urllib.parse
+
+# Owner of the temporary locks used to apply changes made on disk.
+DISK_OWNER = "\0disk"
+
+# (row, length, new row, new length) regions in which two lists of lines
+# differ, see ServerFile._diff_regions.
+Regions = List[Tuple[int, int, int, int]]
+
+
+@dataclasses.dataclass
+class DiskChanges:
+    """
+    A file changed on disk by another program: its new state, hash and
+    lines, and the unsaved edits and the changes on disk, both as regions
+    of the previous content on disk. See ServerFile.read_disk_changes.
+    """
+    disk_state: Tuple[int, int]
+    saved_hash: bytes
+    lines:      List[str]
+    edits:      Regions
+    hunks:      Regions
 
 
 class ServerFile:
@@ -14,13 +45,49 @@ class ServerFile:
     - Cursor/Client list
     - Storage of file path
     - Saving from and loading to disk functionality
+
+    If 'tree' is set, the piece table is backed by a balanced tree, which
+    keeps cursor remapping fast for files with many pieces. If 'add_buffer'
+    is set, the piece table stores new lines in a shared add buffer.
+
+    Files of at least 'mmap_threshold' bytes are not read into memory, but
+    are memory mapped as the orig block (see MappedLines). If a 'line_store'
+    is given, the lines of the file are interned in it (see LineStore).
+
+    If a 'journal_dir' is given, all edits are recorded in a journal within
+    it (see Journal) until they are saved, and unsaved edits found in the
+    journal are replayed when the file is loaded.
     """
-    def __init__(self, root: str, path: str) -> None:
+    def __init__(self, root: str, path: str, tree: bool = False,
+                 add_buffer: bool = False,
+                 mmap_threshold: Optional[int] = None,
+                 line_store: Optional[LineStore] = None,
+                 journal_dir: Optional[str] = None) -> None:
         self.root: str = root
         self.path_relative: str = path
+        self.tree: bool = tree
+        self.add_buffer: bool = add_buffer
+        self.mmap_threshold: Optional[int] = mmap_threshold
+        self.line_store: Optional[LineStore] = line_store
+        self.journal_dir: Optional[str] = journal_dir
+        self.journal: Optional[Journal] = None
         self.pt: PieceTable
         self.cursors: Dict[str, Cursor] = {}
         self.is_saved: bool
+        # Number of edits so far, to tell whether a save is still current.
+        self.edit_count: int = 0
+        # Hash of the content on disk, if known (see 'content_hash'), and
+        # the size and modification time of the file when it was last loaded
+        # or written.
+        self.saved_hash: Optional[bytes] = None
+        self.disk_state: Optional[Tuple[int, int]] = None
+        # Content of the file on disk when it was last loaded or written, to
+        # tell the changes made on disk apart from the unsaved edits. Kept as
+        # a frozen list of line sequences (see PieceTable.freeze) rather than
+        # a snapshot, so edits do not copy the piece table after every save.
+        self.disk_content: List[Sequence[str]]
+        # Whether the file has been removed, so pending saves are dropped.
+        self.is_removed: bool = False
 
         self.load_from_disk()
 
@@ -33,27 +100,334 @@ class ServerFile:
         Loads the file from disk and creates the piece table object.
         """
         file_path = os.path.join(self.root, self.path_relative)
-        with open(file_path) as f:
-            file_list: List[str] = list(f)
+        file_list: Sequence[str]
+
+        if (self.mmap_threshold is not None
+                and os.path.getsize(file_path) >= self.mmap_threshold):
+            file_list = MappedLines(file_path)
+        else:
+            with open(file_path) as f:
+                file_list = list(f)
+
+        self.disk_state = Journal.disk_state(file_path)
+        records = []
+        if self.journal_dir is not None:
+            self.journal = Journal(self._journal_path())
+            records = self.journal.open(self.disk_state)
+
+        disk_lines: Optional[List[str]] = None
+        if records:
+            # The rows in the journal refer to the piece table, which
+            # represents an empty file as a single empty line.
+            disk_lines = list(file_list) or ["\n"]
+            file_list = list(disk_lines)
+            Journal.replay(file_list, records)
+            self.edit_count = records[-1]["seq"]
+
+        # Hashing a memory mapped file would read all of it.
+        if not records and not isinstance(file_list, MappedLines):
+            self.saved_hash = self.content_hash(file_list)
+
+        self.pt = PieceTable(file_list, tree=self.tree,
+                             add_buffer=self.add_buffer,
+                             line_store=self.line_store)
+        self.disk_content = (self.pt.freeze() if disk_lines is None
+                             else [disk_lines])
+        self.is_saved = not records
+
+    def _journal_path(self) -> str:
+        name = urllib.parse.quote(self.path_relative, safe='')
+        return os.path.join(self.journal_dir, name + '.journal')
+
+    def close(self, discard: bool = False) -> None:
+        """
+        Closes the file when it is removed from memory. Unsaved edits are
+        kept in the journal to be recovered when the file is loaded again,
+        unless 'discard' is set.
+        """
+        if self.journal is not None:
+            if discard or self.is_saved:
+                self.journal.remove()
+            else:
+                self.journal.close()
+            self.journal = None
+
+    def reopen(self) -> None:
+        """
+        Reopens a closed file, which has been saved and has not changed on
+        disk since it was closed (see FileCache).
+        """
+        if self.journal_dir is not None:
+            file_path = os.path.join(self.root, self.path_relative)
+            self.journal = Journal(self._journal_path())
+            self.journal.open(Journal.disk_state(file_path))
 
-        self.pt = PieceTable(file_list)
-        self.is_saved = True
+    def _journal_edit(self, row: int, length: int, lines: List[str]) -> None:
+        if self.journal is not None:
+            self.journal.append(self.edit_count, row, length, lines)
 
     def save_to_disk(self) -> None:
         """
         Writes the current buffer to the file on disk, but does not change the
         file representation in RAM.
         """
+        edit_count = self.edit_count
+        self.write_snapshot(self.pt.snapshot(), self.path_relative)
+        self.checkpoint_journal(edit_count)
+        self.mark_saved(edit_count)
+
+    def write_snapshot(self, snapshot: PieceTable, path: str,
+                       skip_unchanged: bool = False) -> int:
+        """
+        Writes a snapshot of the piece table (see PieceTable.snapshot) to the
+        given path relative to the root. As the snapshot is never changed by
+        edits, this can be called from a worker thread while the file is
+        being edited.
+
+        The content is written to a temporary file first, which then
+        atomically replaces the file, so the file is never left half written.
+        This also keeps memory mapped files intact (see MappedLines).
+
+        If 'skip_unchanged' is set, the file is not written when its content
+        hash equals that of the content last loaded or written. Returns the
+        number of characters written.
+        """
+        if (skip_unchanged and self.saved_hash is not None
+                and self.content_hash(snapshot.iter_lines())
+                == self.saved_hash):
+            return 0
+
+        file_path = os.path.join(self.root, path)
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(file_path),
+            prefix=f".{os.path.basename(file_path)}.", suffix=".tmp")
+
+        digest = hashlib.sha1()
+        size = 0
+
+        def hashed_lines() -> Iterator[str]:
+            nonlocal size
+            for line in snapshot.iter_lines():
+                digest.update(line.encode('utf-8', 'surrogatepass'))
+                size += len(line)
+                yield line
+
+        try:
+            with open(fd, 'w') as f:
+                f.writelines(hashed_lines())
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.exists(file_path):
+                shutil.copymode(file_path, temp_path)
+            os.replace(temp_path, file_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        self.saved_hash = digest.digest()
+        self.disk_state = Journal.disk_state(file_path)
+        self.disk_content = snapshot.freeze()
+        return size
+
+    @staticmethod
+    def content_hash(lines: Iterable[str]) -> bytes:
+        """
+        Returns the hash of the given content, used to skip saving content
+        which is already on disk.
+        """
+        digest = hashlib.sha1()
+        for line in lines:
+            digest.update(line.encode('utf-8', 'surrogatepass'))
+        return digest.digest()
+
+    def checkpoint_journal(self, edit_count: int) -> None:
+        """
+        Drops the edits up to the given edit count from the journal, after a
+        snapshot taken at that edit count has been written. Like
+        'write_snapshot', this can be called from a worker thread (see
+        Journal.checkpoint).
+        """
+        journal = self.journal
+        if journal is not None and self.disk_state is not None:
+            journal.checkpoint(self.disk_state, edit_count)
+
+    def mark_saved(self, edit_count: int) -> None:
+        """
+        Marks the file as saved after a snapshot taken at the given edit
+        count has been written, unless the file has been edited since.
+        """
+        if self.edit_count == edit_count:
+            self.is_saved = True
+
+    def is_mapped(self) -> bool:
+        """
+        Returns whether the piece table refers to a memory mapped file.
+        """
+        return any(isinstance(block, MappedLines)
+                   for block in self.pt.blocks.values())
+
+    def is_changed_on_disk(self) -> bool:
+        """
+        Returns whether the file on disk has been changed since it was last
+        loaded or written by this class.
+        """
+        file_path = os.path.join(self.root, self.path_relative)
+        try:
+            return Journal.disk_state(file_path) != self.disk_state
+        except OSError:
+            return False
+
+    def refresh_from_disk(self) -> List[str]:
+        """
+        Updates the file after it has been changed on disk by another program.
+        The changes between the previous and the new content on disk are
+        applied to the file, except where they overlap a lock or an unsaved
+        edit, in which case the content in memory is kept. The unsaved edits
+        are kept in the journal, on top of the new content on disk.
+
+        This is done in three steps, of which the first and the last can run
+        on a worker thread, as long as the file is not edited in the
+        meantime: 'read_disk_changes', 'apply_disk_changes' and
+        'journal_disk_changes'.
+
+        Returns the ids of the pieces which reference a new block.
+        """
+        changes = self.read_disk_changes()
+        changed = self.apply_disk_changes(changes)
+        self.journal_disk_changes(changes)
+        return changed
+
+    def read_disk_changes(self) -> DiskChanges:
+        """
+        Reads the file from disk, and compares it with the previous content
+        on disk and with the content in memory, without changing anything.
+        """
         file_path = os.path.join(self.root, self.path_relative)
+        disk_state = Journal.disk_state(file_path)
+        with open(file_path) as f:
+            disk_lines = list(f)
+        saved_hash = self.content_hash(disk_lines)
+
+        # The piece table represents an empty file as a single empty line.
+        disk_lines = disk_lines or ["\n"]
 
-        with open(file_path, 'w') as f:
-            for line in self.pt.get_lines():
-                f.write(line)
+        old_lines = list(itertools.chain.from_iterable(self.disk_content))
+        limit = PieceTable.DIFF_LINE_LIMIT
+        return DiskChanges(disk_state, saved_hash, disk_lines,
+                           self._diff_regions(old_lines, self.pt.get_lines(),
+                                              limit),
+                           self._diff_regions(old_lines, disk_lines, limit))
+
+    def apply_disk_changes(self, changes: DiskChanges) -> List[str]:
+        """
+        Applies the changes on disk which do not overlap a lock or an unsaved
+        edit, see 'refresh_from_disk'.
+        """
+        self.disk_state = changes.disk_state
+        self.saved_hash = changes.saved_hash
+        cursor_lines = self.get_cursor_rows()
+        changed: List[str] = []
+
+        # Replace from the end, so the rows of earlier hunks stay valid.
+        for row, length, disk_row, disk_length in reversed(changes.hunks):
+            if any(edit_row < row + length and row < edit_row + edit_length
+                   for edit_row, edit_length, _, _ in changes.edits):
+                continue
+
+            # Move the hunk past the rows added or removed by earlier edits.
+            row += sum(new_length - edit_length
+                       for edit_row, edit_length, _, new_length
+                       in changes.edits
+                       if edit_row + edit_length <= row)
+            piece_id, offset = self.pt.row_to_piece(row)
+            try:
+                lock_id = self.pt.put_piece(piece_id, offset, length,
+                                            DISK_OWNER)
+            except ValueError:
+                continue
 
-        self.is_saved = True
+            self.pt.set_piece_content(
+                lock_id, changes.lines[disk_row:disk_row + disk_length])
+            self.pt.close_piece(lock_id)
+            piece_id = self.pt.renew_piece_id(lock_id)
+            changed += self.pt.merge_unlocked_pieces(piece_id) + [piece_id]
+
+        last_row = len(self.pt) - 1
+        self.update_cursors({uname: min(row, last_row)
+                             for uname, row in cursor_lines.items()})
+        if changed:
+            self.edit_count += 1
+
+        return [piece_id for piece_id in dict.fromkeys(changed)
+                if piece_id in self.pt]
+
+    def journal_disk_changes(self, changes: DiskChanges) -> None:
+        """
+        Marks the file as saved if it equals the new content on disk, and
+        otherwise restarts the journal with whatever still differs from it,
+        after the changes have been applied.
+        """
+        lines = self.pt.get_lines()
+        unsaved = self._diff_regions(changes.lines, lines,
+                                     PieceTable.DIFF_LINE_LIMIT)
+        self.is_saved = not unsaved
+        self.disk_content = [changes.lines]
+        if self.journal is not None:
+            self.journal.restart(self.disk_state, [
+                {"seq": self.edit_count, "row": row, "length": length,
+                 "lines": lines[new_row:new_row + new_length]}
+                for row, length, new_row, new_length in reversed(unsaved)])
+
+    @staticmethod
+    def _diff_regions(old: List[str], new: List[str], limit: int
+                      ) -> Regions:
+        """
+        Returns the (row, length, new row, new length) regions in which the
+        old and new lines differ, where every region covers at least one old
+        row. If more than 'limit' lines differ, a single region between the
+        common start and end is returned.
+        """
+        prefix = 0
+        for old_line, new_line in zip(old, new):
+            if old_line != new_line:
+                break
+            prefix += 1
+
+        suffix = 0
+        max_suffix = min(len(old), len(new)) - prefix
+        while suffix < max_suffix and old[-1 - suffix] == new[-1 - suffix]:
+            suffix += 1
+
+        old_mid = old[prefix:len(old) - suffix]
+        new_mid = new[prefix:len(new) - suffix]
+        if not old_mid and not new_mid:
+            return []
+
+        if len(old_mid) + len(new_mid) <= limit:
+            matcher = difflib.SequenceMatcher(None, old_mid, new_mid,
+                                              autojunk=False)
+            opcodes = [(i1 + prefix, i2 + prefix, j1 + prefix, j2 + prefix)
+                       for tag, i1, i2, j1, j2 in matcher.get_opcodes()
+                       if tag != 'equal']
+        else:
+            opcodes = [(prefix, len(old) - suffix, prefix, len(new) - suffix)]
+
+        regions = []
+        for i1, i2, j1, j2 in opcodes:
+            # Extend insertions with an equal neighbouring row, so there is
+            # a row to lock.
+            if i1 == i2:
+                if i2 < len(old):
+                    i2, j2 = i2 + 1, j2 + 1
+                else:
+                    i1, j1 = i1 - 1, j1 - 1
+            regions.append((i1, i2 - i1, j1, j2 - j1))
+        return regions
 
     def change_file_path(self, new_path: str) -> None:
         self.path_relative = new_path
+        if self.journal is not None:
+            self.journal.move(self._journal_path())
 
     #
     # LOCKS
@@ -82,24 +456,60 @@ class ServerFile:
         return lock_id
 
     def insert_lock_after_piece(self, piece_id: str, uname: str) -> str:
-        return self.pt.put_piece_after(piece_id, uname)
+        """
+        Inserts a new locked empty row after the given piece, or at the start
+        of the file if 'piece_id' is empty, and moves the cursors below it
+        one row down. Returns the id of the new lock.
+        """
+        cursor_lines = self.get_cursor_rows()
+        lock_id, row = self._insert_row(piece_id, uname)
+        self.update_cursors(self._shift_rows(cursor_lines, row))
+        return lock_id
+
+    def _insert_row(self, piece_id: str, uname: str) -> Tuple[str, int]:
+        """
+        Inserts a locked empty row after the given piece, and returns the id
+        of the lock and the row inserted. The new row is an edit like any
+        other, so it is recorded in the journal.
+        """
+        if piece_id == "":
+            row = 0
+        else:
+            row = (self.pt.piece_to_row(piece_id)
+                   + self.pt.get_piece(piece_id).length)
+        lock_id = self.pt.put_piece_after(piece_id, uname)
+        self.is_saved = False
+        self.edit_count += 1
+        self._journal_edit(row, 0, ["\n"])
+        return lock_id, row
+
+    @staticmethod
+    def _shift_rows(cursor_lines: Dict[str, int], row: int) -> Dict[str, int]:
+        """
+        Returns the cursor rows after a row has been inserted at 'row'.
+        """
+        return {uname: line + 1 if line >= row else line
+                for uname, line in cursor_lines.items()}
 
-    def remove_lock(self, lock_id: str) -> None:
+    def remove_lock(self, lock_id: str) -> List[str]:
         """
-        Removes the lock in the specified piece, and merges unlocked pieces
-        back into the 'orig' block at index 0. As a result, multiple pieces
-        may be changed. Raises a ValueError if cursor repositioning fails.
+        Removes the lock in the specified piece, and merges the piece with its
+        unlocked neighbours. As a result, multiple pieces may be changed.
+        Raises a ValueError if cursor repositioning fails.
+
+        Returns the ids of the pieces which reference a new block after
+        merging, see PieceTable.merge_unlocked_pieces.
         """
         cursor_lines = self.get_cursor_rows()
 
-        self.pt.get_piece(lock_id).owner = ""
-        self.pt.get_piece(lock_id).piece_id = str(uuid.uuid4())
-        self.pt.merge_unlocked_pieces()
+        changed = self.pt.unlock_piece(lock_id)
 
         self.update_cursors(cursor_lines)
 
+        return changed
+
     def change_lock_owner(self, lock_id: str, uname: str) -> None:
-        self.pt.get_piece(lock_id).owner = uname
+        self.pt.set_owner(lock_id, uname)
 
     #
     # CURSORS
@@ -160,17 +570,25 @@ class ServerFile:
     def client_join(self, uname: str) -> None:
         self.cursors[uname] = Cursor(self.pt.table[0].piece_id, 0, 0)
 
-    def client_leave(self, uname: str) -> None:
+    def client_leave(self, uname: str) -> List[str]:
         """
         Removes the client from the file, as well as all locks which they own.
+
+        Returns the ids of the pieces which reference a new block after
+        removing the locks.
         """
-        for piece in self.pt.table:
-            if piece.owner == uname:
-                self.remove_lock(piece.piece_id)
+        locks = self.pt.get_locks(uname)
+
+        changed: List[str] = []
+        for lock_id in locks:
+            changed += self.remove_lock(lock_id)
 
         if uname in self.cursors:
             del self.cursors[uname]
 
+        return [piece_id for piece_id in dict.fromkeys(changed)
+                if piece_id in self.pt]
+
     def get_clients(self, exclude: List[str] = []) -> List[str]:
         return [uname for uname in self.cursors if uname not in exclude]
 
@@ -180,10 +598,157 @@ class ServerFile:
     def client_count(self) -> int:
         return len(self.cursors)
 
+    def defragment(self) -> List[str]:
+        """
+        Merges all neighbouring unlocked pieces, keeping the pieces in which
+        cursors are positioned, so the cursors remain valid. Returns the ids
+        of the pieces which reference a new block.
+        """
+        return self.pt.defragment(cursor.piece_id
+                                  for cursor in self.cursors.values())
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Returns the memory and fragmentation statistics of the piece table
+        (see PieceTable.memory_usage), together with the joined clients and
+        whether the file is saved.
+        """
+        stats: Dict[str, Any] = self.pt.memory_usage()
+        stats["clients"] = self.get_clients()
+        stats["is_saved"] = self.is_saved
+        return stats
+
+    #
+    # BATCHES
+    #
+
+    def apply_operations(self, uname: str, operations: List[Tuple]
+                         ) -> Tuple[List[Tuple[bool, Any]], List[str]]:
+        """
+        Applies a list of operations of the given user in one pass, where
+        every operation is one of:
+        - ("lock", start_piece_id, offset, length)
+        - ("insert", piece_id)
+        - ("unlock", lock_id)
+        - ("delta", piece_id, content)
+        - ("patch", piece_id, version, patch)
+
+        Cursors are remapped once for all lock changes, instead of once per
+        operation. A failing or malformed operation does not stop the others.
+
+        Returns a (success, result or error message) tuple per operation,
+        and the ids of all pieces of which the block has been added or
+        changed, for broadcasting them to the clients at once.
+        """
+        cursor_lines = self.get_cursor_rows()
+        results: List[Tuple[bool, Any]] = []
+        changed: List[str] = []
+
+        for op, *args in operations:
+            try:
+                if op == "lock":
+                    try:
+                        result = self.pt.put_piece(*args, uname)
+                    except ValueError:
+                        raise LockError("Lock creation has failed.")
+                    changed.append(result)
+                elif op == "insert":
+                    result, row = self._insert_row(*args, uname)
+                    cursor_lines = self._shift_rows(cursor_lines, row)
+                    changed.append(result)
+                elif op == "unlock":
+                    result = None
+                    changed += self.pt.unlock_piece(*args)
+                elif op in ("delta", "patch"):
+                    # Edits change the rows, so settle the cursors first.
+                    self.update_cursors(cursor_lines)
+                    if op == "delta":
+                        result = self.update_content(uname, *args)
+                    else:
+                        result = self.patch_content(uname, *args)
+                    cursor_lines = self.get_cursor_rows()
+                    changed.append(args[0])
+                else:
+                    raise ValueError(f"Unknown operation '{op}'.")
+            except (LockError, VersionError, ValueError) as e:
+                results.append((False, str(e)))
+            except (TypeError, IndexError, AttributeError):
+                results.append((False, f"Malformed operation '{op}'."))
+            else:
+                results.append((True, result))
+
+        self.update_cursors(cursor_lines)
+
+        return results, [piece_id for piece_id in dict.fromkeys(changed)
+                         if piece_id in self.pt]
+
     #
     # EDITS
     #
 
-    def update_content(self, uname: str, piece_id: str, content: str) -> None:
-        self.pt.set_piece_content(piece_id, content.splitlines(True))
+    @staticmethod
+    def _check_owner(owner: str, uname: str) -> None:
+        if not owner or owner != uname:
+            raise LockError("Piece is not locked by this user.")
+
+    def update_content(self, uname: str, piece_id: str, content: str) -> int:
+        """
+        Replaces the content of the given lock, and returns the new version
+        of its block.
+        """
+        piece = self.pt.get_piece(piece_id)
+        self._check_owner(piece.owner, uname)
+        if not isinstance(content, str):
+            raise ValueError("Content must be a string.")
+        row, length = self.pt.piece_to_row(piece_id), piece.length
+        lines = content.splitlines(True)
+
+        version = self.pt.set_piece_content(piece_id, lines)
+        self.is_saved = False
+        self.edit_count += 1
+        self._journal_edit(row, length, lines)
+        return version
+
+    def patch_content(self, uname: str, piece_id: str, version: int,
+                      patch: List[Tuple[int, int, str]]) -> int:
+        """
+        Applies a list of (start, end, content) operations to the content of
+        the given lock, each replacing the lines 'start' up to 'end' with the
+        lines in 'content'. Operations are applied in order, each to the
+        result of the previous one.
+
+        Raises a LockError if the lock does not belong to the user, a
+        VersionError if 'version' is not the current version of the block of
+        the lock, and a ValueError if an operation is malformed or can not be
+        applied. The file is only changed once the whole patch is checked.
+        Returns the new version of the block.
+        """
+        piece = self.pt.get_piece(piece_id)
+        self._check_owner(piece.owner, uname)
+        if self.pt.get_block_version(piece.block_id) != version:
+            raise VersionError("Patch is based on an outdated version.")
+
+        # Check all operations up front, so a patch is applied as a whole.
+        if not isinstance(patch, (list, tuple)):
+            raise ValueError("Patch must be a list of operations.")
+        for op in patch:
+            if not (isinstance(op, (list, tuple)) and len(op) == 3
+                    and all(type(i) is int for i in op[:2])
+                    and isinstance(op[2], str)):
+                raise ValueError("Patch operations must be [start, end, "
+                                 "content].")
+        patch = [(start, end, content.splitlines(True))
+                 for start, end, content in patch]
+        length = piece.length
+        for start, end, lines in patch:
+            if not 0 <= start <= end <= length:
+                raise ValueError("Patch range is outside of the piece.")
+            length += len(lines) - (end - start)
+
+        row = self.pt.piece_to_row(piece_id)
+        self.edit_count += 1
+        for start, end, lines in patch:
+            version = self.pt.set_piece_content(piece_id, lines, start, end)
+            self._journal_edit(row + start, end - start, lines)
         self.is_saved = False
+        return version
@@ -1,23 +1,49 @@
 import threading
 import inspect
 import Pyro4
-from typing import Dict, Any, Callable, List, Tuple
+from typing import Dict, Any, Callable, List, Optional, Tuple
 import uuid
 import time
 import asyncio
 from collections import defaultdict
+from .locks import HandlerLock, KeyLocks
+from .pools import WorkerPools
 from .typedefs import Address
 from .mixins import LoggerMixin
 import signal
 
 
-def message_type(msg_type: str):
+def message_type(msg_type: str, key: Callable[[Any], Any] = None,
+                 pool: str = None):
     """
     Decorator used with Service functions to signal
     which message type it handles.
+
+    Handlers are executed one at a time. When a key function is given,
+    it is called with the message content, e.g.
+        @message_type("file-delta", key=lambda content: content["file_path"])
+    and the handler only runs one at a time with handlers of the same key,
+    but concurrently with handlers of other keys. Messages of the same key
+    are handled in the order they were received.
+
+    Async handlers run on the event loop, so handlers of other keys only
+    run while a handler awaits; blocking work within them should be run
+    through Service._run_in_pool. Regular (non-async) handlers are run on
+    the given pool of the service (see Service._run_in_pool) while holding
+    the same locks: "thread" by default, or "stream" for handlers which
+    mostly wait. Handlers are methods of the service, which cannot be sent
+    to the "process" pool.
     """
+    if pool not in (None, "thread", "stream"):
+        raise ValueError(f"Handlers cannot run on pool {pool}.")
+
     def decorator(f):
+        is_async = inspect.iscoroutinefunction(f)
+        if pool and is_async:
+            raise ValueError("Async handlers cannot run on a pool.")
         f._msg_type = msg_type
+        f._msg_key = key
+        f._msg_pool = None if is_async else pool or "thread"
         return f
     return decorator
 
@@ -49,6 +75,8 @@ class Service(LoggerMixin):
     Inheriting classes can declare which message type a certain
     method accepts by adding the @message_type(<type>) decorator,
     where <type> is a string containing the message type name.
+    Handlers run one at a time, unless they are given a key function
+    (see message_type).
     """
     _running = True
     def __init__(self, msg_bus, logger):
@@ -68,7 +96,10 @@ class Service(LoggerMixin):
         self._waiting: Dict[str, List[Any]] = defaultdict(list)
 
         self._loop = asyncio.new_event_loop()
-        self._handler_lock: asyncio.Lock = asyncio.Lock(loop=self._loop)
+        self._handler_lock = HandlerLock(self._loop)
+        self._pools = WorkerPools(self._loop)
+        self._loop.set_default_executor(self._pools.executor("thread"))
+        self._key_locks = KeyLocks(self._handler_lock)
         self._msg_queue = asyncio.Queue(loop=self._loop)
         self._async_thread = threading.Thread(target=self._start_async_thread)
         self._async_thread.daemon = True
@@ -110,9 +141,56 @@ class Service(LoggerMixin):
                                      "by service {self.__class__.__name__}")
 
             if func:
-                coro = call_with_lock(msg, func)
+                handler = func
+                if func._msg_pool is not None:
+                    def pooled(msg, func=func):
+                        return self._run_in_pool(func, msg,
+                                                 pool=func._msg_pool)
+                    handler = pooled
+
+                key = self._message_key(msg, func)
+                if key is None:
+                    coro = call_with_lock(msg, handler)
+                else:
+                    coro = self._call_with_key_lock(msg, handler, key)
                 asyncio.create_task(coro)
 
+    @staticmethod
+    def _message_key(msg, func) -> Optional[Any]:
+        """
+        Return the key of the message for handlers with a key function, or
+        None when the handler has to run exclusively.
+        """
+        if func._msg_key is None:
+            return None
+        try:
+            return func._msg_key(msg["content"])
+        except (KeyError, TypeError):
+            return None
+
+    async def _call_with_key_lock(self, msg, fn, key) -> None:
+        """
+        Call a keyed handler, one at a time with the handlers of the same key
+        and never during an exclusive handler (see KeyLocks).
+        """
+        await self._key_locks.run(key, fn, msg)
+
+    async def _run_in_pool(self, fn: Callable, *args, pool: str = "thread"):
+        """
+        Run a blocking or CPU-heavy function on the "thread", "process" or
+        "stream" pool of the service (see WorkerPools), and return its
+        result on the event loop. Functions run on the process pool cannot
+        use the service itself.
+        """
+        return await self._pools.run(fn, *args, pool=pool)
+
+    def _get_pool_stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Return the queue and run time statistics of every pool, see
+        WorkerPools.stats.
+        """
+        return self._pools.stats()
+
     async def _wait_for_response(self, uuid: str):
         # should be called from a message handler (i.e. using await)
         fut = asyncio.get_event_loop().create_future()
@@ -148,6 +226,7 @@ class Service(LoggerMixin):
         print(f"{cls.__name__} service running")
         if start_request_loop:
             inst_d.requestLoop(lambda: Service._running)
+            inst._pools.shutdown()
 
     def get_wanted_messages(self):
         """
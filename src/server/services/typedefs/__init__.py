@@ -14,3 +14,10 @@ class LockError(Exception):
     Error to indicate the lock creation has failed.
     """
     pass
+
+
+class VersionError(Exception):
+    """
+    Error to indicate an edit was made against an outdated block version.
+    """
+    pass
@@ -0,0 +1,166 @@
+from typing import Dict, List, Tuple, Union
+import os
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+# A change within the watched directory: ("added", "removed" or "modified",
+# path relative to the root). Paths of directories end with a separator.
+Event = Tuple[str, str]
+
+
+def is_temp_file(path: str) -> bool:
+    """
+    Whether the path is a temporary file written while saving a file (see
+    ServerFile.write_snapshot), which is not part of the project.
+    """
+    name = os.path.basename(path)
+    return name.startswith('.') and name.endswith('.tmp')
+
+
+def _unique(events: List[Event]) -> List[Event]:
+    return [event for event in dict.fromkeys(events)
+            if not is_temp_file(event[1])]
+
+
+class PollingWatcher:
+    """
+    Watches a directory for changes by comparing the size and modification
+    time of all files with those of the previous poll.
+    """
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self._state = self._scan()
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        state = {}
+        for dir_path, dir_names, file_names in os.walk(self.root):
+            rel_path = os.path.relpath(dir_path, self.root)
+            rel_path = '' if rel_path == os.curdir else rel_path
+            for name in dir_names:
+                state[os.path.join(rel_path, name) + os.sep] = (0, 0)
+            for name in file_names:
+                path = os.path.join(rel_path, name)
+                try:
+                    stat = os.stat(os.path.join(dir_path, name))
+                except OSError:
+                    continue
+                state[path] = (stat.st_size, stat.st_mtime_ns)
+        return state
+
+    def poll(self) -> List[Event]:
+        """
+        Return the changes since the previous poll. Added paths are sorted
+        so directories come before their content.
+        """
+        old, new = self._state, self._scan()
+        self._state = new
+
+        events = [("removed", path) for path in old if path not in new]
+        events += [("added", path) for path in sorted(new, key=len)
+                   if path not in old]
+        events += [("modified", path) for path, state in new.items()
+                   if path in old and old[path] != state]
+        return _unique(events)
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher:
+    """
+    Watches a directory for changes using inotify, with a watch on every
+    directory within it. Files count as modified when they are closed after
+    writing or moved into place, so a file being written produces a single
+    event.
+    """
+    MASK = (flags.CREATE | flags.DELETE | flags.CLOSE_WRITE | flags.MOVED_FROM
+            | flags.MOVED_TO) if INotify else 0
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self._inotify = INotify()
+        self._dirs: Dict[int, str] = {}
+        self._watch_tree('')
+
+    def _watch_tree(self, path: str) -> List[Event]:
+        """
+        Watch the directory at the given path and all directories within,
+        and return its content as added events.
+        """
+        events = []
+        for dir_path, dir_names, file_names in os.walk(
+                os.path.join(self.root, path)):
+            rel_path = os.path.relpath(dir_path, self.root)
+            rel_path = '' if rel_path == os.curdir else rel_path
+            try:
+                wd = self._inotify.add_watch(dir_path, self.MASK)
+            except OSError:
+                continue
+            self._dirs[wd] = rel_path
+
+            events += [("added", os.path.join(rel_path, name) + os.sep)
+                       for name in dir_names]
+            events += [("added", os.path.join(rel_path, name))
+                       for name in file_names]
+        return events
+
+    def poll(self) -> List[Event]:
+        """
+        Return the changes since the previous poll, without blocking.
+        """
+        events: List[Event] = []
+        for event in self._inotify.read(timeout=0):
+            if event.mask & flags.IGNORED:
+                self._dirs.pop(event.wd, None)
+                continue
+            if event.wd not in self._dirs or not event.name:
+                continue
+
+            path = os.path.join(self._dirs[event.wd], event.name)
+            if event.mask & flags.ISDIR:
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    events.append(("added", path + os.sep))
+                    events += self._watch_tree(path)
+                elif event.mask & (flags.DELETE | flags.MOVED_FROM):
+                    events.append(("removed", path + os.sep))
+                    self._forget(path)
+            elif event.mask & (flags.DELETE | flags.MOVED_FROM):
+                events.append(("removed", path))
+            elif event.mask & flags.CREATE:
+                events.append(("added", path))
+            else:
+                events += [("added", path), ("modified", path)]
+        return _unique(events)
+
+    def _forget(self, path: str) -> None:
+        """
+        Stop tracking the watches of a directory which was moved away. The
+        watches of deleted directories are removed by the kernel.
+        """
+        prefix = path + os.sep
+        for wd, dir_path in list(self._dirs.items()):
+            if dir_path == path or dir_path.startswith(prefix):
+                del self._dirs[wd]
+                try:
+                    self._inotify.rm_watch(wd)
+                except OSError:
+                    pass
+
+    def close(self) -> None:
+        self._inotify.close()
+
+
+def create_watcher(root: str) -> Union[PollingWatcher, InotifyWatcher]:
+    """
+    Create an inotify watcher for the directory if inotify is available, or
+    a polling watcher otherwise.
+    """
+    if INotify is not None:
+        try:
+            return InotifyWatcher(root)
+        except OSError:
+            pass
+    return PollingWatcher(root)
@@ -27,8 +27,11 @@ def list_ser(obj):
     default, JSON serializable. They can be iterated over, however, and contain
     only JSON serializable objects. Therefore, we simply turn them into lists
     and pass them on to the JSON. This also works well client-side, as the
-    dataclasses replaced plain lists.
+    dataclasses replaced plain lists. Objects with an 'as_tuple' method
+    (pieces and cursors) are converted using it, which avoids iterating.
     """
+    if hasattr(obj, "as_tuple"):
+        return obj.as_tuple()
     return [*obj]
 
 
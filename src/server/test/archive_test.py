@@ -0,0 +1,167 @@
+from concurrent.futures import ThreadPoolExecutor
+import io
+import os
+import tarfile
+from services.archive import (ArchiveCache, ChunkedUpload, build_archive,
+                              iter_file_chunks, iter_tar_chunks, tree_hash)
+
+
+def test_iter_tar_chunks(tmp_path):
+    (tmp_path / 'a.txt').write_text("a" * 5000)
+    (tmp_path / 'dir').mkdir()
+    (tmp_path / 'dir' / 'b.txt').write_text("b")
+
+    chunks = list(iter_tar_chunks(str(tmp_path), 'project', 1000))
+    assert all(len(chunk) == 1000 for chunk in chunks[:-1])
+    assert 0 < len(chunks[-1]) <= 1000
+
+    with tarfile.open(fileobj=io.BytesIO(b"".join(chunks))) as tar:
+        assert sorted(tar.getnames()) == ['project', 'project/a.txt',
+                                          'project/dir', 'project/dir/b.txt']
+        assert tar.extractfile('project/a.txt').read() == b"a" * 5000
+
+
+def test_iter_tar_chunks_close(tmp_path):
+    (tmp_path / 'a.txt').write_text("a" * 100000)
+    chunks = iter_tar_chunks(str(tmp_path), 'project', 100, max_chunks=1)
+    assert len(next(chunks)) == 100
+    chunks.close()
+
+
+def test_iter_tar_chunks_start(tmp_path):
+    (tmp_path / 'a.txt').write_text("a" * 5000)
+    builds = []
+    with ThreadPoolExecutor(1) as pool:
+        chunks = iter_tar_chunks(str(tmp_path), 'project', 1000,
+                                 start=lambda fn: builds.append(
+                                     pool.submit(fn)))
+        # The build is started before the first chunk is requested.
+        assert len(builds) == 1
+        data = b"".join(chunks)
+
+    assert builds[0].done()
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        assert tar.extractfile('project/a.txt').read() == b"a" * 5000
+
+
+def make_tar(tmp_path):
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'src' / 'a.txt').write_text("a" * 30000)
+    (tmp_path / 'src' / 'dir').mkdir()
+    (tmp_path / 'src' / 'dir' / 'b.txt').write_text("b")
+    return b"".join(iter_tar_chunks(str(tmp_path / 'src'), 'project', 1000))
+
+
+def test_chunked_upload(tmp_path):
+    data = make_tar(tmp_path)
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+    entries = []
+
+    upload = ChunkedUpload(str(tmp_path / 'up.tar'), str(dest), entries.append)
+    assert upload.offset == 0
+    assert upload.write(0, data[:5000]) == 5000
+    # A chunk at the wrong offset is ignored.
+    assert upload.write(1000, data[1000:6000]) == 5000
+    assert upload.write(5000, data[5000:]) == len(data)
+    upload.finish()
+
+    assert sorted(entries) == ['project/', 'project/a.txt', 'project/dir/',
+                               'project/dir/b.txt']
+    assert (dest / 'project' / 'a.txt').read_text() == "a" * 30000
+    assert not (tmp_path / 'up.tar').exists()
+
+
+def test_chunked_upload_resume(tmp_path):
+    data = make_tar(tmp_path)
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+
+    upload = ChunkedUpload(str(tmp_path / 'up.tar'), str(dest), print)
+    upload.write(0, data[:15000])
+    upload._file.close()
+
+    upload = ChunkedUpload(str(tmp_path / 'up.tar'), str(dest), print)
+    assert upload.offset == 15000
+    upload.write(15000, data[15000:])
+    upload.finish()
+    assert (dest / 'project' / 'dir' / 'b.txt').read_text() == "b"
+
+
+def test_chunked_upload_unsafe(tmp_path):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        info = tarfile.TarInfo('../outside.txt')
+        info.size = 1
+        tar.addfile(info, io.BytesIO(b"x"))
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+
+    upload = ChunkedUpload(str(tmp_path / 'up.tar'), str(dest), print)
+    upload.write(0, buffer.getvalue())
+    upload.finish()
+    assert not (tmp_path / 'outside.txt').exists()
+
+
+def test_chunked_upload_abort(tmp_path):
+    data = make_tar(tmp_path)
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+
+    upload = ChunkedUpload(str(tmp_path / 'up.tar'), str(dest), print)
+    upload.write(0, data[:15000])
+    upload.abort()
+    assert not (tmp_path / 'up.tar').exists()
+    assert not list(dest.iterdir())
+
+
+def test_chunked_upload_extracts_at_finish(tmp_path):
+    data = make_tar(tmp_path)
+    dest = tmp_path / 'dest'
+    dest.mkdir()
+    entries = []
+
+    upload = ChunkedUpload(str(tmp_path / 'up.tar'), str(dest), entries.append)
+    upload.write(0, data[:-1024])
+    assert entries == []
+    assert not list(dest.iterdir())
+
+    upload.write(len(data) - 1024, data[-1024:])
+    upload.finish()
+    assert len(entries) == 4
+
+
+def test_tree_hash(tmp_path):
+    (tmp_path / 'a.txt').write_text("a")
+    (tmp_path / 'dir').mkdir()
+    key = tree_hash(str(tmp_path))
+    assert tree_hash(str(tmp_path)) == key
+
+    (tmp_path / 'dir' / 'b.txt').write_text("b")
+    assert tree_hash(str(tmp_path)) != key
+    key = tree_hash(str(tmp_path))
+    (tmp_path / 'a.txt').write_text("changed")
+    assert tree_hash(str(tmp_path)) != key
+
+
+def test_archive_cache(tmp_path):
+    (tmp_path / 'src').mkdir()
+    (tmp_path / 'src' / 'a.txt').write_text("a" * 10000)
+    cache = ArchiveCache(str(tmp_path / 'cache'), 1)
+    key = tree_hash(str(tmp_path / 'src'))
+    assert cache.open(key, "xz") is None
+
+    for compression in ("gz", "xz"):
+        path = cache.archive_path(key, compression)
+        size = build_archive(str(tmp_path / 'src'), 'project', path,
+                             compression)
+        assert 0 < size < 10000
+        with tarfile.open(path) as tar:
+            assert tar.extractfile('project/a.txt').read() == b"a" * 10000
+
+    with cache.open(key, "gz") as f:
+        data = b"".join(iter_file_chunks(f, 100))
+    assert len(data) == os.path.getsize(cache.archive_path(key, "gz"))
+
+    cache.evict()
+    assert os.listdir(str(tmp_path / 'cache')) == [f"{key}.tar.gz"]
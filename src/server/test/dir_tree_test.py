@@ -0,0 +1,80 @@
+import os
+from services.dir_tree import DirTree
+
+
+def walk_tree(path):
+    """
+    Build the tree list directly from the directory on disk.
+    """
+    _, dir_names, file_names = next(os.walk(path))
+    return ([(name, walk_tree(os.path.join(path, name))) for name in dir_names]
+            + file_names)
+
+
+def normalise(tree):
+    files = sorted(entry for entry in tree if isinstance(entry, str))
+    dirs = sorted((entry[0], normalise(entry[1])) for entry in tree
+                  if not isinstance(entry, str))
+    return dirs, files
+
+
+def make_tree(root):
+    (root / 'src' / 'lib').mkdir(parents=True)
+    (root / 'docs').mkdir()
+    for path in ['a.txt', 'src/main.py', 'src/lib/util.py', 'docs/x.md']:
+        (root / path).write_text(path)
+
+
+def test_build(tmp_path):
+    make_tree(tmp_path)
+    tree = DirTree(str(tmp_path))
+
+    assert normalise(tree.to_list()) == normalise(walk_tree(str(tmp_path)))
+    assert 'src/lib/util.py' in tree and 'src/lib/' in tree
+    assert 'src/other.py' not in tree
+
+
+def test_updates(tmp_path):
+    make_tree(tmp_path)
+    tree = DirTree(str(tmp_path))
+    cached = tree.to_list()
+
+    tree.add('new/dir/b.txt')
+    tree.add('empty/')
+    tree.remove('docs/')
+    tree.remove('a.txt')
+    tree.rename('src/lib/', 'lib/')
+    tree.rename('src/main.py', 'lib/main.py')
+
+    assert tree.to_list() is not cached
+    assert normalise(tree.to_list()) == normalise([
+        ('new', [('dir', ['b.txt'])]),
+        ('empty', []),
+        ('src', []),
+        ('lib', ['util.py', 'main.py']),
+    ])
+
+
+def test_cache(tmp_path):
+    make_tree(tmp_path)
+    tree = DirTree(str(tmp_path))
+    first = tree.to_list()
+    docs = next(entry for entry in first if entry[0] == 'docs')[1]
+
+    tree.add('src/new.py')
+    second = tree.to_list()
+
+    # Unchanged directories are not rebuilt.
+    assert next(entry for entry in second if entry[0] == 'docs')[1] is docs
+    assert 'new.py' in next(entry for entry in second
+                            if entry[0] == 'src')[1]
+
+
+def test_add_walk(tmp_path):
+    make_tree(tmp_path)
+    tree = DirTree(str(tmp_path / 'docs'))
+    (tmp_path / 'docs' / 'sub').mkdir()
+    (tmp_path / 'docs' / 'sub' / 'y.md').write_text('y')
+
+    tree.add_walk('sub/')
+    assert 'sub/y.md' in tree
@@ -0,0 +1,55 @@
+import os
+from services.file_cache import FileCache
+from services.server_file import ServerFile
+
+
+def make_file(tmp_path, name, content="one\ntwo\n"):
+    (tmp_path / name).write_text(content)
+    return ServerFile(str(tmp_path), name)
+
+
+def test_take(tmp_path):
+    cache = FileCache(2, 1 << 20)
+    file = make_file(tmp_path, 'a.txt')
+
+    cache.put('a.txt', file)
+    assert 'a.txt' in cache and cache.size > 0
+    assert cache.take('a.txt') is file
+    assert len(cache) == 0 and cache.size == 0
+    assert cache.take('a.txt') is None
+
+
+def test_unsaved_not_cached(tmp_path):
+    cache = FileCache(2, 1 << 20)
+    file = make_file(tmp_path, 'a.txt')
+    file.is_saved = False
+
+    cache.put('a.txt', file)
+    assert len(cache) == 0
+
+
+def test_limits(tmp_path):
+    cache = FileCache(2, 1 << 20)
+    for name in ['a.txt', 'b.txt', 'c.txt']:
+        cache.put(name, make_file(tmp_path, name))
+    assert 'a.txt' not in cache and len(cache) == 2
+
+    file = make_file(tmp_path, 'd.txt')
+    small = FileCache(2, cache.size // 2 - 1)
+    small.put('d.txt', file)
+    assert len(small) == 0
+
+
+def test_invalidation(tmp_path):
+    cache = FileCache(4, 1 << 20)
+    cache.put('a.txt', make_file(tmp_path, 'a.txt'))
+    (tmp_path / 'dir').mkdir()
+    cache.put('dir/b.txt', make_file(tmp_path, 'dir/b.txt'))
+    assert len(cache) == 2
+
+    (tmp_path / 'a.txt').write_text("changed\n")
+    os.utime(tmp_path / 'a.txt', ns=(0, 0))
+    assert cache.take('a.txt') is None
+
+    cache.discard('dir')
+    assert len(cache) == 0 and cache.size == 0
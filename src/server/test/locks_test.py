@@ -0,0 +1,131 @@
+import asyncio
+from services.locks import HandlerLock, KeyLocks
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def hold(lock, order, name, exclusive, release):
+    await lock.acquire(exclusive)
+    order.append(name)
+    await release.wait()
+    lock.release(exclusive)
+
+
+def test_handler_lock_fifo():
+    async def main():
+        lock = HandlerLock(asyncio.get_running_loop())
+        order = []
+        release = asyncio.Event()
+
+        await lock.acquire()
+        tasks = [asyncio.create_task(hold(lock, order, name, exclusive,
+                                          release))
+                 for name, exclusive in [("a", False), ("b", True),
+                                         ("c", False)]]
+        await asyncio.sleep(0)
+        assert order == []
+
+        # The shared holder "c" does not overtake the exclusive "b".
+        lock.release()
+        await asyncio.sleep(0)
+        assert order == ["a"]
+        release.set()
+        await asyncio.gather(*tasks)
+        assert order == ["a", "b", "c"]
+        assert not lock.locked()
+
+    run(main())
+
+
+def test_handler_lock_shared():
+    async def main():
+        lock = HandlerLock(asyncio.get_running_loop())
+        order = []
+        release = asyncio.Event()
+
+        shared = [asyncio.create_task(hold(lock, order, name, False,
+                                           release))
+                  for name in ["a", "b"]]
+        await asyncio.sleep(0)
+        assert order == ["a", "b"]
+
+        exclusive = asyncio.create_task(hold(lock, order, "c", True,
+                                             asyncio.Event()))
+        await asyncio.sleep(0)
+        assert order == ["a", "b"]
+
+        release.set()
+        await asyncio.gather(*shared)
+        await asyncio.sleep(0)
+        assert order == ["a", "b", "c"]
+        exclusive.cancel()
+
+    run(main())
+
+
+def test_handler_lock_cancelled_waiter():
+    async def main():
+        lock = HandlerLock(asyncio.get_running_loop())
+        await lock.acquire(exclusive=False)
+
+        waiter = asyncio.create_task(lock.acquire())
+        shared = asyncio.create_task(lock.acquire(exclusive=False))
+        await asyncio.sleep(0)
+        assert not shared.done()
+
+        # The shared waiter no longer queues behind the cancelled one.
+        waiter.cancel()
+        await asyncio.wait_for(shared, 1)
+        assert lock.locked()
+
+    run(main())
+
+
+async def track(running, log, name, delay=0.01):
+    running.append(name)
+    log.append(len(running))
+    await asyncio.sleep(delay)
+    running.remove(name)
+    return name
+
+
+def test_key_locks():
+    async def main():
+        lock = HandlerLock(asyncio.get_running_loop())
+        key_locks = KeyLocks(lock)
+        running, log = [], []
+
+        # Different keys run concurrently.
+        await asyncio.gather(key_locks.run("a", track, running, log, 1),
+                             key_locks.run("b", track, running, log, 2))
+        assert max(log) == 2
+
+        # The same key runs one at a time, in order.
+        log.clear()
+        names = await asyncio.gather(
+            *[key_locks.run("a", track, running, log, i) for i in range(4)])
+        assert names == [0, 1, 2, 3] and max(log) == 1
+        assert len(key_locks) == 0
+
+    run(main())
+
+
+def test_key_locks_exclusive():
+    async def main():
+        lock = HandlerLock(asyncio.get_running_loop())
+        key_locks = KeyLocks(lock)
+        running, log = [], []
+
+        await lock.acquire()
+        task = asyncio.create_task(key_locks.run("a", track, running, log,
+                                                 "a"))
+        await asyncio.sleep(0.02)
+        assert log == [] and len(key_locks) == 1
+
+        lock.release()
+        assert await task == "a"
+        assert len(key_locks) == 0
+
+    run(main())
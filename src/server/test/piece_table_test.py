@@ -1,14 +1,19 @@
+import itertools
+import pickle
 import pytest
 from services.piece_table import PieceTable
 from services.piece import Piece
+from services.piece_tree import PieceTree
+from services.line_store import LineStore
 from services.typedefs import LockError
 
 test_text = "test0\ntekst1\ntest2\ntekst3\ntest4\ntekst5\ntest6\ntekst7"
 
 
-@pytest.fixture
-def pt():
-    return PieceTable(test_text)
+@pytest.fixture(params=[{}, {"tree": True}, {"add_buffer": True}],
+                ids=["list", "tree", "add_buffer"])
+def pt(request):
+    return PieceTable(test_text, **request.param)
 
 
 def test_create_empty_file(pt):
@@ -313,3 +318,402 @@ def test_get_piece_content(pt):
     assert pt.get_piece_content(pt[0].piece_id) == test_text.splitlines(True)
     lock_id = pt.put_piece(pt[0].piece_id, 2, 1, "Gerard")
     assert pt.get_piece_content(lock_id) == ["test2\n"]
+
+
+def test_piece_index_stays_in_sync(pt):
+    lock_id = pt.put_piece(pt[0].piece_id, 2, 3, "Gerard")
+    pt.put_piece_after(lock_id, "Sam")
+
+    for i, piece in enumerate(pt.table):
+        assert pt.get_piece(piece.piece_id) is piece
+        assert pt.get_piece_index(piece.piece_id) == i
+
+    pt.close_piece(lock_id)
+    pt.merge_unlocked_pieces()
+
+    assert set(pt._pieces) == {p.piece_id for p in pt.table}
+    with pytest.raises(ValueError):
+        pt.get_piece(lock_id)
+
+
+def test_piece_index_renumbers_after_edit():
+    pt = PieceTable(test_text)
+    for _ in range(6):
+        pt.put_piece_after(pt[-1].piece_id, "Sam")
+        pt.close_piece(pt[-1].piece_id)
+    piece_ids = [piece.piece_id for piece in pt.table]
+    assert pt.get_piece_index(piece_ids[-1]) == 6
+
+    # Inserting keeps the positions before the insertion, and the new
+    # piece is numbered when it is merged with its neighbours.
+    pt.put_piece_after(piece_ids[3], "Gerard")
+    assert pt._positions_valid == 5
+    assert pt.get_piece_index(piece_ids[2]) == 2
+    assert pt._positions_valid == 5
+
+    # Only the pieces up to the looked up piece are renumbered.
+    assert pt.get_piece_index(piece_ids[4]) == 5
+    assert pt._positions_valid == 6
+
+    pt._remove_piece(piece_ids[0])
+    for i, piece in enumerate(pt.table):
+        assert pt.get_piece_index(piece.piece_id) == i
+
+
+def test_renew_piece_id(pt):
+    lock_id = pt.put_piece(pt[0].piece_id, 2, 3, "Gerard")
+    new_id = pt.renew_piece_id(lock_id)
+
+    assert new_id != lock_id
+    assert pt[1].piece_id == new_id
+    assert pt.get_piece_index(new_id) == 1
+    with pytest.raises(ValueError):
+        pt.get_piece_index(lock_id)
+
+
+def test_merge_unlocked_incremental(pt):
+    lock_id = pt.put_piece(pt[0].piece_id, 2, 3, "Gerard")
+    pt.put_piece(pt[0].piece_id, 0, 1, "Sam")
+    orig = pt.blocks[0]
+
+    pt.close_piece(lock_id)
+    changed = pt.merge_unlocked_pieces(lock_id)
+
+    # Only the unlocked neighbours are merged, the orig block is untouched.
+    assert pt.blocks[0] is orig
+    assert len(pt.table) == 2
+    assert pt[0].owner == "Sam"
+    assert changed == [pt[1].piece_id]
+    assert pt.get_piece_content(changed[0]) == test_text.splitlines(True)[1:]
+    assert pt.get_lines() == test_text.splitlines(True)
+
+
+def test_merge_unlocked_contiguous(pt):
+    pt._set_length(pt[0], 5)
+    pt._insert_piece(Piece("tail", 0, 5, 3, ""), index=1)
+
+    assert pt.merge_unlocked_pieces("tail") == []
+    assert len(pt.table) == 1
+    assert (pt[0].block_id, pt[0].start, pt[0].length) == (0, 0, 8)
+    assert len(pt.blocks) == 1
+
+
+def test_merge_unlocked_copy_limit(pt):
+    lock_id = pt.put_piece(pt[0].piece_id, 2, 3, "Gerard")
+    pt.close_piece(lock_id)
+    pt.MERGE_COPY_LIMIT = 4
+
+    assert pt.merge_unlocked_pieces(lock_id) == []
+    assert len(pt.table) == 3
+    assert pt.get_lines() == test_text.splitlines(True)
+
+
+def test_add_buffer_lock_without_copy():
+    pt = PieceTable(test_text, add_buffer=True)
+    lock_id = pt.put_piece(pt[0].piece_id, 2, 3, "Gerard")
+    block = pt.blocks[pt.get_piece(lock_id).block_id]
+
+    assert block.base is pt.blocks[0]
+    assert pt._add == []
+
+    pt.set_piece_content(lock_id, ["kaas\n"] * 2)
+    assert pt._add == []
+    assert pt.get_piece_content(lock_id) == ["kaas\n"] * 2
+
+    pt.close_piece(lock_id)
+    assert pt._add == ["kaas\n"] * 2
+    assert pt.get_piece_content(lock_id) == ["kaas\n"] * 2
+
+
+def test_add_buffer_patches_in_place():
+    pt = PieceTable(test_text, add_buffer=True)
+    lock_id = pt.put_piece(pt[0].piece_id, 2, 3, "Gerard")
+    block_id = pt.get_piece(lock_id).block_id
+
+    # Only the first patch copies the lock block, none grow the add buffer.
+    pt.set_piece_content(lock_id, ["kaas\n"], 1, 2)
+    block = pt.blocks[block_id]
+    for i in range(10):
+        version = pt.set_piece_content(lock_id, [f"edit {i}\n"], 1, 2)
+        assert pt.blocks[block_id] is block
+        assert pt.get_block_version(block_id) == version
+        assert pt._add == []
+
+    expected = test_text.splitlines(True)[2:5]
+    expected[1] = "edit 9\n"
+    assert pt.get_piece_content(lock_id) == expected
+
+    pt.close_piece(lock_id)
+    assert pt.get_block_version(block_id) == version
+    assert pt._add == expected
+    assert pt.get_lines()[2:5] == expected
+
+
+def test_add_buffer_compaction():
+    pt = PieceTable(test_text, add_buffer=True)
+    pt.ADD_BUFFER_MIN_GARBAGE = 4
+    lock_id = pt.put_piece(pt[0].piece_id, 2, 3, "Gerard")
+
+    for i in range(5):
+        pt.set_piece_content(lock_id, [f"edit {i}\n"] * 2)
+        pt.close_piece(lock_id)
+        pt.set_owner(lock_id, "Gerard")
+    assert len(pt._add) == 10
+
+    pt.clear_unused_blocks()
+    assert pt._add == ["edit 4\n"] * 2
+    assert pt.get_piece_content(lock_id) == ["edit 4\n"] * 2
+
+
+def test_clear_unused_blocks_incremental(pt):
+    lock_id = pt.put_piece(pt[0].piece_id, 2, 3, "Gerard")
+    assert pt.clear_unused_blocks() == []
+
+    pt.close_piece(lock_id)
+    pt.merge_unlocked_pieces()
+    assert pt.clear_unused_blocks() == [1]
+    assert pt.clear_unused_blocks() == []
+    assert list(pt.blocks) == [0]
+
+
+def test_iter_lines(pt):
+    text = test_text.splitlines(True)
+    lock_id = pt.put_piece(pt[0].piece_id, 2, 3, "Gerard")
+    pt.set_piece_content(lock_id, ["kaas\n"])
+    new_text = text[:2] + ["kaas\n"] + text[5:]
+
+    assert list(pt.iter_lines()) == new_text
+    assert list(pt.iter_lines(pt[0].piece_id, 1, 3)) == new_text[1:4]
+    assert list(pt.iter_lines(lock_id, 0, 100)) == new_text[2:]
+
+    with pytest.raises(ValueError):
+        pt.iter_lines("not_existing_id")
+
+
+def test_iter_chunks(pt):
+    text = test_text.splitlines(True)
+    pt.put_piece(pt[0].piece_id, 2, 3, "Gerard")
+
+    chunks = list(pt.iter_chunks(pt[0].piece_id, 1, 5))
+    assert [list(chunk) for chunk in chunks] == [text[1:2], text[2:5],
+                                                 text[5:6]]
+    assert chunks[0].base is pt.blocks[0]
+
+
+def test_piece_is_compact():
+    piece = Piece("test_id", 0, 2, 4, "Gerard")
+
+    assert not hasattr(piece, "__dict__")
+    assert piece.as_tuple() == ("test_id", 0, 2, 4, "Gerard")
+    assert [*piece] == list(piece.as_tuple())
+    assert pickle.loads(pickle.dumps(piece)) == piece
+
+
+def test_set_piece_content_range(pt):
+    lock_id = pt.put_piece(pt[0].piece_id, 2, 3, "Gerard")
+    block_id = pt.get_piece(lock_id).block_id
+    version = pt.get_block_version(block_id)
+
+    assert pt.set_piece_content(lock_id, ["kaas\n"] * 2, 1, 2) == version + 1
+    assert list(pt.get_piece_content(lock_id)) == ["test2\n", "kaas\n",
+                                                   "kaas\n", "test4\n"]
+    assert len(pt) == 9
+
+    with pytest.raises(ValueError):
+        pt.set_piece_content(lock_id, [], 3, 5)
+
+
+def test_lock_index(pt):
+    lock_1 = pt.put_piece(pt[0].piece_id, 1, 2, "Gerard")
+    lock_2 = pt.put_piece(pt[-1].piece_id, 2, 2, "Sam")
+    lock_3 = pt.put_piece(pt[-1].piece_id, 0, 1, "Gerard")
+
+    assert sorted(pt.get_locks("Gerard")) == sorted([lock_1, lock_3])
+    assert pt.get_locks("Sam") == [lock_2]
+    assert pt.get_locks("Robin") == []
+    assert pt.get_locked_ranges() == [(1, 2, lock_1), (5, 2, lock_2),
+                                      (7, 1, lock_3)]
+
+    assert pt.is_range_free(0, 1)
+    assert not pt.is_range_free(0, 2)
+    assert pt.is_range_free(3, 2)
+    assert not pt.is_range_free(4, 2)
+    assert not pt.is_range_free(6, 3, "Sam")
+    assert pt.is_range_free(5, 2, "Sam")
+
+    new_id = pt.renew_piece_id(lock_2)
+    pt.close_piece(lock_1)
+    assert pt.get_locks("Sam") == [new_id]
+    assert pt.get_locks("Gerard") == [lock_3]
+    assert pt.is_range_free(0, 3)
+
+    pt.set_owner(lock_3, "Sam")
+    assert sorted(pt.get_locks("Sam")) == sorted([new_id, lock_3])
+
+
+def test_lock_conflicts_after_edits(pt):
+    lock_1 = pt.put_piece(pt[0].piece_id, 1, 2, "Gerard")
+    lock_2 = pt.put_piece(pt[-1].piece_id, 2, 2, "Sam")
+    order = pt._get_lock_order()
+
+    # Edits shift the rows of later locks, but keep their order.
+    pt.set_piece_content(lock_1, ["a\n", "b\n", "c\n", "d\n"])
+    assert pt.get_locked_ranges() == [(1, 4, lock_1), (7, 2, lock_2)]
+    assert pt._get_lock_order() is order
+
+    assert pt.is_range_free(5, 2)
+    assert not pt.is_range_free(6, 2)
+    with pytest.raises(ValueError):
+        pt.put_piece(pt.row_to_piece(8)[0], pt.row_to_piece(8)[1], 1,
+                     "Gerard")
+    piece_id, offset = pt.row_to_piece(5)
+    pt.put_piece(piece_id, offset, 2, "Gerard")
+
+
+def test_snapshot_is_isolated(pt):
+    text = test_text.splitlines(True)
+    lock_id = pt.put_piece(pt[0].piece_id, 2, 3, "Gerard")
+    snap = pt.snapshot()
+
+    assert snap.table is pt.table
+    assert snap.version == pt.version
+
+    pt.set_piece_content(lock_id, ["kaas\n"])
+    pt.close_piece(lock_id)
+    pt.merge_unlocked_pieces()
+    pt.clear_unused_blocks()
+
+    assert snap.get_lines() == text
+    assert snap.get_piece(lock_id).owner == "Gerard"
+    assert pt.get_lines() == text[:2] + ["kaas\n"] + text[5:]
+    assert pt.version > snap.version
+
+    # The snapshot can be changed without affecting the original.
+    snap.set_piece_content(lock_id, ["worst\n"], 1, 2)
+    assert snap.get_lines() == text[:3] + ["worst\n"] + text[4:]
+    assert pt.get_lines() == text[:2] + ["kaas\n"] + text[5:]
+
+
+def test_dropped_snapshot_is_not_copied(pt):
+    lock_id = pt.put_piece(pt[0].piece_id, 2, 3, "Gerard")
+    table = pt.table
+
+    snap = pt.snapshot()
+    del snap
+    pt.set_piece_content(lock_id, ["kaas\n"])
+    assert pt.table is table
+
+
+def test_freeze(pt):
+    text = test_text.splitlines(True)
+    lock_id = pt.put_piece(pt[0].piece_id, 2, 3, "Gerard")
+    pt.set_piece_content(lock_id, ["kaas\n"] * 3)
+    frozen = pt.freeze()
+
+    # Patching the lock in place leaves the frozen content untouched.
+    pt.set_piece_content(lock_id, ["ham\n"], 1, 2)
+    pt.close_piece(lock_id)
+    pt.merge_unlocked_pieces()
+    pt.clear_unused_blocks()
+
+    assert list(itertools.chain.from_iterable(frozen)) == (
+        text[:2] + ["kaas\n"] * 3 + text[5:])
+    assert pt.get_lines() == (
+        text[:2] + ["kaas\n", "ham\n", "kaas\n"] + text[5:])
+
+
+def test_snapshot_diff(pt):
+    lock_id = pt.put_piece(pt[0].piece_id, 2, 3, "Gerard")
+    snap = pt.snapshot()
+
+    assert pt.diff(snap) == []
+
+    pt.set_piece_content(lock_id, ["kaas\n"] * 3)
+    pt.set_piece_content(lock_id, ["ham\n"], 1, 2)
+    assert pt.diff(snap) == [(2, 3, 2, 3)]
+
+    pt.put_piece_after(pt[-1].piece_id, "Sam")
+    assert pt.diff(snap) == [(2, 3, 2, 3), (8, 1, 8, 0)]
+    assert snap.diff(pt) == [(2, 3, 2, 3), (8, 0, 8, 1)]
+
+
+def test_line_store():
+    store = LineStore()
+    pt = PieceTable(test_text, line_store=store)
+    other = PieceTable(test_text, add_buffer=True, line_store=store)
+
+    assert other.blocks[0][3] is pt.blocks[0][3]
+    assert pt.line_stats["shared_bytes"] == 0
+    assert (other.line_stats["shared_bytes"]
+            == pt.line_stats["unique_bytes"])
+
+    lock_id = other.put_piece(other[0].piece_id, 2, 1, "Gerard")
+    other.set_piece_content(lock_id, "kaas\ntest0\n".splitlines(True))
+    assert other.get_lines()[3] is pt.blocks[0][0]
+
+    del pt
+    assert store.prune() == 0
+    del other
+    assert store.prune() == len(test_text.splitlines()) + 1
+    assert len(store) == 0
+
+
+def test_line_store_prune_keeps_table_lines():
+    store = LineStore()
+    pt = PieceTable(test_text, add_buffer=True, line_store=store)
+    lock_id = pt.put_piece(pt[0].piece_id, 2, 1, "Gerard")
+    pt.set_piece_content(lock_id, ["kaas\n", "ham\n"])
+    pt.set_piece_content(lock_id, ["worst\n"], 1, 2)
+
+    # Lines are kept for as long as a block holds them, regardless of
+    # other references to them.
+    loose = store.intern(["loose\n"])
+    assert store.prune() == 2
+    assert len(store) == len(test_text.splitlines()) + 2
+    assert loose == ["loose\n"]
+    assert store.intern(["worst\n"])[0] is pt.get_piece_content(lock_id)[1]
+
+
+def test_memory_usage(pt):
+    usage = pt.memory_usage()
+    assert usage["pieces"] == 1 and usage["blocks"] == 1
+    assert usage["rows"] == 8 and usage["locks"] == 0
+    assert usage["block_bytes"] > len(test_text)
+    assert usage["mapped_bytes"] == 0
+    if isinstance(pt.table, PieceTree):
+        assert usage["table_bytes"] > pt.table.size_bytes()
+
+    lock_id = pt.put_piece(pt[0].piece_id, 2, 1, "Gerard")
+    pt.close_piece(lock_id)
+    usage = pt.memory_usage()
+    assert usage["pieces"] == 3 and usage["locks"] == 0
+    assert usage["mergeable_pieces"] == 2
+
+    pt.merge_unlocked_pieces(lock_id)
+    assert pt.memory_usage()["mergeable_pieces"] == 0
+
+
+def test_defragment(pt):
+    text = pt.get_lines()
+    first_id = pt.put_piece(pt[0].piece_id, 1, 2, "Gerard")
+    pt.set_piece_content(first_id, ["kaas\n"])
+    second_id = pt.put_piece(pt[2].piece_id, 2, 1, "Sam")
+    pt.close_piece(first_id)
+
+    assert pt.fragmentation() == 2
+    kept_id = pt[2].piece_id
+    changed = pt.defragment(keep=[kept_id])
+    pt.clear_unused_blocks()
+
+    assert [p.piece_id for p in pt] == [pt[0].piece_id, kept_id, second_id,
+                                        pt[3].piece_id]
+    assert changed == [pt[0].piece_id]
+    assert pt.get_lines() == text[:1] + ["kaas\n"] + text[3:]
+    assert pt.fragmentation() == 1
+
+    pt.close_piece(second_id)
+    pt.defragment()
+    pt.clear_unused_blocks()
+    assert len(pt.table) == 1
+    assert pt.get_lines() == text[:1] + ["kaas\n"] + text[3:]
+    assert pt.blocks.keys() == {0, pt[0].block_id}
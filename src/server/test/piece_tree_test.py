@@ -0,0 +1,112 @@
+import random
+import sys
+import pytest
+from services.piece import Piece
+from services.piece_tree import PieceTree
+
+
+def make_pieces(n):
+    return [Piece(str(i), 0, i, i % 5 + 1, "") for i in range(n)]
+
+
+@pytest.fixture
+def tree():
+    return PieceTree(make_pieces(20))
+
+
+def test_behaves_like_list(tree):
+    pieces = make_pieces(20)
+    assert len(tree) == 20
+    assert list(tree) == pieces
+    assert tree[0] == pieces[0]
+    assert tree[-1] == pieces[-1]
+    assert tree[5:9] == pieces[5:9]
+    assert tree[18:] == pieces[18:]
+
+    with pytest.raises(IndexError):
+        tree[20]
+
+
+def test_insert_and_remove(tree):
+    piece = Piece("new", 1, 0, 3, "Gerard")
+    tree.insert(3, piece)
+
+    assert tree[3] is piece
+    assert tree.index(piece) == 3
+    assert len(tree) == 21
+
+    assert tree.pop(3) is piece
+    assert len(tree) == 20
+    with pytest.raises(ValueError):
+        tree.index(piece)
+
+
+def test_slice_assignment(tree):
+    new = [Piece("a", 1, 0, 2, ""), Piece("b", 2, 0, 4, "")]
+    tree[2:10] = new
+
+    assert len(tree) == 14
+    assert tree[2:4] == new
+    assert tree.index(new[1]) == 3
+
+
+def test_rows(tree):
+    pieces = list(tree)
+    rows = 0
+    for piece in pieces:
+        assert tree.row_of(piece) == rows
+        assert tree.find_row(rows) == (piece, 0)
+        assert tree.find_row(rows + piece.length - 1) == (piece,
+                                                          piece.length - 1)
+        rows += piece.length
+
+    assert tree.total_rows() == rows
+    with pytest.raises(ValueError):
+        tree.find_row(rows)
+    with pytest.raises(ValueError):
+        tree.find_row(-1)
+
+
+def test_refresh(tree):
+    piece = tree[4]
+    before = tree.total_rows()
+    piece.length += 10
+    tree.refresh(piece)
+
+    assert tree.total_rows() == before + 10
+    assert tree.row_of(tree[5]) == sum(p.length for p in tree[:5])
+
+
+def test_random_operations_match_list():
+    rnd = random.Random(1)
+    pieces = make_pieces(50)
+    tree = PieceTree(pieces)
+    pieces = list(pieces)
+
+    for i in range(500):
+        op = rnd.randrange(3)
+        if op == 0:
+            piece = Piece(f"n{i}", 0, 0, rnd.randint(1, 9), "")
+            index = rnd.randrange(len(pieces) + 1)
+            pieces.insert(index, piece)
+            tree.insert(index, piece)
+        elif op == 1 and pieces:
+            index = rnd.randrange(len(pieces))
+            assert tree.pop(index) is pieces.pop(index)
+        elif pieces:
+            piece = rnd.choice(pieces)
+            piece.length = rnd.randint(1, 9)
+            tree.refresh(piece)
+
+    assert list(tree) == pieces
+    assert tree.total_rows() == sum(p.length for p in pieces)
+    for index, piece in enumerate(pieces):
+        assert tree.index(piece) == index
+        assert tree.row_of(piece) == sum(p.length for p in pieces[:index])
+
+
+def test_size_bytes(tree):
+    size = tree.size_bytes()
+    assert size > 20 * sys.getsizeof(tree._root)
+    tree.append(Piece("new", 1, 0, 3, ""))
+    assert tree.size_bytes() > size
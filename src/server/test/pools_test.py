@@ -0,0 +1,90 @@
+import asyncio
+import os
+import threading
+import time
+import pytest
+from services.pools import WorkerPools
+
+
+def run_pools(fn):
+    async def main():
+        pools = WorkerPools(asyncio.get_running_loop())
+        try:
+            return await fn(pools)
+        finally:
+            pools.shutdown()
+    return asyncio.run(main())
+
+
+def fail(message, delay=0):
+    time.sleep(delay)
+    raise ValueError(message)
+
+
+def test_run_on_thread_pool():
+    async def main(pools):
+        ident = await pools.run(threading.get_ident)
+        assert ident != threading.get_ident()
+        assert await pools.run(os.getpid) == os.getpid()
+        assert await pools.run(sum, [1, 2], 3) == 6
+
+        stats = pools.stats()["thread"]
+        assert stats["calls"] == 3 and stats["pending"] == 0
+        assert pools.stats()["process"]["calls"] == 0
+
+    run_pools(main)
+
+
+def test_run_on_process_pool():
+    async def main(pools):
+        assert pools._executors["process"] is None
+        assert await pools.run(os.getpid, pool="process") != os.getpid()
+        assert pools.stats()["process"]["calls"] == 1
+
+    run_pools(main)
+
+
+def test_run_exception():
+    async def main(pools):
+        for pool in ("thread", "process"):
+            with pytest.raises(ValueError, match="broken"):
+                await pools.run(fail, "broken", 0.01, pool=pool)
+            stats = pools.stats()[pool]
+            assert stats["pending"] == 0 and stats["calls"] == 1
+            assert stats["run_time"] >= 0.01
+
+        with pytest.raises(KeyError):
+            await pools.run(os.getpid, pool="unknown")
+
+    run_pools(main)
+
+
+def test_run_concurrently():
+    async def main(pools):
+        barrier = threading.Barrier(2, timeout=5)
+        await asyncio.gather(pools.run(barrier.wait, pool="stream"),
+                             pools.run(barrier.wait, pool="stream"))
+        assert pools.stats()["stream"]["calls"] == 2
+
+    run_pools(main)
+
+
+def test_shutdown():
+    async def main(pools):
+        event = threading.Event()
+        call = asyncio.ensure_future(pools.run(event.wait, 5))
+        await asyncio.sleep(0.01)
+
+        # Running calls are finished, new calls are refused.
+        loop = asyncio.get_running_loop()
+        shutdown = loop.run_in_executor(None, pools.shutdown)
+        await asyncio.sleep(0.01)
+        event.set()
+        await shutdown
+        assert await call is True
+
+        for pool in ("thread", "process"):
+            with pytest.raises(RuntimeError):
+                await pools.run(os.getpid, pool=pool)
+
+    run_pools(main)
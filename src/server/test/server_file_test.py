@@ -1,7 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
+import pickle
+import random
 import pytest
+from services.blocks import MappedLines
 from services.server_file import ServerFile
 from services.cursor import Cursor
-from services.typedefs import LockError
+from services.journal import Journal
+from services.typedefs import LockError, VersionError
 
 
 @pytest.fixture(scope='class')
@@ -91,3 +96,373 @@ class TestSFDummy:
         sf.client_leave("Sam")
         assert "Sam" not in sf.get_clients()
         assert all(p.owner != "Sam" for p in sf.pt.table)
+
+
+def test_tree_backed_cursors():
+    sf = ServerFile('./test', 'test_file.txt', tree=True)
+    sf.client_join('Sam')
+    sf.move_cursor('Sam', sf.pt[0].piece_id, 2, 3)
+    lock_id = sf.add_lock(sf.pt[0].piece_id, 1, 2, 'Sam')
+
+    assert sf.cursors['Sam'] == Cursor(lock_id, 1, 3)
+    assert sf.get_cursor_rows() == {'Sam': 2}
+
+    sf.remove_lock(lock_id)
+    assert sf.cursors['Sam'] == Cursor(sf.pt[0].piece_id, 2, 3)
+
+
+def test_patch_content():
+    sf = ServerFile('./test', 'test_file.txt')
+    sf.client_join('Sam')
+    lock_id = sf.add_lock(sf.pt[0].piece_id, 0, 2, 'Sam')
+    version = sf.update_content('Sam', lock_id, "a\nb\nc\n")
+
+    version = sf.patch_content('Sam', lock_id, version,
+                               [(1, 2, "x\ny\n"), (0, 0, "start\n")])
+    assert list(sf.pt.get_piece_content(lock_id)) == ["start\n", "a\n", "x\n",
+                                                      "y\n", "c\n"]
+    assert sf.is_saved is False
+
+    with pytest.raises(VersionError):
+        sf.patch_content('Sam', lock_id, version - 1, [(0, 0, "z\n")])
+    with pytest.raises(ValueError):
+        sf.patch_content('Sam', lock_id, version, [(0, 0, "z\n"),
+                                                   (4, 8, "")])
+    assert len(sf.pt.get_piece_content(lock_id)) == 5
+
+
+def test_patch_content_validates_first():
+    sf = ServerFile('./test', 'test_file.txt')
+    lock_id = sf.add_lock(sf.pt[0].piece_id, 0, 2, 'Sam')
+    version = sf.pt.get_block_version(sf.pt.get_piece(lock_id).block_id)
+    lines = list(sf.pt.get_piece_content(lock_id))
+
+    with pytest.raises(LockError):
+        sf.patch_content('Robin', lock_id, version, [(0, 0, "z\n")])
+    with pytest.raises(LockError):
+        sf.update_content('Robin', lock_id, "z\n")
+    with pytest.raises(ValueError):
+        sf.patch_content('Sam', lock_id, version, [(0, 0)])
+    with pytest.raises(ValueError):
+        sf.patch_content('Sam', lock_id, version, [(0, 0, 5)])
+
+    assert sf.is_saved is True
+    assert sf.edit_count == 0
+    assert list(sf.pt.get_piece_content(lock_id)) == lines
+
+
+def test_apply_operations():
+    sf = ServerFile('./test', 'test_file.txt')
+    sf.client_join('Sam')
+    sf.client_join('Robin')
+    sf.move_cursor('Robin', sf.pt[0].piece_id, 3, 1)
+    first_id = sf.pt[0].piece_id
+
+    results, changed = sf.apply_operations('Sam', [
+        ("lock", first_id, 0, 2),
+        ("lock", "kaas", 0, 1),
+        ("unknown",),
+    ])
+    lock_id = results[0][1]
+
+    assert results[0][0] is True
+    assert results[1][0] is False and results[2][0] is False
+    assert changed == [lock_id]
+    assert sf.get_cursor_rows()['Robin'] == 3
+
+    results, changed = sf.apply_operations('Sam', [
+        ("delta", lock_id, "a\nb\nc\n"),
+        ("unlock", lock_id),
+    ])
+
+    assert [ok for ok, _ in results] == [True, True]
+    assert sf.pt.get_locks('Sam') == []
+    assert sf.get_cursor_rows()['Robin'] == 4
+
+
+def test_apply_operations_insert_moves_cursors():
+    sf = ServerFile('./test', 'test_file.txt')
+    sf.client_join('Sam')
+    sf.client_join('Robin')
+    sf.move_cursor('Robin', sf.pt[0].piece_id, 3, 1)
+
+    # Robin's row, before the insert.
+    piece_id, offset = sf.pt.row_to_piece(3)
+
+    results, _ = sf.apply_operations('Sam', [
+        ("insert", ""),
+        ("lock", piece_id, offset, 1),
+    ])
+    assert [ok for ok, _ in results] == [True, True]
+    assert sf.get_cursor_rows()['Robin'] == 4
+
+    # The inserted row is merged with the lock holding the cursor.
+    lock_id = sf.insert_lock_after_piece(results[1][1], 'Sam')
+    assert sf.pt.piece_to_row(lock_id) == 4
+    assert sf.pt.get_piece(lock_id).length == 2
+    assert sf.get_cursor_rows()['Robin'] == 4
+
+
+def test_apply_operations_malformed():
+    sf = ServerFile('./test', 'test_file.txt')
+    sf.client_join('Sam')
+    lock_id = sf.add_lock(sf.pt[0].piece_id, 0, 1, 'Sam')
+
+    results, changed = sf.apply_operations('Sam', [
+        ("lock", sf.pt[-1].piece_id),
+        ("delta", lock_id, 5),
+        ("patch", lock_id, 0, "not a patch"),
+        ("unlock",),
+        ("delta", lock_id, "ok\n"),
+    ])
+    assert [ok for ok, _ in results] == [False, False, False, False, True]
+    assert changed == [lock_id]
+    assert sf.is_saved is False
+
+
+def test_mapped_file(tmp_path):
+    with open('./test/test_file.txt') as f:
+        lines = f.readlines()
+    (tmp_path / 'mapped.txt').write_text("".join(lines))
+
+    sf = ServerFile(str(tmp_path), 'mapped.txt', add_buffer=True,
+                    mmap_threshold=0)
+    assert sf.is_mapped()
+    assert sf.pt.get_lines() == lines
+
+    sf.client_join('Sam')
+    lock_id = sf.add_lock(sf.pt[0].piece_id, 1, 2, 'Sam')
+    sf.update_content('Sam', lock_id, "changed\n")
+    sf.save_to_disk()
+
+    expected = lines[:1] + ["changed\n"] + lines[3:]
+    assert (tmp_path / 'mapped.txt').read_text() == "".join(expected)
+    assert sf.pt.get_lines() == expected
+
+
+def test_mapped_lines_truncated(tmp_path):
+    path = tmp_path / 'mapped.txt'
+    path.write_text("".join(f"line {i}\n" for i in range(1000)))
+    lines = MappedLines(str(path))
+
+    assert lines[999] == "line 999\n"
+    with open(path, 'r+') as f:
+        f.truncate(0)
+    with pytest.raises(OSError):
+        lines[999]
+
+
+def test_mapped_lines_lazy(tmp_path, monkeypatch):
+    monkeypatch.setattr(MappedLines, 'CHUNK_SIZE', 64)
+    monkeypatch.setattr(MappedLines, 'BATCH_LINES', 7)
+    expected = [f"line {i}\r\n" for i in range(1000)] + ["last"]
+    path = tmp_path / 'mapped.txt'
+    path.write_bytes("".join(expected).encode())
+    expected = [line.replace("\r\n", "\n") for line in expected]
+
+    lines = MappedLines(str(path))
+    assert lines._length is None
+    assert len(lines) == 1001
+    assert not lines._chunks
+
+    # Only the chunks containing the requested lines are indexed.
+    assert lines[500] == expected[500]
+    assert len(lines._chunks) <= 2
+    assert lines[-1] == "last"
+    assert lines[10:20] == expected[10:20]
+    assert list(lines) == expected
+    assert pickle.loads(pickle.dumps(lines)) == expected
+
+
+def test_mapped_lines_threads(tmp_path, monkeypatch):
+    monkeypatch.setattr(MappedLines, 'CHUNK_SIZE', 64)
+    expected = [f"line {i}\n" for i in range(2000)]
+    path = tmp_path / 'mapped.txt'
+    path.write_text("".join(expected))
+    lines = MappedLines(str(path))
+
+    indices = list(range(2000))
+    random.Random(0).shuffle(indices)
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lines.__getitem__, indices))
+    assert results == [expected[i] for i in indices]
+
+
+def test_get_stats():
+    sf = ServerFile('./test', 'test_file.txt')
+    sf.client_join('Sam')
+    sf.add_lock(sf.pt[0].piece_id, 1, 2, 'Sam')
+
+    stats = sf.get_stats()
+    assert stats["clients"] == ['Sam']
+    assert stats["locks"] == 1 and stats["pieces"] == 3
+    assert stats["is_saved"] is True
+
+
+def test_defragment():
+    sf = ServerFile('./test', 'test_file.txt', tree=True)
+    sf.client_join('Sam')
+    lock_id = sf.add_lock(sf.pt[0].piece_id, 1, 2, 'Sam')
+    sf.move_cursor('Sam', sf.pt[2].piece_id, 1, 0)
+    sf.pt.close_piece(lock_id)
+    cursor = sf.cursors['Sam']
+
+    sf.defragment()
+
+    assert len(sf.pt.table) == 2
+    assert sf.cursors['Sam'] == cursor
+    assert sf.get_cursor_rows()['Sam'] == 4
+
+
+def test_write_snapshot(tmp_path):
+    (tmp_path / 'save.txt').write_text("one\ntwo\nthree\n")
+    sf = ServerFile(str(tmp_path), 'save.txt', add_buffer=True)
+    sf.client_join('Sam')
+    lock_id = sf.add_lock(sf.pt[0].piece_id, 1, 1, 'Sam')
+    sf.update_content('Sam', lock_id, "2\n")
+
+    snapshot = sf.pt.snapshot()
+    edit_count = sf.edit_count
+    sf.update_content('Sam', lock_id, "TWO\n")
+    sf.write_snapshot(snapshot, 'save.txt')
+    sf.checkpoint_journal(edit_count)
+    sf.mark_saved(edit_count)
+
+    assert (tmp_path / 'save.txt').read_text() == "one\n2\nthree\n"
+    assert sf.is_saved is False
+    assert [p.name for p in tmp_path.iterdir()] == ['save.txt']
+
+    sf.save_to_disk()
+    assert (tmp_path / 'save.txt').read_text() == "one\nTWO\nthree\n"
+    assert sf.is_saved is True
+
+
+def test_edit_after_save_shares_table(tmp_path):
+    (tmp_path / 'save.txt').write_text("one\ntwo\nthree\n")
+    sf = ServerFile(str(tmp_path), 'save.txt', tree=True)
+    sf.client_join('Sam')
+    lock_id = sf.add_lock(sf.pt[0].piece_id, 1, 1, 'Sam')
+    sf.update_content('Sam', lock_id, "2\n")
+
+    sf.save_to_disk()
+    table = sf.pt.table
+    sf.update_content('Sam', lock_id, "TWO\n")
+    assert sf.pt.table is table
+
+
+def test_journal_recovery(tmp_path):
+    journal_dir = str(tmp_path / 'journal')
+    (tmp_path / 'edit.txt').write_text("one\ntwo\nthree\n")
+
+    sf = ServerFile(str(tmp_path), 'edit.txt', journal_dir=journal_dir)
+    sf.client_join('Sam')
+    lock_id = sf.add_lock(sf.pt[0].piece_id, 1, 1, 'Sam')
+    sf.update_content('Sam', lock_id, "2\n2.5\n")
+    version = sf.pt.get_block_version(sf.pt.get_piece(lock_id).block_id)
+    sf.patch_content('Sam', lock_id, version, [(0, 1, "TWO\n")])
+    insert_id = sf.insert_lock_after_piece("", 'Sam')
+    sf.update_content('Sam', insert_id, "zero\n")
+    sf.insert_lock_after_piece(sf.pt.table[-1].piece_id, 'Sam')
+    lines = sf.pt.get_lines()
+    assert lines == ["zero\n", "one\n", "TWO\n", "2.5\n", "three\n", "\n"]
+
+    # Simulate a crash, leaving a partially written record behind.
+    sf.journal.sync()
+    with open(sf.journal.path, 'a') as f:
+        f.write('{"seq": 6, "ro')
+
+    recovered = ServerFile(str(tmp_path), 'edit.txt',
+                           journal_dir=journal_dir)
+    assert recovered.pt.get_lines() == lines
+    assert recovered.is_saved is False
+    assert recovered.edit_count == 5
+
+    recovered.save_to_disk()
+    recovered.close()
+    assert (tmp_path / 'edit.txt').read_text() == "".join(lines)
+
+    reloaded = ServerFile(str(tmp_path), 'edit.txt', journal_dir=journal_dir)
+    assert reloaded.pt.get_lines() == lines
+    assert reloaded.is_saved is True
+
+
+def test_journal_checkpoint_during_edits(tmp_path):
+    journal = Journal(str(tmp_path / 'edit.journal'))
+    journal.open((0, 0))
+    for seq in range(1, 101):
+        journal.append(seq, 0, 0, ["x\n"])
+
+    with ThreadPoolExecutor(1) as pool:
+        future = pool.submit(journal.checkpoint, (1, 1), 50)
+        for seq in range(101, 201):
+            journal.append(seq, 0, 0, ["x\n"])
+        future.result()
+    journal.close()
+
+    records = Journal(journal.path).open((1, 1))
+    assert [record["seq"] for record in records] == list(range(51, 201))
+
+
+def test_write_snapshot_unchanged(tmp_path):
+    (tmp_path / 'same.txt').write_text("one\ntwo\n")
+    sf = ServerFile(str(tmp_path), 'same.txt')
+    sf.client_join('Sam')
+    lock_id = sf.add_lock(sf.pt[0].piece_id, 1, 1, 'Sam')
+    sf.update_content('Sam', lock_id, "2\n")
+    sf.update_content('Sam', lock_id, "two\n")
+
+    assert sf.write_snapshot(sf.pt.snapshot(), 'same.txt', True) == 0
+
+    sf.update_content('Sam', lock_id, "2\n")
+    assert sf.write_snapshot(sf.pt.snapshot(), 'same.txt', True) == 6
+    assert (tmp_path / 'same.txt').read_text() == "one\n2\n"
+    assert sf.write_snapshot(sf.pt.snapshot(), 'same.txt', True) == 0
+
+
+def test_refresh_from_disk(tmp_path):
+    (tmp_path / 'ext.txt').write_text("a\nb\nc\nd\ne\nf\n")
+    sf = ServerFile(str(tmp_path), 'ext.txt', tree=True)
+    sf.client_join('Sam')
+    lock_id = sf.add_lock(sf.pt[0].piece_id, 3, 1, 'Sam')
+    sf.update_content('Sam', lock_id, "D\n")
+    assert not sf.is_changed_on_disk()
+
+    (tmp_path / 'ext.txt').write_text("a\nx\nb\nc\nd2\ne\n")
+    assert sf.is_changed_on_disk()
+    changed = sf.refresh_from_disk()
+
+    # The lock keeps its content, the rest follows the file on disk.
+    assert sf.pt.get_lines() == ["a\n", "x\n", "b\n", "c\n", "D\n", "e\n"]
+    assert sf.pt.get_piece(lock_id).owner == 'Sam'
+    assert changed and all(piece_id in sf.pt for piece_id in changed)
+    assert not sf.is_changed_on_disk()
+    assert sf.is_saved is False
+
+
+def test_refresh_keeps_unsaved_edits(tmp_path):
+    journal_dir = str(tmp_path / 'journal')
+    (tmp_path / 'ext.txt').write_text("a\nb\nc\nd\ne\nf\n")
+    sf = ServerFile(str(tmp_path), 'ext.txt', journal_dir=journal_dir)
+    sf.client_join('Sam')
+    lock_id = sf.add_lock(sf.pt[0].piece_id, 1, 1, 'Sam')
+    sf.update_content('Sam', lock_id, "B\nB2\n")
+    sf.remove_lock(lock_id)
+
+    (tmp_path / 'ext.txt').write_text("a\nbb\nc\nd\nE\nf\ng\n")
+    sf.refresh_from_disk()
+
+    # The unsaved edit wins over the conflicting change on disk.
+    lines = ["a\n", "B\n", "B2\n", "c\n", "d\n", "E\n", "f\n", "g\n"]
+    assert sf.pt.get_lines() == lines
+    assert sf.is_saved is False
+
+    sf.journal.sync()
+    recovered = ServerFile(str(tmp_path), 'ext.txt', journal_dir=journal_dir)
+    assert recovered.pt.get_lines() == lines
+    assert recovered.is_saved is False
+
+    recovered.save_to_disk()
+    (tmp_path / 'ext.txt').write_text("a\nB\nB2\nc\nd\nE\nf\ng\nh\n")
+    recovered.refresh_from_disk()
+    assert recovered.pt.get_lines() == lines + ["h\n"]
+    assert recovered.is_saved is True
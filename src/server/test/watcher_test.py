@@ -0,0 +1,23 @@
+from services.watcher import PollingWatcher
+
+
+def test_polling_watcher(tmp_path):
+    (tmp_path / 'a.txt').write_text("a")
+    (tmp_path / 'old').mkdir()
+    (tmp_path / 'old' / 'b.txt').write_text("b")
+    watcher = PollingWatcher(str(tmp_path))
+    assert watcher.poll() == []
+
+    (tmp_path / 'a.txt').write_text("changed")
+    (tmp_path / 'new').mkdir()
+    (tmp_path / 'new' / 'c.txt').write_text("c")
+    (tmp_path / 'old' / 'b.txt').unlink()
+    (tmp_path / '.a.txt.123.tmp').write_text("")
+
+    assert sorted(watcher.poll()) == [
+        ("added", "new/"),
+        ("added", "new/c.txt"),
+        ("modified", "a.txt"),
+        ("removed", "old/b.txt"),
+    ]
+    assert watcher.poll() == []